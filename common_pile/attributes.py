@@ -0,0 +1,271 @@
+"""A columnar store for dolma attributes.
+
+`dolma tag` writes one JSONL file of attributes per document shard and attribute
+set, and mixing reads every one of them in lockstep with the documents, decoding
+all of the spans even when a filter only looks at one score. This stores the same
+attributes as a Parquet file next to the JSONL one (`x.jsonl.gz` -> `x.parquet`).
+Row i holds the attributes of line i of the document shard, and each attribute,
+e.g. `char_length_v1__char_length_v1__length`, is a column of [start, end, score]
+spans. Parquet stores the start, end, and score of the spans as separate columns,
+so checking a filter rule against the score of the first span only reads the
+scores of that one attribute.
+
+Attributes a document doesn't have are null, an attribute with no spans is an
+empty list.
+"""
+
+import operator
+import os
+import re
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+SPAN_FIELDS = ("start", "end", "score")
+SPAN = pa.struct([("start", pa.int64()), ("end", pa.int64()), ("score", pa.float64())])
+ID = "id"
+COMPARISONS = {
+    "<=": operator.le,
+    "<": operator.lt,
+    ">=": operator.ge,
+    ">": operator.gt,
+    "==": operator.eq,
+    "!=": operator.ne,
+}
+# The filter rules the store can answer, `$.attributes[?(<conditions>)]`.
+RULE = re.compile(r"^\$@?\.attributes\[\?\((?P<conditions>.*)\)\]$")
+CONDITION = re.compile(
+    r"^@\.(?P<key>\w+)(?P<index>(?:\[\d+\])*)"
+    r"(?:\s*(?P<op><=|>=|==|!=|<|>)\s*(?P<value>-?[0-9.]+(?:[eE][-+]?\d+)?))?$"
+)
+
+
+def attributes_path(path: str, name: str) -> str:
+    """.../documents/x.jsonl.gz -> .../attributes/{name}/x.jsonl.gz"""
+    parts = path.split("/")
+    if "documents" not in parts:
+        raise ValueError(f"{path} isn't in a documents directory.")
+    idx = len(parts) - 1 - parts[::-1].index("documents")
+    return "/".join(parts[:idx] + ["attributes", name] + parts[idx + 1 :])
+
+
+def parquet_path(path: str) -> str:
+    """x.jsonl.gz -> x.parquet"""
+    head, tail = os.path.split(path)
+    for ext in (".jsonl", ".json"):
+        if ext in tail:
+            tail = tail[: tail.rindex(ext)]
+            break
+    return os.path.join(head, f"{tail}.parquet")
+
+
+def span_column(rows: Sequence[Optional[List[List[float]]]]) -> pa.ListArray:
+    """Build a column of spans from each row's [[start, end, score], ...] or None."""
+    lengths = np.fromiter(
+        (0 if spans is None else len(spans) for spans in rows),
+        dtype=np.int32,
+        count=len(rows),
+    )
+    offsets = np.zeros(len(rows) + 1, dtype=np.int32)
+    np.cumsum(lengths, out=offsets[1:])
+    flat = [span for spans in rows if spans for span in spans]
+    values = np.array(flat, dtype=np.float64).reshape(-1, 3)
+    spans = pa.StructArray.from_arrays(
+        [
+            pa.array(values[:, 0].astype(np.int64)),
+            pa.array(values[:, 1].astype(np.int64)),
+            pa.array(values[:, 2]),
+        ],
+        fields=list(SPAN),
+    )
+    mask = pa.array([spans is None for spans in rows], type=pa.bool_())
+    return pa.ListArray.from_arrays(pa.array(offsets), spans, mask=mask)
+
+
+class AttributeWriter:
+    """Collect the attributes of a shard's documents, in order, and write them as Parquet.
+
+    The file is written when the writer is closed, by way of a temporary file, so
+    a Parquet file that exists is complete.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.ids: List[str] = []
+        self.columns: Dict[str, List[Optional[List[List[float]]]]] = {}
+
+    def write(self, doc_id: str, attributes: Dict[str, List[List[float]]]):
+        row = len(self.ids)
+        self.ids.append(doc_id)
+        for key, spans in attributes.items():
+            if key not in self.columns:
+                self.columns[key] = [None] * row
+            self.columns[key].append(spans)
+        for key, column in self.columns.items():
+            if len(column) == row:
+                column.append(None)
+
+    def close(self):
+        table = pa.table(
+            {
+                ID: pa.array(self.ids, type=pa.string()),
+                **{key: span_column(self.columns[key]) for key in sorted(self.columns)},
+            }
+        )
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+
+
+class Condition(NamedTuple):
+    key: str
+    index: Tuple[int, ...]
+    op: Optional[str] = None
+    value: Optional[float] = None
+
+    @property
+    def field(self) -> Optional[str]:
+        """The part of the spans this condition reads, None when it only checks for them."""
+        if len(self.index) == 2:
+            return SPAN_FIELDS[self.index[1]]
+        return None
+
+
+def parse_rule(rule: str) -> List[List[Condition]]:
+    """Parse a filter rule into conditions, a list of alternatives that are all required.
+
+    Only rules on the spans of attributes are supported, e.g.
+    `$.attributes[?(@.x__x__en && @.x__x__en[0][2] <= 0.5)]`.
+    """
+    match = RULE.match(rule.strip())
+    if match is None:
+        raise ValueError(f"Only rules on the attributes are supported, not {rule}")
+    alternatives = []
+    for alternative in match.group("conditions").split("||"):
+        conditions = []
+        for condition in alternative.split("&&"):
+            m = CONDITION.match(condition.strip())
+            if m is None:
+                raise ValueError(f"Can't parse the condition {condition} in {rule}")
+            index = tuple(int(i) for i in re.findall(r"\d+", m.group("index")))
+            if len(index) > 2 or (len(index) == 2 and index[1] >= len(SPAN_FIELDS)):
+                raise ValueError(f"{condition} doesn't index into the spans.")
+            if (m.group("op") is None) != (len(index) != 2):
+                raise ValueError(
+                    f"{condition} needs to compare a start, end, or score."
+                )
+            conditions.append(
+                Condition(
+                    m.group("key"),
+                    index,
+                    m.group("op"),
+                    None if m.group("value") is None else float(m.group("value")),
+                )
+            )
+        alternatives.append(conditions)
+    return alternatives
+
+
+def evaluate_condition(condition: Condition, column: pa.ListArray) -> np.ndarray:
+    """Which rows match a condition, given the condition's column."""
+    valid = ~np.asarray(column.is_null(), dtype=bool)
+    if not condition.index:
+        return valid
+    offsets = np.asarray(column.offsets, dtype=np.int64)
+    i = condition.index[0]
+    matches = valid & (np.diff(offsets) > i)
+    if condition.field is None:
+        return matches
+    values = column.values
+    if isinstance(values, pa.StructArray):
+        values = values.field(condition.field)
+    values = np.asarray(values.to_numpy(zero_copy_only=False), dtype=np.float64)
+    rows = np.flatnonzero(matches)
+    matches[rows] = COMPARISONS[condition.op](
+        values[offsets[rows] + i], condition.value
+    )
+    return matches
+
+
+def evaluate_rule(
+    rule: str, read: Callable[[str, Optional[str]], Optional[pa.ListArray]], rows: int
+) -> np.ndarray:
+    """Which rows match a rule, reading each column it needs with `read(key, field)`.
+
+    `read` returns None for an attribute that isn't in the store, which no row has.
+    """
+    result = np.zeros(rows, dtype=bool)
+    columns = {}
+    for conditions in parse_rule(rule):
+        matches = np.ones(rows, dtype=bool)
+        for c in conditions:
+            if (c.key, c.field) not in columns:
+                columns[c.key, c.field] = read(c.key, c.field)
+            column = columns[c.key, c.field]
+            if column is None:
+                matches[:] = False
+                break
+            matches &= evaluate_condition(c, column)
+        result |= matches
+    return result
+
+
+class ShardAttributes:
+    """The columnar attributes of one document shard, across attribute sets."""
+
+    def __init__(self, document_path: str, attributes: Sequence[str]):
+        self.files = {}
+        for name in attributes:
+            path = parquet_path(attributes_path(document_path, name))
+            if not os.path.exists(path):
+                raise FileNotFoundError(
+                    f"Missing the {name} attributes of {document_path} at {path}"
+                )
+            self.files[name] = pq.ParquetFile(path)
+        self.keys = {}
+        for name, f in self.files.items():
+            for key in f.schema_arrow.names:
+                if key != ID:
+                    self.keys.setdefault(key, name)
+        rows = {f.metadata.num_rows for f in self.files.values()}
+        if len(rows) > 1:
+            raise ValueError(
+                f"The attribute sets of {document_path} have different numbers of rows."
+            )
+        self.rows = rows.pop() if rows else 0
+
+    def column(self, key: str, field: Optional[str] = None) -> Optional[pa.ListArray]:
+        """Read an attribute, or only the start, end, or score of its spans."""
+        if key not in self.keys:
+            return None
+        path = key if field is None else f"{key}.list.element.{field}"
+        table = self.files[self.keys[key]].read(columns=[path])
+        return table.column(0).combine_chunks()
+
+    def ids(self) -> List[str]:
+        f = next(iter(self.files.values()))
+        return f.read(columns=[ID]).column(0).to_pylist()
+
+    def matches(self, rule: str) -> np.ndarray:
+        return evaluate_rule(rule, self.column, self.rows)
+
+    def keep(
+        self, include: Sequence[str] = (), exclude: Sequence[str] = ()
+    ) -> np.ndarray:
+        """Which rows a mixer filter keeps, any include rule if there are some, and no exclude rule."""
+        keep = np.ones(self.rows, dtype=bool)
+        if include:
+            keep &= np.logical_or.reduce([self.matches(r) for r in include])
+        for rule in exclude:
+            keep &= ~self.matches(rule)
+        return keep
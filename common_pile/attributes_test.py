@@ -0,0 +1,108 @@
+"""Tests for the columnar attribute store."""
+
+import gzip
+import json
+import os
+
+import dolma
+import pytest
+
+from common_pile import attributes
+
+KEY = "x__x__score"
+ROWS = [
+    {},
+    {KEY: []},
+    {KEY: [[0, 10, 0.95]]},
+    {KEY: [[0, 10, 0.5]], "x__x__other": [[1, 2, 3.0]]},
+    {KEY: [[0, 4, 0.9], [5, 10, 0.1]]},
+    {KEY: [[0, 10, 0.3]]},
+    {KEY: [[0, 10, -20.5]]},
+]
+RULES = [
+    f"$@.attributes[?(@.{KEY} && @.{KEY}[0] && @.{KEY}[0][2] >= 0.9)]",
+    f"$.attributes[?(@.{KEY}[0][2] <= 0.5)]",
+    f"$.attributes[?(@.{KEY}[1][2] < 0.5)]",
+    f"$.attributes[?(@.{KEY}[0][1] > 4)]",
+    f"$.attributes[?(@.{KEY})]",
+    f"$.attributes[?(@.{KEY}[0][2] <= -20)]",
+    f"$.attributes[?(@.{KEY}[0][2] > 0.9 || @.{KEY}[0][2] < 0.4)]",
+    "$.attributes[?(@.y__y__score[0][2] <= 0.5)]",
+]
+
+
+@pytest.fixture
+def shard(tmp_path):
+    os.makedirs(tmp_path / "documents")
+    os.makedirs(tmp_path / "attributes" / "x")
+    with gzip.open(tmp_path / "documents" / "0.jsonl.gz", "wt") as wf, gzip.open(
+        tmp_path / "attributes" / "x" / "0.jsonl.gz", "wt"
+    ) as af, attributes.AttributeWriter(
+        str(tmp_path / "attributes" / "x" / "0.parquet")
+    ) as writer:
+        for i, row in enumerate(ROWS):
+            wf.write(json.dumps({"id": str(i), "text": "text", "source": "s"}) + "\n")
+            af.write(json.dumps({"id": str(i), "attributes": row}) + "\n")
+            writer.write(str(i), row)
+    return str(tmp_path / "documents" / "0.jsonl.gz")
+
+
+def test_parquet_path():
+    assert attributes.parquet_path("/a/b/0.jsonl.gz") == "/a/b/0.parquet"
+    assert attributes.parquet_path("/a/b/c.d.json.zst") == "/a/b/c.d.parquet"
+
+
+def test_round_trip(shard):
+    store = attributes.ShardAttributes(shard, ["x"])
+    assert store.rows == len(ROWS)
+    assert store.ids() == [str(i) for i in range(len(ROWS))]
+    spans = store.column(KEY).to_pylist()
+    assert [
+        None if s is None else [[x["start"], x["end"], x["score"]] for x in s]
+        for s in spans
+    ] == [row.get(KEY) for row in ROWS]
+    # Only the scores are read.
+    assert store.column(KEY, "score").type.value_type.names == ["score"]
+    assert store.column("missing") is None
+
+
+def test_parse_rule():
+    assert attributes.parse_rule(RULES[1]) == [
+        [attributes.Condition(KEY, (0, 2), "<=", 0.5)]
+    ]
+    for rule in (
+        "$.metadata[?(@.language in ['CSV'])]",
+        '.metadata.title | startswith("User talk")',
+        f"$.attributes[?(@.{KEY}[0][3] <= 0.5)]",
+        f"$.attributes[?(@.{KEY}[0] <= 0.5)]",
+    ):
+        with pytest.raises(ValueError):
+            attributes.parse_rule(rule)
+
+
+@pytest.mark.parametrize("rule", RULES)
+def test_matches_dolma_mix(shard, rule, tmp_path):
+    output = tmp_path / "mixed"
+    dolma.mixer(
+        {
+            "streams": [
+                {
+                    "name": "x",
+                    "documents": [shard],
+                    "attributes": ["x"],
+                    "output": {"path": str(output), "max_size_in_bytes": 2**30},
+                    "filter": {"include": [], "exclude": [rule], "syntax": "jsonpath"},
+                    "compression": {"input": None, "output": None},
+                }
+            ],
+            "work_dir": {
+                "input": str(tmp_path / "input"),
+                "output": str(tmp_path / "output"),
+            },
+            "processes": 1,
+        }
+    )
+    with gzip.open(output / "x-0000.json.gz", "rt") as f:
+        kept = [json.loads(l)["id"] for l in f]
+    store = attributes.ShardAttributes(shard, ["x"])
+    assert [i for i, k in zip(store.ids(), store.keep(exclude=[rule])) if k] == kept
@@ -0,0 +1,272 @@
+"""Content addressed memoization for expensive document conversions.
+
+Results are keyed by a hash of the input bytes, the name and version of the
+converter, and its config, so re-running a pipeline after a small code change
+only reconverts what actually changed. Entries live in a SQLite file so many
+worker processes can share one cache, and the least recently used entries are
+evicted once the cache grows past `max_bytes`.
+
+The cache is opt-in, set `COMMON_PILE_CACHE_DIR` (and optionally
+`COMMON_PILE_CACHE_MAX_GB`) to enable it for the pipelines that use
+`get_cache` or `memoize`.
+"""
+
+import dataclasses
+import functools
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from typing import Any, Callable, Dict, Optional, Union
+
+from common_pile.logs import get_logger
+
+CACHE_DIR_ENV = "COMMON_PILE_CACHE_DIR"
+CACHE_SIZE_ENV = "COMMON_PILE_CACHE_MAX_GB"
+CACHE_FILENAME = "conversions.sqlite"
+
+_MISSING = object()
+
+Version = Union[str, Callable[[], str]]
+
+
+@dataclasses.dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    bytes_written: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+def content_key(
+    data: Union[str, bytes],
+    converter: str,
+    version: str = "",
+    config: Optional[Dict[str, Any]] = None,
+) -> str:
+    """Hash the input with everything else that changes the conversion output."""
+    if isinstance(data, str):
+        data = data.encode("utf-8", "surrogatepass")
+    h = hashlib.sha256()
+    # Length prefix each part so different splits can't produce the same key.
+    for part in (
+        converter.encode("utf-8"),
+        str(version).encode("utf-8"),
+        json.dumps(config or {}, sort_keys=True, default=str).encode("utf-8"),
+        data,
+    ):
+        h.update(len(part).to_bytes(8, "little"))
+        h.update(part)
+    return h.hexdigest()
+
+
+class ConversionCache:
+    """An on-disk, size-bounded, LRU cache of JSON serializable conversion outputs."""
+
+    def __init__(
+        self,
+        path: str,
+        max_bytes: int = 10 * 1000 * 1000 * 1000,
+        evict_interval: int = 100,
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        # Summing the sizes is a table scan, so only check every so often.
+        self.evict_interval = evict_interval
+        self._puts = 0
+        self.stats = CacheStats()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Connections are opened lazily, so a cache created in a parent process
+        # can be used after it is pickled into workers.
+        self._conn = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_conn"] = None
+        return state
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS conversions ("
+                "key TEXT PRIMARY KEY, "
+                "converter TEXT, "
+                "value BLOB, "
+                "size INTEGER, "
+                "last_access REAL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS lru ON conversions (last_access)"
+            )
+        return self._conn
+
+    def get(self, key: str, default: Any = None) -> Any:
+        row = self.conn.execute(
+            "SELECT value FROM conversions WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            self.stats.misses += 1
+            return default
+        self.stats.hits += 1
+        self.conn.execute(
+            "UPDATE conversions SET last_access = ? WHERE key = ?", (time.time(), key)
+        )
+        return json.loads(row[0])
+
+    def put(self, key: str, value: Any, converter: str = ""):
+        blob = json.dumps(value).encode("utf-8")
+        self.conn.execute(
+            "INSERT OR REPLACE INTO conversions VALUES (?, ?, ?, ?, ?)",
+            (key, converter, blob, len(blob), time.time()),
+        )
+        self.stats.bytes_written += len(blob)
+        self._puts += 1
+        if self._puts % self.evict_interval == 0:
+            self.evict()
+
+    def size(self) -> int:
+        return self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM conversions"
+        ).fetchone()[0]
+
+    def evict(self):
+        """Drop the least recently used entries until we are under `max_bytes`."""
+        excess = self.size() - self.max_bytes
+        if excess <= 0:
+            return
+        freed = 0
+        evicted = []
+        for key, size in self.conn.execute(
+            "SELECT key, size FROM conversions ORDER BY last_access"
+        ):
+            evicted.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        self.conn.executemany("DELETE FROM conversions WHERE key = ?", evicted)
+        self.stats.evictions += len(evicted)
+        get_logger().debug("Evicted %d entries from %s", len(evicted), self.path)
+
+    def memoize(
+        self,
+        converter: str,
+        version: Version = "",
+        config: Optional[Dict[str, Any]] = None,
+        key_fn: Optional[Callable[..., Union[str, bytes]]] = None,
+    ):
+        """Decorator that caches a conversion function.
+
+        Args:
+          converter: The name of the conversion, i.e. "pandoc-html-plain".
+          version: The version of the converter, bump it to invalidate old results.
+            A callable is called the first time the function is, so finding the
+            version can be slow or fail when the converter isn't installed.
+          config: Any settings that change the output of the conversion.
+          key_fn: Maps the function arguments to the bytes to hash, defaults to
+            the first positional argument.
+        """
+        return _memoize(lambda: self, converter, version, config, key_fn)
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class NullCache:
+    """Stand-in used when caching is disabled, everything is a miss."""
+
+    def __init__(self):
+        self.stats = CacheStats()
+
+    def get(self, key: str, default: Any = None) -> Any:
+        self.stats.misses += 1
+        return default
+
+    def put(self, key: str, value: Any, converter: str = ""):
+        pass
+
+    def memoize(self, *args, **kwargs):
+        return lambda fn: fn
+
+    def close(self):
+        pass
+
+
+_NULL_CACHE = NullCache()
+
+
+def get_cache(
+    cache_dir: Optional[str] = None, max_gb: Optional[float] = None
+) -> Union[ConversionCache, NullCache]:
+    """Get the shared conversion cache, configured from the environment by default."""
+    cache_dir = cache_dir if cache_dir is not None else os.environ.get(CACHE_DIR_ENV)
+    if not cache_dir:
+        return _NULL_CACHE
+    max_gb = max_gb if max_gb is not None else float(os.environ.get(CACHE_SIZE_ENV, 10))
+    return _open_cache(cache_dir, max_gb)
+
+
+@functools.lru_cache(maxsize=None)
+def _open_cache(cache_dir: str, max_gb: float) -> ConversionCache:
+    return ConversionCache(
+        os.path.join(cache_dir, CACHE_FILENAME), max_bytes=int(max_gb * 1000**3)
+    )
+
+
+def _memoize(
+    get: Callable[[], Union[ConversionCache, NullCache]],
+    converter: str,
+    version: Version,
+    config: Optional[Dict[str, Any]],
+    key_fn: Optional[Callable[..., Union[str, bytes]]],
+):
+    key_fn = key_fn if key_fn is not None else (lambda data, *a, **kw: data)
+
+    def decorator(fn):
+        @functools.lru_cache(maxsize=None)
+        def resolved_version() -> str:
+            return str(version() if callable(version) else version)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            cache = get()
+            if isinstance(cache, NullCache):
+                return fn(*args, **kwargs)
+            key = content_key(
+                key_fn(*args, **kwargs), converter, resolved_version(), config
+            )
+            if (result := cache.get(key, _MISSING)) is not _MISSING:
+                return result
+            result = fn(*args, **kwargs)
+            cache.put(key, result, converter)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def memoize(
+    converter: str,
+    version: Version = "",
+    config: Optional[Dict[str, Any]] = None,
+    key_fn: Optional[Callable[..., Union[str, bytes]]] = None,
+):
+    """`ConversionCache.memoize` on the cache from `get_cache()` at call time.
+
+    The environment is read when the function is called rather than when it is
+    decorated, and nothing is done (not even finding the version) while caching
+    is disabled.
+    """
+    return _memoize(get_cache, converter, version, config, key_fn)
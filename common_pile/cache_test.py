@@ -0,0 +1,101 @@
+"""Tests for the conversion cache."""
+
+import time
+
+import pytest
+
+from common_pile import cache
+
+
+@pytest.fixture
+def conversions(tmp_path):
+    c = cache.ConversionCache(str(tmp_path / "cache.sqlite"))
+    yield c
+    c.close()
+
+
+def counted(fn):
+    def wrapper(*args, **kwargs):
+        wrapper.calls += 1
+        return fn(*args, **kwargs)
+
+    wrapper.calls = 0
+    return wrapper
+
+
+def test_hit_and_miss(conversions):
+    upper = counted(str.upper)
+    convert = conversions.memoize("upper", version="1")(upper)
+    assert convert("abc") == "ABC"
+    assert convert("abc") == "ABC"
+    assert convert("xyz") == "XYZ"
+    assert upper.calls == 2
+    assert (conversions.stats.hits, conversions.stats.misses) == (1, 2)
+
+
+def test_version_invalidates(conversions):
+    upper = counted(str.upper)
+    conversions.memoize("upper", version="1")(upper)("abc")
+    conversions.memoize("upper", version="1")(upper)("abc")
+    assert upper.calls == 1
+    conversions.memoize("upper", version="2")(upper)("abc")
+    assert upper.calls == 2
+    conversions.memoize("upper", version="1", config={"x": 1})(upper)("abc")
+    assert upper.calls == 3
+
+
+def test_version_is_lazy(conversions):
+    version = counted(lambda: "1")
+    convert = conversions.memoize("upper", version=version)(str.upper)
+    assert version.calls == 0
+    convert("abc")
+    convert("xyz")
+    assert version.calls == 1
+
+
+def test_lru_eviction(tmp_path):
+    c = cache.ConversionCache(
+        str(tmp_path / "cache.sqlite"), max_bytes=25, evict_interval=1
+    )
+    # Each value is 10 bytes of JSON.
+    c.put("a", "a" * 8)
+    time.sleep(0.01)
+    c.put("b", "b" * 8)
+    time.sleep(0.01)
+    assert c.get("a") == "a" * 8
+    time.sleep(0.01)
+    c.put("c", "c" * 8)
+    assert c.get("b") is None
+    assert c.get("a") == "a" * 8
+    assert c.get("c") == "c" * 8
+    assert c.stats.evictions == 1
+    assert c.size() <= 25
+    c.close()
+
+
+def test_null_cache(monkeypatch):
+    monkeypatch.delenv(cache.CACHE_DIR_ENV, raising=False)
+    null = cache.get_cache()
+    assert isinstance(null, cache.NullCache)
+    null.put("a", 1)
+    assert null.get("a") is None
+    upper = counted(str.upper)
+    assert null.memoize("upper")(upper) is upper
+
+
+def test_memoize_reads_environment_at_call_time(tmp_path, monkeypatch):
+    monkeypatch.delenv(cache.CACHE_DIR_ENV, raising=False)
+    version = counted(lambda: "1")
+    upper = counted(str.upper)
+    convert = cache.memoize("upper", version=version)(upper)
+    assert convert("abc") == "ABC"
+    assert convert("abc") == "ABC"
+    # While caching is disabled the version isn't needed.
+    assert (upper.calls, version.calls) == (2, 0)
+
+    monkeypatch.setenv(cache.CACHE_DIR_ENV, str(tmp_path))
+    assert convert("abc") == "ABC"
+    assert convert("abc") == "ABC"
+    assert (upper.calls, version.calls) == (3, 1)
+    assert cache.get_cache().stats.hits == 1
+    cache.get_cache().close()
@@ -0,0 +1,257 @@
+"""Polite, resumable bulk downloading of many urls to disk.
+
+Downloads are scheduled with asyncio: each domain gets its own workers that
+start requests at least `delay` seconds apart, while a global semaphore caps
+how many requests are in flight across all domains. A slow or rate limited
+site only holds up its own queue, so throughput scales with the number of
+sites instead of being bound by one sleep per worker.
+
+The requests themselves are made by the shared `common_pile.scrape.Client` in
+worker threads, so they get its connection pooling, retries, and 429 handling.
+Bodies are streamed to a temporary file that is renamed once complete.
+
+Every finished url is appended to a jsonl journal in the output directory,
+along with its `ETag` and `Last-Modified` headers. Re-running skips urls that
+are already in the journal, and with `refresh=True` they are re-requested
+conditionally, so pages that haven't changed come back as a cheap 304.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import dataclasses
+import functools
+import json
+import os
+import time
+from typing import Dict, Iterable, List, Optional
+
+from common_pile import logs, scrape
+
+JOURNAL_NAME = "download_journal.jsonl"
+
+# Journal statuses.
+DOWNLOADED = "downloaded"
+NOT_MODIFIED = "not_modified"
+FAILED = "failed"
+
+
+@dataclasses.dataclass
+class DownloadTask:
+    url: str
+    path: str
+
+
+@dataclasses.dataclass
+class DownloadStats:
+    downloaded: int = 0
+    not_modified: int = 0
+    skipped: int = 0
+    failed: int = 0
+    bytes: int = 0
+
+
+class Journal:
+    """An append-only jsonl log of the urls that finished downloading."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: Dict[str, Dict] = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # The last line can be cut off if we were killed mid write.
+                        continue
+                    self.entries[entry["url"]] = entry
+        self._wf = None
+
+    def completed(self, url: str) -> bool:
+        return self.entries.get(url, {}).get("status") in (DOWNLOADED, NOT_MODIFIED)
+
+    def record(self, url: str, status: str, **kwargs):
+        entry = {"url": url, "status": status, "time": time.time(), **kwargs}
+        # Keep the validators from the last download when the page didn't change.
+        if status == NOT_MODIFIED:
+            previous = self.entries.get(url, {})
+            for key in ("etag", "last_modified"):
+                entry.setdefault(key, previous.get(key))
+        self.entries[url] = entry
+        if self._wf is None:
+            self._wf = open(self.path, "a")
+        self._wf.write(json.dumps(entry) + "\n")
+        self._wf.flush()
+
+    def close(self):
+        if self._wf is not None:
+            self._wf.close()
+            self._wf = None
+
+
+def conditional_headers(entry: Optional[Dict]) -> Dict[str, str]:
+    """Headers that let the server skip sending a page we already have."""
+    headers = {}
+    if entry:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+
+def fetch(
+    client: scrape.Client,
+    task: DownloadTask,
+    headers: Dict[str, str],
+    chunk_size: int = 64 * 1024,
+) -> Dict:
+    """Download one url to disk, this runs in a worker thread."""
+    with client.get(task.url, headers=headers, stream=True) as resp:
+        if resp.status_code == 304:
+            return {"status": NOT_MODIFIED}
+        if resp.status_code != 200:
+            return {"status": FAILED, "code": resp.status_code}
+        tmp_path = f"{task.path}.tmp"
+        size = 0
+        with open(tmp_path, "wb") as wf:
+            for chunk in resp.iter_content(chunk_size=chunk_size):
+                size += wf.write(chunk)
+        os.replace(tmp_path, task.path)
+        return {
+            "status": DOWNLOADED,
+            "bytes": size,
+            "etag": resp.headers.get("ETag"),
+            "last_modified": resp.headers.get("Last-Modified"),
+        }
+
+
+class Downloader:
+    """Download tasks with per-domain politeness and a global concurrency cap.
+
+    Args:
+      output_dir: Where the journal is kept.
+      delay: The minimum time between the start of two requests to one domain.
+      concurrency: The max number of requests in flight across all domains.
+      per_domain: How many requests can be in flight to one domain at once.
+      refresh: Re-request completed urls, conditionally if we have validators.
+      overwrite: Re-request completed urls without validators.
+    """
+
+    def __init__(
+        self,
+        output_dir: str,
+        delay: float = 1.0,
+        concurrency: int = 32,
+        per_domain: int = 1,
+        refresh: bool = False,
+        overwrite: bool = False,
+        client: Optional[scrape.Client] = None,
+    ):
+        self.delay = delay
+        self.concurrency = concurrency
+        self.per_domain = per_domain
+        self.refresh = refresh
+        self.overwrite = overwrite
+        self.client = (
+            client if client is not None else scrape.Client(pool_size=concurrency)
+        )
+        self.journal = Journal(os.path.join(output_dir, JOURNAL_NAME))
+        self.stats = DownloadStats()
+        self._next_start: Dict[str, float] = collections.defaultdict(float)
+        self._executor = None
+
+    def pending(self, task: DownloadTask) -> bool:
+        if self.refresh or self.overwrite:
+            return True
+        return not (self.journal.completed(task.url) or os.path.exists(task.path))
+
+    async def _wait_turn(self, domain: str):
+        """Book the domain's next slot and sleep until it.
+
+        This is called while holding the global semaphore, so the slot is
+        booked from when the request really starts, not from before we
+        waited for the semaphore.
+        """
+        # The event loop is single threaded, so reserving the slot is atomic.
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        start = max(now, self._next_start[domain])
+        self._next_start[domain] = start + self.delay
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    async def _download(
+        self, task: DownloadTask, domain: str, semaphore: asyncio.Semaphore
+    ):
+        logger = logs.get_logger()
+        headers = {}
+        if not self.overwrite and os.path.exists(task.path):
+            headers = conditional_headers(self.journal.entries.get(task.url))
+        async with semaphore:
+            await self._wait_turn(domain)
+            try:
+                result = await asyncio.get_running_loop().run_in_executor(
+                    self._executor, functools.partial(fetch, self.client, task, headers)
+                )
+            except Exception as e:
+                result = {"status": FAILED, "error": str(e)}
+        status = result.pop("status")
+        if status == DOWNLOADED:
+            self.stats.downloaded += 1
+            self.stats.bytes += result["bytes"]
+        elif status == NOT_MODIFIED:
+            self.stats.not_modified += 1
+        else:
+            self.stats.failed += 1
+            logger.error("Failed to fetch %s: %s", task.url, result)
+        self.journal.record(task.url, status, path=task.path, **result)
+
+    async def _domain_worker(self, queue, domain, semaphore):
+        while queue:
+            task = queue.popleft()
+            # Wait until the domain is due before taking a global slot, so a
+            # domain that isn't due yet doesn't hold up the others.
+            wait = self._next_start[domain] - asyncio.get_running_loop().time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            await self._download(task, domain, semaphore)
+
+    async def adownload(self, tasks: Iterable[DownloadTask]) -> DownloadStats:
+        queues: Dict[str, collections.deque] = collections.defaultdict(
+            collections.deque
+        )
+        for task in tasks:
+            if not self.pending(task):
+                self.stats.skipped += 1
+                continue
+            queues[scrape.get_host(task.url)].append(task)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        workers = [
+            self._domain_worker(queue, domain, semaphore)
+            for domain, queue in queues.items()
+            for _ in range(min(self.per_domain, len(queue)))
+        ]
+        # The default executor is sized by cpu count, these threads just wait on io.
+        with concurrent.futures.ThreadPoolExecutor(self.concurrency) as executor:
+            self._executor = executor
+            try:
+                await asyncio.gather(*workers)
+            finally:
+                self.journal.close()
+        return self.stats
+
+    def download(self, tasks: Iterable[DownloadTask]) -> DownloadStats:
+        return asyncio.run(self.adownload(tasks))
+
+
+def download_urls(
+    tasks: List[DownloadTask], output_dir: str, **kwargs
+) -> DownloadStats:
+    """Download tasks into output_dir, see `Downloader` for the options."""
+    downloader = Downloader(output_dir, **kwargs)
+    stats = downloader.download(tasks)
+    downloader.client.log_metrics()
+    downloader.client.close()
+    return stats
@@ -0,0 +1,156 @@
+"""Tests for the polite bulk downloader, against a local mock server."""
+
+import collections
+import http.server
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from common_pile import download
+
+# How long the /slow pages take to answer.
+SLOW = 0.4
+
+
+class PageHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.requests.append((self.path, time.monotonic()))
+        self.server.starts.append((self.headers["Host"], time.monotonic()))
+        if self.path.startswith("/slow"):
+            time.sleep(SLOW)
+        if self.path.startswith("/missing"):
+            self.send_error(404)
+            return
+        etag = f'"{self.path}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.server.not_modified.append(self.path)
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = f"<html>{self.path}</html>".encode("utf-8")
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", "Mon, 01 Jan 2024 00:00:00 GMT")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), PageHandler)
+    httpd.requests = []
+    httpd.starts = []
+    httpd.not_modified = []
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def make_tasks(server, output_dir, paths, host="127.0.0.1"):
+    port = server.server_address[1]
+    return [
+        download.DownloadTask(
+            f"http://{host}:{port}{path}", os.path.join(output_dir, f"{i}.html")
+        )
+        for i, path in enumerate(paths)
+    ]
+
+
+def read_journal(output_dir):
+    with open(os.path.join(output_dir, download.JOURNAL_NAME)) as f:
+        return [json.loads(l) for l in f]
+
+
+def test_download_and_resume(server, tmp_path):
+    output_dir = str(tmp_path)
+    tasks = make_tasks(server, output_dir, ["/a", "/b", "/missing"])
+    stats = download.download_urls(tasks, output_dir, delay=0)
+    assert (stats.downloaded, stats.failed) == (2, 1)
+    with open(tasks[1].path) as f:
+        assert f.read() == "<html>/b</html>"
+    assert not os.path.exists(tasks[2].path)
+    journal = {e["url"]: e for e in read_journal(output_dir)}
+    assert journal[tasks[0].url]["etag"] == '"/a"'
+    assert journal[tasks[2].url]["status"] == download.FAILED
+
+    # Only the failed url is retried.
+    server.requests.clear()
+    stats = download.download_urls(tasks, output_dir, delay=0)
+    assert (stats.skipped, stats.failed) == (2, 1)
+    assert [p for p, _ in server.requests] == ["/missing"]
+
+
+def test_refresh_is_conditional(server, tmp_path):
+    output_dir = str(tmp_path)
+    tasks = make_tasks(server, output_dir, ["/a", "/b"])
+    download.download_urls(tasks, output_dir, delay=0)
+    stats = download.download_urls(tasks, output_dir, delay=0, refresh=True)
+    assert stats.not_modified == 2
+    assert sorted(server.not_modified) == ["/a", "/b"]
+    # The validators are kept for the next refresh.
+    journal = read_journal(output_dir)
+    assert journal[-1]["status"] == download.NOT_MODIFIED
+    assert journal[-1]["etag"] is not None
+    # Overwriting skips the validators.
+    server.not_modified.clear()
+    stats = download.download_urls(tasks, output_dir, delay=0, overwrite=True)
+    assert stats.downloaded == 2
+    assert server.not_modified == []
+
+
+def test_per_domain_delay(server, tmp_path):
+    output_dir = str(tmp_path)
+    paths = [f"/{i}" for i in range(3)]
+    # 127.0.0.1 and localhost are different domains to the scheduler.
+    tasks = make_tasks(server, output_dir, paths) + make_tasks(
+        server, os.path.join(output_dir, "l"), paths, host="localhost"
+    )
+    os.makedirs(os.path.join(output_dir, "l"))
+    start = time.monotonic()
+    stats = download.download_urls(tasks, output_dir, delay=0.2, concurrency=4)
+    elapsed = time.monotonic() - start
+    assert stats.downloaded == 6
+    # Each domain waits between its own requests, but the domains overlap.
+    assert 0.4 <= elapsed < 1.2
+
+
+def test_per_domain_delay_with_fewer_slots_than_domains(server, tmp_path):
+    output_dir = str(tmp_path)
+    os.makedirs(os.path.join(output_dir, "l"))
+    # The slow page holds the only slot, so the first localhost request starts
+    # late, and its next request has to wait from when it really started.
+    tasks = make_tasks(server, output_dir, ["/slow", "/1", "/2"]) + make_tasks(
+        server, os.path.join(output_dir, "l"), ["/0", "/1", "/2"], host="localhost"
+    )
+    delay = 0.3
+    stats = download.download_urls(tasks, output_dir, delay=delay, concurrency=1)
+    assert stats.downloaded == 6
+    starts = collections.defaultdict(list)
+    for host, start in server.starts:
+        starts[host.split(":")[0]].append(start)
+    assert sorted(starts) == ["127.0.0.1", "localhost"]
+    for times in starts.values():
+        gaps = [b - a for a, b in zip(times, times[1:])]
+        # A little slack for when the server sees the request.
+        assert min(gaps) >= delay - 0.02, gaps
+
+
+def test_journal_skips_truncated_lines(tmp_path):
+    path = tmp_path / download.JOURNAL_NAME
+    path.write_text('{"url": "a", "status": "downloaded"}\n{"url": "b", "sta')
+    journal = download.Journal(str(path))
+    assert journal.completed("a")
+    assert not journal.completed("b")
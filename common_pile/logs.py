@@ -1,9 +1,9 @@
 """Shared Logging setup for Common Pile."""
 
-import functools
 import logging
+import os
 import sys
-from typing import Protocol, Sequence
+from typing import Optional, Protocol, Sequence
 
 import contextual_logger
 from logging_json import JSONFormatter
@@ -35,7 +35,9 @@ def get_stream_handler() -> logging.Handler:
     return stream_handler
 
 
-def get_file_handler(log_file: str) -> logging.Handler:
+def get_file_handler(log_file: Optional[str] = None) -> logging.Handler:
+    if log_file is None:
+        log_file = os.environ.get("COMMON_PILE_LOG_FILE", "common_pile_log.txt")
     file_handler = logging.FileHandler(log_file)
     return file_handler
 
@@ -44,7 +46,7 @@ def get_file_handler(log_file: str) -> logging.Handler:
 # datadog or watch tower.
 DEFAULT_HANDLERS = (
     get_stream_handler,
-    functools.partial(get_file_handler, log_file="common_pile_log.txt"),
+    get_file_handler,
 )
 
 
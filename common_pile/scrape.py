@@ -1,10 +1,26 @@
-"""Shared Utilities related to scraping."""
+"""Shared Utilities related to scraping.
 
+Requests go through a shared `Client`, which keeps a pooled keep-alive session
+per host, rate limits each host with a token bucket that backs off when the
+site answers with a 429 (honoring `Retry-After`), retries transient failures,
+and tracks per-host latency and error counts.
+"""
+
+import asyncio
+import collections
+import dataclasses
+import email.utils
+import functools
 import logging
-from typing import Dict, Optional
+import random
+import threading
+import time
+import urllib.parse
+from typing import Dict, Iterable, List, Optional
 
 import requests
-from tenacity import retry, stop_after_attempt, wait_random_exponential
+
+from common_pile import logs
 
 # A user agent that says we are compatible with most websites (most browsers
 # start with Mozilla/5.0) and also tells that we are a bot and includes a link
@@ -14,20 +30,341 @@ USER_AGENT = "Mozilla/5.0 (compatible; Common-Pile-bot/0.1; +http://www.github.c
 
 DEFAULT_HEADERS = {"User-Agent": USER_AGENT}
 
+# Status codes that are worth retrying, everything else is returned as is.
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+
+
+def get_host(url: str) -> str:
+    return urllib.parse.urlparse(url).netloc
+
+
+class TokenBucket:
+    """A thread-safe token bucket, `acquire` blocks until a request is allowed.
+
+    Tokens are added at `rate` per second up to `burst`. Callers reserve their
+    token while holding the lock and sleep outside of it, so waiting threads
+    are released in order, `1 / rate` seconds apart. A rate <= 0 means no limit,
+    but `pause` is still honored.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+        self._resume_at = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1) -> float:
+        """Take tokens from the bucket, returns how long we waited for them."""
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0.0, self._resume_at - now)
+            if self.rate > 0:
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._last) * self.rate
+                )
+                self._tokens -= tokens
+                if self._tokens < 0:
+                    wait = max(wait, -self._tokens / self.rate)
+            self._last = now
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def pause(self, seconds: float):
+        """Don't hand out any tokens for the next `seconds`."""
+        with self._lock:
+            self._resume_at = max(self._resume_at, time.monotonic() + seconds)
+
+
+class HostRateLimiter:
+    """A token bucket per host, so scraping one site doesn't slow down another."""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = collections.defaultdict(
+            lambda: TokenBucket(self.rate, self.burst)
+        )
+        self._lock = threading.Lock()
+
+    def bucket(self, url: str) -> TokenBucket:
+        host = get_host(url)
+        with self._lock:
+            return self._buckets[host]
+
+    def wait(self, url: str) -> float:
+        return self.bucket(url).acquire()
+
+
+class AdaptiveRateLimiter(HostRateLimiter):
+    """A per-host limiter that slows down when a host says we are too fast.
+
+    Each 429 halves the host's rate (starting from `throttled_rate` for hosts
+    that were unlimited) and pauses it for the `Retry-After` time. Every
+    successful request adds `recovery` requests per second back, up to the
+    configured rate, so we settle just under what the host tolerates.
+    """
+
+    def __init__(
+        self,
+        rate: float = 0,
+        burst: int = 1,
+        throttled_rate: float = 1.0,
+        min_rate: float = 1 / 60,
+        recovery: float = 0.05,
+    ):
+        super().__init__(rate, burst)
+        self.throttled_rate = throttled_rate
+        self.min_rate = min_rate
+        self.recovery = recovery
+
+    def throttled(self, url: str, retry_after: Optional[float] = None):
+        bucket = self.bucket(url)
+        rate = bucket.rate / 2 if bucket.rate > 0 else self.throttled_rate
+        bucket.rate = max(self.min_rate, rate)
+        if retry_after:
+            bucket.pause(retry_after)
+        logs.get_logger().info(
+            "Throttled by %s, slowing down to %.3f requests/s",
+            get_host(url),
+            bucket.rate,
+        )
+
+    def succeeded(self, url: str):
+        bucket = self.bucket(url)
+        # Hosts that were never throttled have nothing to recover.
+        if bucket.rate <= 0 or bucket.rate == self.rate:
+            return
+        rate = bucket.rate + self.recovery
+        bucket.rate = min(rate, self.rate) if self.rate > 0 else rate
+
+
+@dataclasses.dataclass
+class HostStats:
+    requests: int = 0
+    errors: int = 0
+    throttled: int = 0
+    retries: int = 0
+    total_latency: float = 0.0
+    max_latency: float = 0.0
+
+    @property
+    def mean_latency(self) -> float:
+        return self.total_latency / self.requests if self.requests else 0.0
+
+    @property
+    def error_rate(self) -> float:
+        return self.errors / self.requests if self.requests else 0.0
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Convert a Retry-After header, either seconds or an http date, into seconds."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+
+class Client:
+    """A pooled, rate limited, retrying http client shared across scrapers.
+
+    Args:
+      rate: The max requests per second to any one host, <= 0 means no limit
+        until the host starts returning 429s.
+      burst: How many requests can be sent to a host back to back.
+      max_retries: How many times to retry connection errors and retryable
+        status codes before giving up.
+      pool_size: The number of keep-alive connections to keep open per host.
+      max_retry_after: Cap on how long we will sleep for a Retry-After header.
+      timeout: Timeout for each request in seconds.
+    """
+
+    def __init__(
+        self,
+        rate: float = 0,
+        burst: int = 1,
+        max_retries: int = 5,
+        pool_size: int = 16,
+        max_backoff: float = 30,
+        max_retry_after: float = 600,
+        timeout: Optional[float] = 60,
+        headers: Optional[Dict[str, str]] = None,
+    ):
+        self.limiter = AdaptiveRateLimiter(rate, burst)
+        self.max_retries = max_retries
+        self.pool_size = pool_size
+        self.max_backoff = max_backoff
+        self.max_retry_after = max_retry_after
+        self.timeout = timeout
+        # Unpack the defaults first so the user provided ones can override them.
+        self.headers = {**DEFAULT_HEADERS, **(headers or {})}
+        self.stats: Dict[str, HostStats] = collections.defaultdict(HostStats)
+        self._sessions: Dict[str, requests.Session] = {}
+        self._lock = threading.Lock()
+
+    def session(self, url: str) -> requests.Session:
+        """The keep-alive session for this url's host."""
+        host = get_host(url)
+        with self._lock:
+            if (session := self._sessions.get(host)) is None:
+                session = self._sessions[host] = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.pool_size
+                )
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                session.headers.update(self.headers)
+            return session
+
+    def _record(self, url: str, latency: float, error: bool, status: int = 0):
+        with self._lock:
+            stats = self.stats[get_host(url)]
+            stats.requests += 1
+            stats.errors += error
+            stats.throttled += status == 429
+            stats.total_latency += latency
+            stats.max_latency = max(stats.max_latency, latency)
+
+    def _backoff(self, attempt: int) -> float:
+        return min(self.max_backoff, 2**attempt) * random.uniform(0.5, 1)
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """Send a request, retrying failures. The last response is returned even
+        if it wasn't successful, connection errors are raised once we run out
+        of retries."""
+        kwargs.setdefault("timeout", self.timeout)
+        session = self.session(url)
+        for attempt in range(self.max_retries + 1):
+            last = attempt == self.max_retries
+            if attempt:
+                with self._lock:
+                    self.stats[get_host(url)].retries += 1
+            self.limiter.wait(url)
+            start = time.perf_counter()
+            try:
+                resp = session.request(method, url, **kwargs)
+            except requests.RequestException as e:
+                self._record(url, time.perf_counter() - start, error=True)
+                if last:
+                    raise
+                logs.get_logger().warning("Failed request to %s: %s", url, e)
+                time.sleep(self._backoff(attempt))
+                continue
+            status = resp.status_code
+            self._record(url, time.perf_counter() - start, status >= 400, status)
+            logging.debug(f"Sent {method} to {resp.url}: {status}")
+            if status not in RETRY_STATUSES or last:
+                if status < 400:
+                    self.limiter.succeeded(url)
+                return resp
+            retry_after = parse_retry_after(resp.headers.get("Retry-After"))
+            if retry_after is not None:
+                retry_after = min(retry_after, self.max_retry_after)
+            if status == 429:
+                self.limiter.throttled(url, retry_after)
+            else:
+                self.limiter.bucket(url).pause(
+                    retry_after if retry_after is not None else self._backoff(attempt)
+                )
+            logs.get_logger().warning(
+                "Failed request to %s: %d, %s, retrying", resp.url, status, resp.reason
+            )
+            # Release the connection back to the pool before we retry.
+            resp.close()
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    async def aget(self, url: str, **kwargs) -> requests.Response:
+        """`get` from async code, the request runs in a worker thread."""
+        return await asyncio.to_thread(self.get, url, **kwargs)
+
+    async def aget_many(
+        self, urls: Iterable[str], concurrency: int = 8, **kwargs
+    ) -> List[requests.Response]:
+        """Fetch urls with up to `concurrency` requests in flight, in order.
+
+        The per-host rate limits still apply, concurrency only helps when the
+        requests are spread over hosts or the host allows bursts.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def fetch(url):
+            async with semaphore:
+                return await self.aget(url, **kwargs)
+
+        return await asyncio.gather(*(fetch(url) for url in urls))
+
+    def get_many(
+        self, urls: Iterable[str], concurrency: int = 8, **kwargs
+    ) -> List[requests.Response]:
+        return asyncio.run(self.aget_many(urls, concurrency, **kwargs))
+
+    def metrics(self) -> Dict[str, Dict[str, float]]:
+        """Per-host request, error, and latency metrics."""
+        with self._lock:
+            return {
+                host: {
+                    **dataclasses.asdict(stats),
+                    "mean_latency": stats.mean_latency,
+                    "error_rate": stats.error_rate,
+                    "rate": self.limiter.bucket(f"//{host}").rate,
+                }
+                for host, stats in self.stats.items()
+            }
+
+    def log_metrics(self, logger=None):
+        logger = logger if logger is not None else logs.get_logger()
+        for host, m in self.metrics().items():
+            logger.info(
+                "%s: %d requests, %d errors (%d throttled), %d retries, "
+                "latency mean %.3fs max %.3fs",
+                host,
+                m["requests"],
+                m["errors"],
+                m["throttled"],
+                m["retries"],
+                m["mean_latency"],
+                m["max_latency"],
+            )
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+
+@functools.lru_cache(maxsize=None)
+def get_client() -> Client:
+    """The client shared by everything in this process."""
+    return Client()
+
 
-@retry(stop=stop_after_attempt(5), wait=wait_random_exponential(multiplier=1, max=30))
 def get_page(
     url: str,
     params: Optional[Dict[str, str]] = None,
     headers: Optional[Dict[str, str]] = None,
 ):
-    """GET page with retries, uses our common-pile default user-agent string."""
+    """GET page with retries, uses our common-pile default user-agent string.
+
+    Raises a RuntimeError if the final response isn't a 200, and the
+    `requests.RequestException` if the page still can't be reached after the
+    retries.
+    """
     params = params if params is not None else {}
-    headers = headers if headers is not None else {}
-    # Unpack the defaults first so the user provided ones can override them.
-    headers = {**DEFAULT_HEADERS, **headers}
-    resp = requests.get(url, params=params, headers=headers)
-    logging.debug(f"Sending GET to {resp.url}")
+    resp = get_client().get(url, params=params, headers=headers)
     if resp.status_code != 200:
         # TODO: Update logger
         logging.warning(
@@ -0,0 +1,117 @@
+"""Tests for the shared scraping client, against a local stub server."""
+
+import email.utils
+import http.server
+import threading
+import time
+
+import pytest
+
+from common_pile import scrape
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        # Each path can be given a list of statuses to return in order.
+        statuses = self.server.statuses.get(self.path, [])
+        status = statuses.pop(0) if statuses else 200
+        body = self.path.encode("utf-8")
+        self.send_response(status)
+        if status == 429:
+            self.send_header("Retry-After", "0")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    httpd.paths = []
+    httpd.statuses = {}
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def url(server, path):
+    return f"http://127.0.0.1:{server.server_address[1]}{path}"
+
+
+def test_retries_after_throttling(server):
+    server.statuses["/a"] = [429, 503]
+    client = scrape.Client(max_backoff=0.01)
+    resp = client.get(url(server, "/a"))
+    assert resp.status_code == 200
+    assert server.paths == ["/a", "/a", "/a"]
+    (metrics,) = client.metrics().values()
+    assert metrics["requests"] == 3
+    assert metrics["errors"] == 2
+    assert metrics["throttled"] == 1
+    assert metrics["retries"] == 2
+    # The host was unlimited, the 429 starts rate limiting it.
+    assert (
+        0 < metrics["rate"] <= client.limiter.throttled_rate + client.limiter.recovery
+    )
+
+
+def test_gives_up_and_returns_last_response(server):
+    server.statuses["/a"] = [500, 500, 500]
+    client = scrape.Client(max_retries=2, max_backoff=0.01)
+    assert client.get(url(server, "/a")).status_code == 500
+    assert len(server.paths) == 3
+
+
+def test_does_not_retry_client_errors(server):
+    server.statuses["/a"] = [404]
+    with pytest.raises(RuntimeError):
+        scrape.get_page(url(server, "/a"))
+    assert server.paths == ["/a"]
+
+
+def test_get_many_in_order(server):
+    client = scrape.Client()
+    paths = [f"/{i}" for i in range(10)]
+    responses = client.get_many([url(server, p) for p in paths], concurrency=4)
+    assert [r.text for r in responses] == paths
+    assert sorted(server.paths) == sorted(paths)
+
+
+def test_adaptive_rate_limiter():
+    limiter = scrape.AdaptiveRateLimiter(rate=8, recovery=1)
+    limiter.throttled("http://a.org")
+    limiter.throttled("http://a.org")
+    assert limiter.bucket("http://a.org").rate == 2
+    assert limiter.bucket("http://b.org").rate == 8
+    for _ in range(10):
+        limiter.succeeded("http://a.org")
+    assert limiter.bucket("http://a.org").rate == 8
+
+
+def test_token_bucket_pause():
+    bucket = scrape.TokenBucket(rate=0)
+    bucket.pause(0.05)
+    start = time.monotonic()
+    bucket.acquire()
+    assert time.monotonic() - start >= 0.04
+
+
+@pytest.mark.parametrize(
+    "value,expected",
+    [(None, None), ("", None), ("120", 120.0), ("soon", None)],
+)
+def test_parse_retry_after(value, expected):
+    assert scrape.parse_retry_after(value) == expected
+
+
+def test_parse_retry_after_date():
+    value = email.utils.formatdate(time.time() + 60, usegmt=True)
+    assert 55 < scrape.parse_retry_after(value) <= 60
@@ -0,0 +1,210 @@
+"""Convert dolma attributes to Parquet, and check mixer filters against them.
+
+    python columnar_attributes.py convert --config filtering/mixer_configs/stackexchange.json
+    python columnar_attributes.py filter --config filtering/mixer_configs/stackexchange.json
+
+`convert` writes a Parquet file next to each of the JSONL attribute files a mixer
+config uses (see `common_pile/attributes.py`). `filter` then counts how many
+documents each stream's filter rules remove, per rule, reading only the columns
+the rules need, e.g. to pick thresholds without running the mixer.
+"""
+
+import argparse
+import collections
+import glob
+import json
+import multiprocessing as mp
+import os
+from typing import Dict, List, Sequence, Tuple
+
+import msgspec
+import smart_open
+import tqdm
+
+from common_pile import attributes
+from common_pile.logs import configure_logging, get_logger
+
+configure_logging()
+
+
+def document_shards(documents: Sequence[str]) -> List[str]:
+    shards = []
+    for pattern in documents:
+        shards.extend(
+            p
+            for p in sorted(glob.glob(pattern))
+            if os.path.isfile(p) and p not in shards
+        )
+    return shards
+
+
+def run(pool, fn, tasks, desc):
+    return list(tqdm.tqdm(pool.imap(fn, tasks), total=len(tasks), desc=desc))
+
+
+def convert_file(task: Tuple[str, bool]) -> int:
+    """Convert one JSONL attribute file to Parquet, returning the number of rows."""
+    path, overwrite = task
+    output = attributes.parquet_path(path)
+    if not overwrite and os.path.exists(output):
+        return 0
+    decoder = msgspec.json.Decoder()
+    writer = attributes.AttributeWriter(output)
+    with smart_open.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            row = decoder.decode(line)
+            writer.write(row["id"], row.get("attributes") or {})
+    writer.close()
+    return len(writer.ids)
+
+
+def stream_filter_stats(task: Tuple[str, List[str], Dict]) -> Dict:
+    """Count the documents of one shard each filter rule matches."""
+    path, names, rules = task
+    shard = attributes.ShardAttributes(path, names)
+    include, exclude = rules.get("include", []), rules.get("exclude", [])
+    matched = {rule: int(shard.matches(rule).sum()) for rule in include + exclude}
+    return {
+        "documents": shard.rows,
+        "kept": int(shard.keep(include, exclude).sum()),
+        "matched": matched,
+    }
+
+
+def supported_rules(rules: Sequence[str]) -> Tuple[List[str], List[str]]:
+    supported, unsupported = [], []
+    for rule in rules:
+        try:
+            attributes.parse_rule(rule)
+            supported.append(rule)
+        except ValueError:
+            unsupported.append(rule)
+    return supported, unsupported
+
+
+def convert(args):
+    logger = get_logger()
+    with open(args.config) as f:
+        config = json.load(f)
+    tasks = []
+    for stream in config["streams"]:
+        names = stream.get("attributes", [])
+        if args.attributes:
+            names = [n for n in names if n in args.attributes]
+        for path in document_shards(stream["documents"]):
+            for name in names:
+                attribute_file = attributes.attributes_path(path, name)
+                if (attribute_file, args.overwrite) in tasks:
+                    continue
+                if os.path.exists(attribute_file):
+                    tasks.append((attribute_file, args.overwrite))
+                else:
+                    logger.warning("Missing %s, skipping it.", attribute_file)
+    logger.info("Converting %d attribute files", len(tasks))
+    with mp.Pool(args.processes) as pool:
+        rows = run(pool, convert_file, tasks, "Converting attributes")
+    logger.info("Converted %d rows", sum(rows))
+
+
+def filter_stats(args):
+    logger = get_logger()
+    with open(args.config) as f:
+        config = json.load(f)
+    report = []
+    with mp.Pool(args.processes) as pool:
+        for stream in config["streams"]:
+            rules = stream.get("filter") or {}
+            if rules.get("syntax", "jsonpath") != "jsonpath":
+                logger.warning(
+                    "Skipping %s, its filter isn't jsonpath.", stream["name"]
+                )
+                continue
+            include, skipped = supported_rules(rules.get("include", []))
+            exclude, unsupported = supported_rules(rules.get("exclude", []))
+            for rule in skipped + unsupported:
+                logger.warning("Skipping the rule %s, it isn't on attributes.", rule)
+            tasks = [
+                (
+                    path,
+                    stream.get("attributes", []),
+                    {"include": include, "exclude": exclude},
+                )
+                for path in document_shards(stream["documents"])
+            ]
+            results = run(pool, stream_filter_stats, tasks, stream["name"])
+            matched = collections.Counter()
+            for result in results:
+                matched.update(result["matched"])
+            # A skipped include rule can keep documents that the supported ones
+            # don't, and a skipped exclude rule can remove them, so the count
+            # of kept documents is only exact when no rule was skipped.
+            kept = None if skipped or unsupported else sum(r["kept"] for r in results)
+            stats = {
+                "stream": stream["name"],
+                "documents": sum(r["documents"] for r in results),
+                "kept": kept,
+                "matched": {rule: matched[rule] for rule in include + exclude},
+                "skipped": skipped + unsupported,
+            }
+            if kept is None:
+                logger.info(
+                    "%s: %d documents, the number kept is unknown as rules were "
+                    "skipped",
+                    stream["name"],
+                    stats["documents"],
+                )
+            else:
+                logger.info(
+                    "%s: kept %d of %d documents",
+                    stream["name"],
+                    kept,
+                    stats["documents"],
+                )
+            report.append(stats)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as wf:
+            wf.write(output + "\n")
+    else:
+        print(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Columnar dolma attributes.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    convert_parser = subparsers.add_parser(
+        "convert", help="Write Parquet copies of a mixer config's attribute files."
+    )
+    convert_parser.add_argument("--config", required=True, help="A mixer config.")
+    convert_parser.add_argument(
+        "--attributes", nargs="+", help="Only convert these attribute sets."
+    )
+    convert_parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="Convert files that already have a Parquet copy.",
+    )
+    convert_parser.set_defaults(fn=convert)
+    filter_parser = subparsers.add_parser(
+        "filter", help="Count the documents each filter rule of a mixer config removes."
+    )
+    filter_parser.add_argument("--config", required=True, help="A mixer config.")
+    filter_parser.add_argument(
+        "--output", help="Where to write the JSON report, defaults to stdout."
+    )
+    filter_parser.set_defaults(fn=filter_stats)
+    for p in (convert_parser, filter_parser):
+        p.add_argument(
+            "--processes",
+            type=int,
+            default=mp.cpu_count(),
+            help="Number of processors for multicore.",
+        )
+    args = parser.parse_args()
+    args.fn(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""Tests for the filter stats of the columnar attributes."""
+
+import argparse
+import gzip
+import json
+import os
+
+import pytest
+
+from common_pile import attributes
+from common_pile.scripts import columnar_attributes
+
+KEEP = "$.attributes[?(@.length[0][2] >= 3)]"
+
+
+@pytest.fixture
+def documents(tmp_path):
+    os.makedirs(tmp_path / "documents")
+    os.makedirs(tmp_path / "attributes" / "length")
+    with gzip.open(tmp_path / "documents" / "0.jsonl.gz", "wt") as wf, gzip.open(
+        tmp_path / "attributes" / "length" / "0.jsonl.gz", "wt"
+    ) as af, attributes.AttributeWriter(
+        str(tmp_path / "attributes" / "length" / "0.parquet")
+    ) as writer:
+        for i in range(10):
+            text = "x" * i
+            wf.write(json.dumps({"id": str(i), "text": text, "source": "s"}) + "\n")
+            row = {"length": [[0, i, float(i)]]}
+            af.write(json.dumps({"id": str(i), "attributes": row}) + "\n")
+            writer.write(str(i), row)
+    return str(tmp_path / "documents" / "*.gz")
+
+
+def filter_stats(tmp_path, documents, rules):
+    config = {
+        "streams": [
+            {
+                "name": "s",
+                "documents": [documents],
+                "attributes": ["length"],
+                "filter": rules,
+            }
+        ]
+    }
+    with open(tmp_path / "config.json", "w") as wf:
+        json.dump(config, wf)
+    output = tmp_path / "stats.json"
+    columnar_attributes.filter_stats(
+        argparse.Namespace(
+            config=str(tmp_path / "config.json"), processes=1, output=str(output)
+        )
+    )
+    with open(output) as f:
+        return json.load(f)[0]
+
+
+def test_kept(tmp_path, documents):
+    stats = filter_stats(tmp_path, documents, {"include": [KEEP]})
+    assert (stats["documents"], stats["kept"], stats["skipped"]) == (10, 7, [])
+    assert stats["matched"] == {KEEP: 7}
+
+
+@pytest.mark.parametrize("kind", ["include", "exclude"])
+def test_kept_is_unknown_with_skipped_rules(tmp_path, documents, kind):
+    skipped = '$.metadata[?(@.license == "CC0")]'
+    rules = {"include": [KEEP]}
+    rules.setdefault(kind, []).append(skipped)
+    stats = filter_stats(tmp_path, documents, rules)
+    assert stats["documents"] == 10
+    assert stats["kept"] is None
+    assert stats["matched"] == {KEEP: 7}
+    assert stats["skipped"] == [skipped]
@@ -0,0 +1,523 @@
+"""Exact n-gram paragraph dedupe, sharded over the n-gram hash space.
+
+This is an alternative to running `dolma dedupe` with a bloom filter: it reads the
+same config (filtering/dedupe_configs/global_dedupe.json) and writes the same
+attribute, i.e. `bff_duplicate_paragraph_spans`, so the mixer configs work as is.
+Instead of one serial pass that reads and writes a single shared bloom filter,
+it runs in stages that are each parallel, and can be split across nodes that
+share the work directory:
+
+  map:    Each document shard is split into paragraphs, and each paragraph into
+          hashed word n-grams. The (n-gram, paragraph, count) records are written
+          grouped by `hash % partitions`.
+  reduce: Each partition of the hash space finds, for every n-gram, the first
+          paragraph it appears in. Every later occurrence is a duplicate n-gram,
+          attributed to that first paragraph.
+  write:  The duplicate counts of each paragraph are summed over the partitions.
+          A paragraph whose fraction of duplicate n-grams is at least the overlap
+          threshold gets a span in its shard's attribute file.
+  clusters: A clusters.jsonl report groups the duplicates, each one is linked to
+          the earlier paragraph it shares the most n-grams with.
+
+"First" follows the order the documents are listed in the config, then the
+sorted shard paths, then the position in the shard, so results don't depend on
+how the work is split up. Unlike the bloom filter, there are no false positives,
+and the n-grams of duplicate paragraphs count as seen for later paragraphs too.
+Words are runs of word characters (allowing inner apostrophes and periods), an
+approximation of the unicode word segmentation dolma uses, which also counts each
+punctuation mark as a word. An n-gram repeated within its first paragraph isn't a
+duplicate, while dolma counts the repeats.
+
+Spans are character offsets and, like dolma's, include the separator after the
+paragraph unless it is at the very end of the text, so the mixer removes it with
+the paragraph. dolma only advances its offsets one character per separator, so
+with a longer separator, e.g. "████████", its spans drift away from the paragraphs
+they score. Here the spans always cover the paragraph and its whole separator.
+
+    python dedupe.py --config filtering/dedupe_configs/global_dedupe.json --work_dir /mnt/data2/dedupe --processes 64
+"""
+
+import argparse
+import collections
+import glob
+import json
+import multiprocessing as mp
+import os
+import re
+import zlib
+from typing import Dict, Iterator, List, NamedTuple, Tuple
+
+import msgspec
+import numpy as np
+import smart_open
+import tqdm
+from dolma.core.data_types import InputSpec
+
+from common_pile.attributes import attributes_path
+from common_pile.logs import configure_logging, get_logger
+
+configure_logging()
+
+STAGES = ("map", "reduce", "write", "clusters")
+WORD = re.compile(r"\w+(?:['’.]\w+)*")
+# The paragraph id is the shard index in the high bits and the paragraph's index
+# in the shard in the low bits, so ids sort in document order.
+UNIT_BITS = 40
+UNIT_MASK = (1 << UNIT_BITS) - 1
+
+parser = argparse.ArgumentParser(description="Sharded exact n-gram paragraph dedupe.")
+parser.add_argument("--config", required=True, help="A dolma dedupe config.")
+parser.add_argument(
+    "--work_dir",
+    required=True,
+    help="Where the intermediate files go, shared by all nodes.",
+)
+parser.add_argument(
+    "--stage", choices=STAGES + ("all",), default="all", help="Which stage to run."
+)
+parser.add_argument(
+    "--partitions",
+    type=int,
+    default=256,
+    help="How many parts to split the n-gram hashes into.",
+)
+parser.add_argument(
+    "--processes",
+    type=int,
+    default=mp.cpu_count(),
+    help="Number of processes per node.",
+)
+parser.add_argument(
+    "--node",
+    type=int,
+    default=0,
+    help="Which node this is, when splitting a stage across nodes.",
+)
+parser.add_argument(
+    "--nodes", type=int, default=1, help="How many nodes the stage is split across."
+)
+
+
+class NgramConfig(NamedTuple):
+    attribute_name: str
+    ngram_length: int
+    stride: int
+    overlap_threshold: float
+    skip_short_paragraphs: bool
+    paragraph_separator: str
+
+
+def read_config(path: str) -> Tuple[str, List[str], NgramConfig]:
+    """The dedupe name, the sorted document shards, and the paragraph settings."""
+    with open(path) as f:
+        config = json.load(f)
+    paragraphs = config["dedupe"]["paragraphs"]
+    by_ngram = paragraphs.get("by_ngram") or {}
+    ngrams = NgramConfig(
+        attribute_name=paragraphs["attribute_name"],
+        ngram_length=by_ngram.get("ngram_length", 0),
+        stride=by_ngram.get("stride", 0),
+        overlap_threshold=by_ngram.get("overlap_threshold", 1.0),
+        skip_short_paragraphs=by_ngram.get("skip_short_paragraphs", False),
+        paragraph_separator=paragraphs.get("paragraph_separator", "\n"),
+    )
+    shards = []
+    for pattern in config["documents"]:
+        shards.extend(p for p in sorted(glob.glob(pattern)) if os.path.isfile(p))
+    return config["dedupe"]["name"], shards, ngrams
+
+
+def split_paragraphs(text: str, separator: str) -> Iterator[Tuple[int, int]]:
+    start = 0
+    while (end := text.find(separator, start)) != -1:
+        yield start, end
+        start = end + len(separator)
+    yield start, len(text)
+
+
+def span_end(text: str, end: int, separator: str) -> int:
+    """Where the span of a paragraph ending at `end` ends, including its separator."""
+    if end + len(separator) < len(text):
+        return end + len(separator)
+    return end
+
+
+def _mix(h: np.ndarray) -> np.ndarray:
+    """The splitmix64 finalizer, vectorized."""
+    h = (h ^ (h >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return h ^ (h >> np.uint64(31))
+
+
+def hash_words(words: List[str]) -> np.ndarray:
+    """A stable 64 bit hash of each word (python's hash changes per process)."""
+    lookup = {}
+    for w in words:
+        if w not in lookup:
+            data = w.encode("utf-8", "surrogatepass")
+            lookup[w] = zlib.crc32(data) << 32 | zlib.adler32(data)
+    return np.fromiter((lookup[w] for w in words), dtype=np.uint64, count=len(words))
+
+
+def hash_ngrams(words: List[str], ngrams: NgramConfig) -> np.ndarray:
+    """The hash of every `ngram_length` words, `stride` words apart.
+
+    A paragraph shorter than one n-gram is a single n-gram of all its words,
+    unless `skip_short_paragraphs` is set.
+    """
+    n = ngrams.ngram_length
+    if not words or (len(words) < n and ngrams.skip_short_paragraphs):
+        return np.zeros(0, dtype=np.uint64)
+    words = hash_words(words)
+    n = min(max(n, 1), len(words))
+    count = len(words) - n + 1
+    # A polynomial hash of the word hashes, so the order of the words matters.
+    h = words[:count].copy()
+    for k in range(1, n):
+        h = h * np.uint64(0x100000001B3) + words[k : k + count]
+    return _mix(h)[:: max(ngrams.stride, 1)]
+
+
+def shard_dir(work_dir: str, shard: int) -> str:
+    return os.path.join(work_dir, "map", f"{shard:06d}")
+
+
+def reduce_path(work_dir: str, partition: int) -> str:
+    return os.path.join(work_dir, "reduce", f"{partition:05d}.npz")
+
+
+def save_atomic(path: str, **arrays):
+    tmp_path = f"{path}.tmp.npz"
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+
+
+def map_shard(task: Tuple[int, str, NgramConfig, str, int]) -> int:
+    """Hash the n-grams of every paragraph in a shard, grouped by partition."""
+    shard, path, ngrams, work_dir, partitions = task
+    output_dir = shard_dir(work_dir, shard)
+    if os.path.exists(os.path.join(output_dir, "units.npy")):
+        return 0
+    decoder = msgspec.json.Decoder(InputSpec)
+    docs, units, hashes, unit_ids, counts = [], [], [], [], []
+    with smart_open.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            row = decoder.decode(line)
+            docs.append({"id": row.id, "source": row.source})
+            for start, end in split_paragraphs(row.text, ngrams.paragraph_separator):
+                h = hash_ngrams(WORD.findall(row.text, start, end), ngrams)
+                if not len(h):
+                    continue
+                h, c = np.unique(h, return_counts=True)
+                unit = shard << UNIT_BITS | len(units)
+                span = (start, span_end(row.text, end, ngrams.paragraph_separator))
+                units.append((len(docs) - 1, *span, c.sum()))
+                hashes.append(h)
+                unit_ids.append(np.full(len(h), unit, dtype=np.uint64))
+                counts.append(c.astype(np.uint32))
+    hashes = np.concatenate(hashes) if hashes else np.zeros(0, dtype=np.uint64)
+    unit_ids = np.concatenate(unit_ids) if unit_ids else np.zeros(0, dtype=np.uint64)
+    counts = np.concatenate(counts) if counts else np.zeros(0, dtype=np.uint32)
+    part = hashes % np.uint64(partitions)
+    order = np.argsort(part, kind="stable")
+    offsets = np.searchsorted(part[order], np.arange(partitions + 1))
+
+    tmp_dir = f"{output_dir}.tmp"
+    os.makedirs(tmp_dir, exist_ok=True)
+    np.save(os.path.join(tmp_dir, "hashes.npy"), hashes[order])
+    np.save(os.path.join(tmp_dir, "unit_ids.npy"), unit_ids[order])
+    np.save(os.path.join(tmp_dir, "counts.npy"), counts[order])
+    np.save(os.path.join(tmp_dir, "offsets.npy"), offsets)
+    with open(os.path.join(tmp_dir, "docs.jsonl"), "w") as wf:
+        wf.writelines(json.dumps(d) + "\n" for d in docs)
+    # units.npy is written last, it marks the shard as done.
+    np.save(
+        os.path.join(tmp_dir, "units.npy"),
+        np.array(units, dtype=np.int64).reshape(-1, 4),
+    )
+    if os.path.exists(output_dir):
+        for name in os.listdir(output_dir):
+            os.remove(os.path.join(output_dir, name))
+        os.rmdir(output_dir)
+    os.replace(tmp_dir, output_dir)
+    return len(docs)
+
+
+def sum_pairs(
+    units: np.ndarray, owners: np.ndarray, counts: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Sum the counts of each (paragraph, owner) pair, sorted by paragraph then owner."""
+    if not len(units):
+        return units, owners, counts
+    order = np.lexsort((owners, units))
+    units, owners, counts = units[order], owners[order], counts[order]
+    starts = np.flatnonzero(
+        np.r_[True, (units[1:] != units[:-1]) | (owners[1:] != owners[:-1])]
+    )
+    return units[starts], owners[starts], np.add.reduceat(counts, starts)
+
+
+def reduce_partition(task: Tuple[int, int, str]) -> int:
+    """Find the first paragraph of each n-gram in one partition of the hash space.
+
+    Saves every (paragraph, first paragraph, count) of the duplicate n-grams,
+    summed over the pairs.
+    """
+    partition, num_shards, work_dir = task
+    path = reduce_path(work_dir, partition)
+    if os.path.exists(path):
+        return 0
+    hashes, unit_ids, counts = [], [], []
+    for shard in range(num_shards):
+        d = shard_dir(work_dir, shard)
+        offsets = np.load(os.path.join(d, "offsets.npy"))
+        lo, hi = offsets[partition], offsets[partition + 1]
+        if lo == hi:
+            continue
+        hashes.append(np.load(os.path.join(d, "hashes.npy"), mmap_mode="r")[lo:hi])
+        unit_ids.append(np.load(os.path.join(d, "unit_ids.npy"), mmap_mode="r")[lo:hi])
+        counts.append(np.load(os.path.join(d, "counts.npy"), mmap_mode="r")[lo:hi])
+    if not hashes:
+        save_atomic(
+            path,
+            units=np.zeros(0, np.uint64),
+            owners=np.zeros(0, np.uint64),
+            counts=np.zeros(0, np.uint64),
+        )
+        return 0
+    hashes, unit_ids, counts = (
+        np.concatenate(hashes),
+        np.concatenate(unit_ids),
+        np.concatenate(counts),
+    )
+    order = np.lexsort((unit_ids, hashes))
+    hashes, unit_ids, counts = hashes[order], unit_ids[order], counts[order]
+    # Each run of equal hashes starts with its first paragraph, the rest are duplicates.
+    first = np.ones(len(hashes), dtype=bool)
+    first[1:] = hashes[1:] != hashes[:-1]
+    owners = unit_ids[first][np.cumsum(first) - 1]
+    dup = ~first
+    units, owners, counts = sum_pairs(
+        unit_ids[dup], owners[dup], counts[dup].astype(np.uint64)
+    )
+    save_atomic(path, units=units, owners=owners, counts=counts)
+    return len(units)
+
+
+def load_duplicates(
+    work_dir: str, partitions: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Every (paragraph, owner, count) of duplicate n-grams, summed over the partitions."""
+    units, owners, counts = [], [], []
+    for partition in range(partitions):
+        with np.load(reduce_path(work_dir, partition)) as data:
+            units.append(data["units"])
+            owners.append(data["owners"])
+            counts.append(data["counts"])
+    return sum_pairs(
+        np.concatenate(units), np.concatenate(owners), np.concatenate(counts)
+    )
+
+
+def duplicate_counts(
+    units: np.ndarray, counts: np.ndarray
+) -> Dict[int, Dict[int, int]]:
+    """The number of duplicate n-grams in each paragraph, by shard."""
+    by_shard = collections.defaultdict(dict)
+    totals = collections.Counter()
+    for unit, count in zip(units.tolist(), counts.tolist()):
+        totals[unit] += count
+    for unit, count in totals.items():
+        by_shard[unit >> UNIT_BITS][unit & UNIT_MASK] = count
+    return by_shard
+
+
+def best_owners(
+    units: np.ndarray, owners: np.ndarray, counts: np.ndarray
+) -> Dict[int, int]:
+    """The earlier paragraph each paragraph shares the most n-grams with, the first on ties."""
+    best: Dict[int, Tuple[int, int]] = {}
+    # Owners are sorted within each paragraph, so the first max is the earliest.
+    for unit, owner, count in zip(units.tolist(), owners.tolist(), counts.tolist()):
+        if unit not in best or count > best[unit][1]:
+            best[unit] = (owner, count)
+    return {u: o for u, (o, _) in best.items()}
+
+
+def write_shard(task: Tuple[int, str, str, NgramConfig, str, Dict[int, int]]) -> int:
+    """Write the attribute file of one shard, and the scores of its duplicate paragraphs."""
+    shard, path, name, ngrams, work_dir, duplicates = task
+    d = shard_dir(work_dir, shard)
+    units = np.load(os.path.join(d, "units.npy"))
+    with open(os.path.join(d, "docs.jsonl")) as f:
+        docs = [json.loads(l) for l in f]
+    spans = [[] for _ in docs]
+    flagged, scores = [], []
+    for i, count in sorted(duplicates.items()):
+        doc, start, end, total = units[i].tolist()
+        score = count / total
+        if score >= ngrams.overlap_threshold:
+            spans[doc].append([start, end, score])
+            flagged.append(shard << UNIT_BITS | i)
+            scores.append(score)
+    output = attributes_path(path, name)
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    tmp_path = f"{output}.tmp"
+    with smart_open.open(
+        tmp_path, "wt", encoding="utf-8", compression=smart_open_compression(output)
+    ) as wf:
+        for doc, doc_spans in zip(docs, spans):
+            wf.write(
+                json.dumps({**doc, "attributes": {ngrams.attribute_name: doc_spans}})
+                + "\n"
+            )
+    os.replace(tmp_path, output)
+    save_atomic(
+        os.path.join(d, "flagged.npz"),
+        units=np.array(flagged, dtype=np.uint64),
+        scores=np.array(scores),
+    )
+    return len(flagged)
+
+
+def smart_open_compression(path: str) -> str:
+    # The output is written to a tmp file, so the compression can't come from its name.
+    return (
+        os.path.splitext(path)[1]
+        if path.endswith((".gz", ".zst", ".bz2"))
+        else "disable"
+    )
+
+
+class Paragraphs:
+    """Look up where paragraphs are, loading each shard's tables once."""
+
+    def __init__(self, work_dir: str, shards: List[str]):
+        self.work_dir = work_dir
+        self.shards = shards
+        self._cache = {}
+
+    def __getitem__(self, unit: int) -> Dict:
+        shard, i = unit >> UNIT_BITS, unit & UNIT_MASK
+        if shard not in self._cache:
+            d = shard_dir(self.work_dir, shard)
+            with open(os.path.join(d, "docs.jsonl")) as f:
+                ids = [json.loads(l)["id"] for l in f]
+            self._cache[shard] = (ids, np.load(os.path.join(d, "units.npy")))
+        ids, units = self._cache[shard]
+        doc, start, end, _ = units[i].tolist()
+        return {"path": self.shards[shard], "id": ids[doc], "start": start, "end": end}
+
+
+def write_clusters(
+    path: str, paragraphs: Paragraphs, flagged: Dict[int, float], owners: Dict[int, int]
+) -> int:
+    """Group each duplicate paragraph under the first paragraph of its chain of owners."""
+    roots = {}
+
+    def root(unit):
+        chain = []
+        while unit in flagged and unit not in roots:
+            chain.append(unit)
+            unit = owners[unit]
+        r = roots.get(unit, unit)
+        for u in chain:
+            roots[u] = r
+        return r
+
+    clusters = collections.defaultdict(list)
+    for unit in sorted(flagged):
+        clusters[root(unit)].append(unit)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as wf:
+        for r, members in sorted(clusters.items()):
+            cluster = {
+                "root": paragraphs[r],
+                "members": [
+                    {
+                        **paragraphs[u],
+                        "score": flagged[u],
+                        "owner": paragraphs[owners[u]]["id"],
+                    }
+                    for u in members
+                ],
+            }
+            wf.write(json.dumps(cluster) + "\n")
+    os.replace(tmp_path, path)
+    return len(clusters)
+
+
+def run(pool, fn, tasks, desc):
+    results = []
+    for result in tqdm.tqdm(
+        pool.imap_unordered(fn, tasks), total=len(tasks), desc=desc
+    ):
+        results.append(result)
+    return results
+
+
+def main(args):
+    logger = get_logger()
+    name, shards, ngrams = read_config(args.config)
+    if not shards:
+        raise ValueError(f"No documents match the globs in {args.config}")
+    logger.info("Deduping %d shards in %d partitions", len(shards), args.partitions)
+    os.makedirs(os.path.join(args.work_dir, "map"), exist_ok=True)
+    os.makedirs(os.path.join(args.work_dir, "reduce"), exist_ok=True)
+    stages = STAGES if args.stage == "all" else (args.stage,)
+
+    def mine(items):
+        return [x for i, x in enumerate(items) if i % args.nodes == args.node]
+
+    with mp.Pool(args.processes) as pool:
+        if "map" in stages:
+            tasks = mine(
+                [
+                    (i, p, ngrams, args.work_dir, args.partitions)
+                    for i, p in enumerate(shards)
+                ]
+            )
+            docs = run(pool, map_shard, tasks, "Hashing n-grams")
+            logger.info("Hashed the n-grams of %d documents", sum(docs))
+        if "reduce" in stages:
+            tasks = mine(
+                [(p, len(shards), args.work_dir) for p in range(args.partitions)]
+            )
+            pairs = run(pool, reduce_partition, tasks, "Finding duplicate n-grams")
+            logger.info("Found %d duplicate paragraph pairs", sum(pairs))
+        if "write" in stages:
+            units, _, counts = load_duplicates(args.work_dir, args.partitions)
+            duplicates = duplicate_counts(units, counts)
+            tasks = mine(
+                [
+                    (i, p, name, ngrams, args.work_dir, duplicates.get(i, {}))
+                    for i, p in enumerate(shards)
+                ]
+            )
+            flagged = run(pool, write_shard, tasks, "Writing attributes")
+            logger.info("Flagged %d duplicate paragraphs", sum(flagged))
+    # The clusters need every shard to be written, with several nodes run this stage on its own.
+    if "clusters" in stages and args.node == 0:
+        flagged = {}
+        for shard in range(len(shards)):
+            with np.load(
+                os.path.join(shard_dir(args.work_dir, shard), "flagged.npz")
+            ) as data:
+                flagged.update(zip(data["units"].tolist(), data["scores"].tolist()))
+        owners = best_owners(*load_duplicates(args.work_dir, args.partitions))
+        paragraphs = Paragraphs(args.work_dir, shards)
+        clusters = write_clusters(
+            os.path.join(args.work_dir, "clusters.jsonl"), paragraphs, flagged, owners
+        )
+        logger.info(
+            "Wrote %d duplicate clusters to %s",
+            clusters,
+            os.path.join(args.work_dir, "clusters.jsonl"),
+        )
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args)
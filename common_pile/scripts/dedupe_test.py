@@ -0,0 +1,203 @@
+"""Tests for the sharded n-gram dedupe."""
+
+import argparse
+import gzip
+import json
+import os
+import random
+
+import dolma
+import pytest
+
+from common_pile.scripts import dedupe
+
+WORDS = [f"w{i}" for i in range(30)]
+
+
+def make_config(tmp_path, separator="\n", ngram_length=3, threshold=0.5):
+    config = {
+        "documents": [
+            str(tmp_path / "a" / "documents" / "*.jsonl.gz"),
+            str(tmp_path / "b" / "documents" / "*.jsonl.gz"),
+        ],
+        "dedupe": {
+            "name": "global_dedupe",
+            "paragraphs": {
+                "attribute_name": "bff_duplicate_paragraph_spans",
+                "by_ngram": {
+                    "ngram_length": ngram_length,
+                    "stride": 1,
+                    "overlap_threshold": threshold,
+                    "skip_short_paragraphs": True,
+                },
+                "paragraph_separator": separator,
+            },
+        },
+    }
+    path = tmp_path / "dedupe.json"
+    path.write_text(json.dumps(config))
+    return str(path)
+
+
+def write_shard(path, texts, prefix):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with gzip.open(path, "wt") as wf:
+        for i, text in enumerate(texts):
+            wf.write(
+                json.dumps({"id": f"{prefix}-{i}", "text": text, "source": "t"}) + "\n"
+            )
+
+
+def run(config, work_dir, partitions=4):
+    args = argparse.Namespace(
+        config=config,
+        work_dir=str(work_dir),
+        stage="all",
+        partitions=partitions,
+        processes=2,
+        node=0,
+        nodes=1,
+    )
+    dedupe.main(args)
+
+
+def read_spans(path):
+    with gzip.open(path, "rt") as f:
+        return [json.loads(l)["attributes"]["bff_duplicate_paragraph_spans"] for l in f]
+
+
+def dolma_dedupe(config, work_dir):
+    """Run `dolma dedupe` on a config, with a bloom filter too big for false positives."""
+    with open(config) as f:
+        config = json.load(f)
+    config["dedupe"].update(
+        skip_empty=False, min_length=0, min_words=0, num_partitions=1, partition_index=0
+    )
+    config["bloom_filter"] = {
+        "file": str(work_dir / "bloom_filter.bin"),
+        "read_only": False,
+        "size_in_bytes": 0,
+        "estimated_doc_count": 100_000,
+        "desired_false_positive_rate": 1e-9,
+    }
+    config["work_dir"] = {
+        "input": str(work_dir / "input"),
+        "output": str(work_dir / "output"),
+    }
+    config.update(
+        processes=1, is_s3_volume=False, compression={"input": None, "output": None}
+    )
+    dolma.deduper(config)
+
+
+def test_attributes_path():
+    assert (
+        dedupe.attributes_path("/d/x/v1/documents/sub/0.jsonl.gz", "global_dedupe")
+        == "/d/x/v1/attributes/global_dedupe/sub/0.jsonl.gz"
+    )
+
+
+def test_hash_ngrams():
+    ngrams = dedupe.NgramConfig("a", 3, 1, 0.5, True, "\n")
+    h = dedupe.hash_ngrams(["a", "b", "c", "d"], ngrams)
+    assert len(h) == 2
+    # Order matters.
+    assert dedupe.hash_ngrams(["b", "a", "c"], ngrams)[0] != h[0]
+    assert dedupe.hash_ngrams(["a", "b", "c"], ngrams)[0] == h[0]
+    assert not len(dedupe.hash_ngrams(["a", "b"], ngrams))
+    assert (
+        len(
+            dedupe.hash_ngrams(["a", "b"], ngrams._replace(skip_short_paragraphs=False))
+        )
+        == 1
+    )
+
+
+def test_matches_dolma_dedupe(tmp_path):
+    rng = random.Random(0)
+    # No word repeats within a paragraph, dolma counts repeated n-grams as duplicates.
+    base = [" ".join(rng.sample(WORDS, k=8)) for _ in range(10)]
+
+    def text():
+        paragraphs = [
+            rng.choice(base)
+            if rng.random() < 0.5
+            else " ".join(rng.sample(WORDS, k=rng.randint(1, 8)))
+            for _ in range(rng.randint(1, 4))
+        ]
+        # Empty paragraphs, and a separator at the end, move the offsets.
+        if rng.random() < 0.3:
+            paragraphs.insert(rng.randint(0, len(paragraphs)), "")
+        return "\n".join(paragraphs) + ("\n" if rng.random() < 0.3 else "")
+
+    shards = {
+        str(tmp_path / "a" / "documents" / f"{i}.jsonl.gz"): [text() for _ in range(20)]
+        for i in range(3)
+    }
+    shards[str(tmp_path / "b" / "documents" / "0.jsonl.gz")] = [
+        text() for _ in range(20)
+    ]
+    for i, (path, texts) in enumerate(shards.items()):
+        write_shard(path, texts, i)
+    config = make_config(tmp_path)
+    dolma_dedupe(config, tmp_path / "dolma")
+    expected = [read_spans(dedupe.attributes_path(p, "global_dedupe")) for p in shards]
+    assert any(s for shard in expected for s in shard)
+
+    for partitions in (1, 7):
+        run(config, tmp_path / f"work-{partitions}", partitions)
+        for path, spans in zip(shards, expected):
+            assert read_spans(dedupe.attributes_path(path, "global_dedupe")) == [
+                [[start, end, pytest.approx(score)] for start, end, score in s]
+                for s in spans
+            ]
+
+
+def test_long_separator(tmp_path):
+    separator = "████████"
+    paragraphs = ["alpha beta gamma delta", "zeta eta theta", "alpha beta gamma delta"]
+    text = separator.join(paragraphs + paragraphs)
+    write_shard(str(tmp_path / "a" / "documents" / "0.jsonl.gz"), [text], "a")
+    config = make_config(tmp_path, separator=separator)
+    run(config, tmp_path / "work")
+    spans = read_spans(
+        str(tmp_path / "a" / "attributes" / "global_dedupe" / "0.jsonl.gz")
+    )[0]
+    # The spans cover the whole paragraph and its separator.
+    assert [text[start:end] for start, end, _ in spans] == [
+        paragraphs[2] + separator,
+        paragraphs[0] + separator,
+        paragraphs[1] + separator,
+        paragraphs[2],
+    ]
+
+
+def test_clusters(tmp_path):
+    text = "the quick brown fox jumps over the lazy dog"
+    write_shard(
+        str(tmp_path / "a" / "documents" / "0.jsonl.gz"),
+        [text, "something else entirely here"],
+        "a",
+    )
+    write_shard(
+        str(tmp_path / "b" / "documents" / "0.jsonl.gz"), [text + " again", text], "b"
+    )
+    config = make_config(tmp_path, separator="████████", ngram_length=4, threshold=0.9)
+    run(config, tmp_path / "work")
+
+    assert read_spans(
+        str(tmp_path / "a" / "attributes" / "global_dedupe" / "0.jsonl.gz")
+    ) == [[], []]
+    spans = read_spans(
+        str(tmp_path / "b" / "attributes" / "global_dedupe" / "0.jsonl.gz")
+    )
+    assert spans[1] == [[0, len(text), 1.0]]
+    # 6 of the 7 4-grams were seen before.
+    assert spans[0] == []
+    with open(tmp_path / "work" / "clusters.jsonl") as f:
+        clusters = [json.loads(l) for l in f]
+    assert len(clusters) == 1
+    assert clusters[0]["root"]["id"] == "a-0"
+    assert [(m["id"], m["score"], m["owner"]) for m in clusters[0]["members"]] == [
+        ("b-1", 1.0, "a-0")
+    ]
@@ -1,58 +1,87 @@
 #!/usr/bin/env python3
+"""Index where each document of a dolma dataset is, to look them up by id.
+
+    python id_to_shard.py --input data/stackexchange/v0 --output stackexchange.sqlite
+    python id_to_shard.py --output stackexchange.sqlite --lookup <id> <id>
+
+See `common_pile/shard_index.py` for the index format.
+"""
 
 import argparse
+import functools
 import glob
 import json
 import multiprocessing as mp
 import os
-import re
-from tempfile import TemporaryDirectory
-
-import smart_open
 
-from common_pile import utils, write
+import tqdm
 
+from common_pile import shard_index, utils
+from common_pile.logs import configure_logging, get_logger
 
-class IdToShardParallel(write.ShardParallelProcessor):
-    @classmethod
-    def process_example(cls, example, **kwargs):
-        return {"id": example["id"]}
+configure_logging()
 
 
 def main():
-    mp.set_start_method("spawn")
-    parser = argparse.ArgumentParser(description="")
-    parser.add_argument("--input", help="", required=True)
+    parser = argparse.ArgumentParser(
+        description="Index the byte offset of each document of dolma shards by id."
+    )
+    parser.add_argument("--input", help="The dolma data to index.")
+    parser.add_argument(
+        "--output", default="id_to_shards.sqlite", help="Where the index is saved."
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=mp.cpu_count(),
+        help="Number of processors for multicore.",
+    )
+    parser.add_argument(
+        "--reblock",
+        action="store_true",
+        help="Rewrite gzip shards as blocks first, so a lookup only decompresses "
+        "one block. This replaces the shards.",
+    )
+    parser.add_argument(
+        "--block_size",
+        type=int,
+        default=shard_index.BLOCK_SIZE,
+        help="The decompressed size of the blocks when using --reblock.",
+    )
     parser.add_argument(
-        "--output",
-        help="",
-        default="id_to_shards.json",
+        "--lookup", nargs="+", help="Print the documents with these ids."
     )
-    parser.add_argument("--processes", type=int, default=mp.cpu_count(), help="")
     args = parser.parse_args()
+    logger = get_logger()
 
-    args.input = utils.dolma_input(args.input)
-
-    with TemporaryDirectory() as tempdir:
-        processor = IdToShardParallel(
-            source_prefix=args.input,
-            destination_prefix=tempdir,
-            metadata_prefix=tempdir,
-            num_processes=args.processes,
-        )
-        processor()
-
-        id_to_shard = {}
-        for shard_file in glob.iglob(
-            os.path.join(tempdir, os.path.basename(args.input))
-        ):
-            if shard := re.search("^(\d{5})_", os.path.basename(shard_file)):
-                shard = shard.group(1)
-                with smart_open.smart_open(shard_file) as f:
-                    ids = [json.loads(l)["id"] for l in f if l]
-                    id_to_shard |= dict.fromkeys(ids, shard)
-        with smart_open.smart_open(args.output, "w") as wf:
-            json.dump(id_to_shard, wf)
+    with shard_index.ShardIndex(args.output) as index:
+        if args.input:
+            shards = sorted(
+                p for p in glob.glob(utils.dolma_input(args.input)) if os.path.isfile(p)
+            )
+            if args.reblock:
+                gzipped = [p for p in shards if shard_index.is_gzip(p)]
+                with mp.Pool(args.processes) as pool:
+                    for _ in tqdm.tqdm(
+                        pool.imap_unordered(
+                            functools.partial(
+                                shard_index.reblock, block_size=args.block_size
+                            ),
+                            gzipped,
+                        ),
+                        total=len(gzipped),
+                        desc="Reblocking",
+                    ):
+                        pass
+            logger.info("Indexing %d shards from %s", len(shards), args.input)
+            added = index.build(shards, args.processes)
+            logger.info("Added %d documents, %d in the index", added, len(index))
+        for doc_id in args.lookup or []:
+            doc = index.get(doc_id)
+            if doc is None:
+                logger.warning("%s isn't in the index.", doc_id)
+            else:
+                print(json.dumps(doc))
 
 
 if __name__ == "__main__":
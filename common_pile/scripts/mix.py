@@ -0,0 +1,325 @@
+"""Mix the streams of many mixer configs in parallel, under one process budget.
+
+Each mixer config is a `dolma mix` run with `"processes": 1`, so the sources get
+mixed one after another, one input file at a time. This reads the streams of all
+the configs, splits each stream into output shards the way `dolma mix` does
+(consecutive input files until `max_size_in_bytes`), and mixes the shards of all
+the streams in one pool, the largest first. Every shard is written to the same
+`{name}-{shard:04d}.json.gz` file `dolma mix` would write, by way of a temporary
+directory, so shards that already exist are complete and get skipped when a run is
+restarted. The throughput of each stream is logged when its last shard is done.
+"""
+
+import argparse
+import collections
+import copy
+import glob
+import json
+import multiprocessing as mp
+import os
+import shutil
+import tempfile
+import time
+from typing import Dict, List, NamedTuple, Optional, Sequence
+
+import dolma
+import tqdm
+
+from common_pile.logs import configure_logging, get_logger
+
+configure_logging()
+
+MIXER_CONFIGS = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+    "filtering",
+    "mixer_configs",
+    "*.json",
+)
+# The default output size of dolma mix.
+MAX_SIZE_IN_BYTES = 2 * 2**30
+
+
+class Shard(NamedTuple):
+    stream: str
+    index: int
+    inputs: List[str]
+    size: int
+    config: Dict
+
+
+class ShardResult(NamedTuple):
+    stream: str
+    index: int
+    size: int
+    output_size: int
+    start: float
+    end: float
+    error: Optional[str] = None
+
+
+def load_streams(paths: Sequence[str]) -> List[Dict]:
+    """The streams of every mixer config, checking that their names are unique."""
+    streams, seen = [], {}
+    for path in paths:
+        with open(path) as f:
+            config = json.load(f)
+        for stream in config["streams"]:
+            if stream["name"] in seen:
+                raise ValueError(
+                    f"Stream {stream['name']} is in both {seen[stream['name']]} and {path}."
+                )
+            seen[stream["name"]] = path
+            streams.append(stream)
+    return streams
+
+
+def input_files(stream: Dict) -> List[str]:
+    files = []
+    for pattern in stream["documents"]:
+        files.extend(
+            p
+            for p in sorted(glob.glob(pattern))
+            if os.path.isfile(p) and p not in files
+        )
+    return files
+
+
+def plan_shards(stream: Dict) -> List[Shard]:
+    """Group a stream's input files into output shards, like dolma mix does.
+
+    Files are added to a shard until the next one would take it over
+    `max_size_in_bytes`, so a file larger than that is a shard on its own.
+    """
+    max_size = stream["output"].get("max_size_in_bytes", MAX_SIZE_IN_BYTES)
+    shards, inputs, size = [], [], 0
+    for path in input_files(stream):
+        file_size = os.path.getsize(path)
+        if inputs and size + file_size > max_size:
+            shards.append(Shard(stream["name"], len(shards), inputs, size, stream))
+            inputs, size = [], 0
+        inputs.append(path)
+        size += file_size
+    if inputs:
+        shards.append(Shard(stream["name"], len(shards), inputs, size, stream))
+    return shards
+
+
+def output_path(shard: Shard) -> str:
+    return os.path.join(
+        shard.config["output"]["path"], f"{shard.stream}-{shard.index:04d}.json.gz"
+    )
+
+
+def pending(shards: Sequence[Shard]) -> List[Shard]:
+    """The shards whose output doesn't exist yet."""
+    return [s for s in shards if not os.path.exists(output_path(s))]
+
+
+def rust_config(shard: Shard, output_dir: str, work_dir: str) -> Dict:
+    """The config the dolma mixer takes, for just the files of one shard.
+
+    This fills in the defaults `dolma mix` adds to a stream before it calls the mixer.
+    """
+    stream = copy.deepcopy(shard.config)
+    stream["documents"] = list(shard.inputs)
+    stream.setdefault("attributes", [])
+    # A limit above the shard's size keeps it in one output file.
+    stream["output"] = {
+        **stream["output"],
+        "path": output_dir,
+        "max_size_in_bytes": max(
+            shard.size + 1,
+            stream["output"].get("max_size_in_bytes", MAX_SIZE_IN_BYTES),
+        ),
+    }
+    if "filter" in stream:
+        stream["filter"] = {
+            "include": [],
+            "exclude": [],
+            "syntax": "jsonpath",
+            **stream["filter"],
+        }
+    stream["span_replacement"] = [
+        {"syntax": "jsonpath", "replacement": "", **s}
+        for s in stream.get("span_replacement", [])
+    ]
+    if not stream["span_replacement"]:
+        del stream["span_replacement"]
+    stream["compression"] = {
+        "input": None,
+        "output": None,
+        **(stream.get("compression") or {}),
+    }
+    return {
+        "streams": [stream],
+        "work_dir": {
+            "input": os.path.join(work_dir, "input"),
+            "output": os.path.join(work_dir, "output"),
+        },
+        "processes": 1,
+    }
+
+
+def mix_shard(shard: Shard) -> ShardResult:
+    """Mix one shard into a temporary directory, then move it into place."""
+    logger = get_logger()
+    start = time.time()
+    output = output_path(shard)
+    tmp_dir = os.path.join(os.path.dirname(output), f".{os.path.basename(output)}.tmp")
+    try:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        with tempfile.TemporaryDirectory() as work_dir:
+            dolma.mixer(rust_config(shard, tmp_dir, work_dir))
+        mixed = os.path.join(tmp_dir, f"{shard.stream}-0000.json.gz")
+        os.replace(mixed, output)
+        shutil.rmtree(tmp_dir)
+    except Exception as e:
+        logger.error(
+            "Failed to mix shard %d of %s", shard.index, shard.stream, exc_info=True
+        )
+        return ShardResult(
+            shard.stream, shard.index, shard.size, 0, start, time.time(), repr(e)
+        )
+    return ShardResult(
+        shard.stream,
+        shard.index,
+        shard.size,
+        os.path.getsize(output),
+        start,
+        time.time(),
+    )
+
+
+class StreamStats:
+    """The progress of one stream, and its throughput once it is done."""
+
+    def __init__(self, name: str, shards: int):
+        self.name = name
+        self.shards = shards
+        self.done = 0
+        self.failed = 0
+        self.size = 0
+        self.output_size = 0
+        # Seconds spent mixing, summed over the processes.
+        self.busy = 0.0
+        self.start = float("inf")
+        self.end = 0.0
+
+    def update(self, result: ShardResult):
+        self.done += 1
+        self.failed += result.error is not None
+        self.size += result.size
+        self.output_size += result.output_size
+        self.busy += result.end - result.start
+        self.start = min(self.start, result.start)
+        self.end = max(self.end, result.end)
+
+    @property
+    def finished(self) -> bool:
+        return self.done == self.shards
+
+    def report(self) -> str:
+        wall = max(self.end - self.start, 1e-9)
+        busy = max(self.busy, 1e-9)
+        return (
+            f"{self.name}: {self.done - self.failed}/{self.shards} shards, "
+            f"{self.size / 1e9:.2f} GB in, {self.output_size / 1e9:.2f} GB out, "
+            f"{self.size / 1e6 / wall:.1f} MB/s over {wall:.0f}s "
+            f"({self.size / 1e6 / busy:.1f} MB/s per process)"
+        )
+
+
+def mix(shards: Sequence[Shard], processes: int) -> Dict[str, StreamStats]:
+    """Mix the shards across `processes` workers, the largest shards first."""
+    logger = get_logger()
+    counts = collections.Counter(s.stream for s in shards)
+    stats = {name: StreamStats(name, count) for name, count in counts.items()}
+    # Starting the big shards first keeps one from running on its own at the end.
+    shards = sorted(shards, key=lambda s: s.size, reverse=True)
+    # The rust mixer can deadlock in a process forked after it has run.
+    with mp.get_context("spawn").Pool(processes) as pool, tqdm.tqdm(
+        total=sum(s.size for s in shards), unit="B", unit_scale=True, desc="Mixing"
+    ) as progress:
+        for result in pool.imap_unordered(mix_shard, shards):
+            stream = stats[result.stream]
+            stream.update(result)
+            progress.update(result.size)
+            if stream.finished:
+                logger.info(stream.report())
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Mix the streams of many mixer configs in one process pool."
+    )
+    parser.add_argument(
+        "--configs",
+        nargs="+",
+        default=sorted(glob.glob(MIXER_CONFIGS)),
+        help="The mixer configs to run, defaults to all of filtering/mixer_configs.",
+    )
+    parser.add_argument(
+        "--streams", nargs="+", help="Only mix the streams with these names."
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=mp.cpu_count(),
+        help="How many shards to mix at once, across all streams.",
+    )
+    parser.add_argument(
+        "--dryrun",
+        action="store_true",
+        help="Only log the shards that would be mixed.",
+    )
+    args = parser.parse_args()
+    logger = get_logger()
+
+    streams = load_streams(args.configs)
+    if args.streams:
+        streams = [s for s in streams if s["name"] in args.streams]
+    shards, done = [], 0
+    for stream in streams:
+        stream_shards = plan_shards(stream)
+        if not stream_shards:
+            logger.warning("No documents found for %s, skipping it.", stream["name"])
+            continue
+        todo = pending(stream_shards)
+        done += len(stream_shards) - len(todo)
+        logger.info(
+            "%s: %d of %d shards to mix, %.2f GB",
+            stream["name"],
+            len(todo),
+            len(stream_shards),
+            sum(s.size for s in todo) / 1e9,
+        )
+        for shard in todo:
+            os.makedirs(shard.config["output"]["path"], exist_ok=True)
+        shards.extend(todo)
+    logger.info(
+        "Mixing %d shards (%d already done) with %d processes",
+        len(shards),
+        done,
+        args.processes,
+    )
+    if args.dryrun or not shards:
+        return
+
+    start = time.time()
+    stats = mix(shards, args.processes)
+    size = sum(s.size for s in stats.values())
+    logger.info(
+        "Mixed %.2f GB in %.0fs, %.1f MB/s",
+        size / 1e9,
+        time.time() - start,
+        size / 1e6 / max(time.time() - start, 1e-9),
+    )
+    failed = sum(s.failed for s in stats.values())
+    if failed:
+        raise RuntimeError(f"{failed} shards failed to mix, re-run to retry them.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""Tests for the parallel mixer, against the output of the dolma mixer."""
+
+import gzip
+import json
+import os
+
+import dolma
+import pytest
+
+from common_pile.scripts import mix
+
+
+def write_source(root, name, shards=3, docs=20):
+    for kind in ("documents", "attributes/length"):
+        os.makedirs(root / name / kind, exist_ok=True)
+    for shard in range(shards):
+        with gzip.open(
+            root / name / "documents" / f"{shard}.jsonl.gz", "wt"
+        ) as wf, gzip.open(
+            root / name / "attributes" / "length" / f"{shard}.jsonl.gz", "wt"
+        ) as af:
+            for i in range(docs):
+                doc_id = f"{name}-{shard}-{i}"
+                text = f"{doc_id} " * (i % 7)
+                wf.write(json.dumps({"id": doc_id, "text": text, "source": name}))
+                wf.write("\n")
+                attributes = {"length": [[0, len(text), len(text)]]}
+                af.write(json.dumps({"id": doc_id, "attributes": attributes}) + "\n")
+
+
+def stream(root, name, output, max_size):
+    return {
+        "name": name,
+        "documents": [str(root / name / "documents" / "*.gz")],
+        "attributes": ["length"],
+        "output": {"path": str(root / output / name), "max_size_in_bytes": max_size},
+        "filter": {"exclude": ["$.attributes[?(@.length[0][2] >= 60)]"]},
+    }
+
+
+def read_shards(path):
+    rows = {}
+    for name in sorted(os.listdir(path)):
+        with gzip.open(os.path.join(path, name), "rt") as f:
+            rows[name] = [json.loads(l) for l in f]
+    return rows
+
+
+@pytest.fixture
+def streams(tmp_path):
+    write_source(tmp_path, "a")
+    write_source(tmp_path, "b", shards=1)
+    size = os.path.getsize(tmp_path / "a" / "documents" / "0.jsonl.gz")
+    # Two files per output shard for a.
+    return [
+        stream(tmp_path, "a", "mixed", 2 * size),
+        stream(tmp_path, "b", "mixed", 2 * size),
+    ]
+
+
+def test_plan_shards(streams):
+    assert [len(s.inputs) for s in mix.plan_shards(streams[0])] == [2, 1]
+    assert [len(s.inputs) for s in mix.plan_shards(streams[1])] == [1]
+
+
+def test_matches_dolma_mix(streams, tmp_path):
+    shards = [s for stream in streams for s in mix.plan_shards(stream)]
+    for shard in shards:
+        os.makedirs(shard.config["output"]["path"], exist_ok=True)
+    stats = mix.mix(shards, processes=2)
+    assert {name: (s.done, s.failed) for name, s in stats.items()} == {
+        "a": (2, 0),
+        "b": (1, 0),
+    }
+
+    for s in streams:
+        expected = {**s, "output": {**s["output"], "path": str(tmp_path / "dolma")}}
+        # Fill in the defaults the dolma mix cli adds.
+        config = mix.rust_config(
+            mix.Shard(s["name"], 0, s["documents"], 0, expected),
+            str(tmp_path / "dolma" / s["name"]),
+            str(tmp_path / "work"),
+        )
+        config["streams"][0]["output"]["max_size_in_bytes"] = s["output"][
+            "max_size_in_bytes"
+        ]
+        dolma.mixer(config)
+        assert read_shards(s["output"]["path"]) == read_shards(
+            tmp_path / "dolma" / s["name"]
+        )
+
+
+def test_resume(streams):
+    shards = mix.plan_shards(streams[0])
+    os.makedirs(shards[0].config["output"]["path"], exist_ok=True)
+    mix.mix(shards, processes=1)
+    first, second = [mix.output_path(s) for s in shards]
+    os.remove(second)
+    mtime = os.path.getmtime(first)
+    todo = mix.pending(shards)
+    assert todo == shards[1:]
+    mix.mix(todo, processes=1)
+    assert os.path.exists(second)
+    assert os.path.getmtime(first) == mtime
@@ -1,21 +1,225 @@
-"""Count the number of (whitespace-delineated) tokens in a dolma dataset."""
+"""Count the documents, characters, bytes, and tokens in a dolma dataset.
+
+Tokens are whitespace-delineated by default, they can also be counted with a
+`tokenizers` tokenizer. With `--output`, the counts and a histogram of document
+lengths are written as JSON for the whole dataset and for each source, license,
+and shard.
+"""
 
 import argparse
+import collections
+import functools
 import json
+import math
 import multiprocessing as mp
 import os
-import re
 from queue import Queue
-from tempfile import TemporaryDirectory
+from typing import Any, Dict, List, Optional
 
+import msgspec
+import numpy as np
 import smart_open
 from dolma.core.parallel import BaseParallelProcessor
+from tokenizers import Tokenizer
 
 from common_pile import utils
 from common_pile.logs import configure_logging, get_logger
 
 configure_logging()
 
+# Document lengths are binned on a log scale, with this many bins per doubling.
+BINS_PER_OCTAVE = 4
+PERCENTILES = (1, 10, 25, 50, 75, 90, 99)
+MEASURES = ("characters", "bytes", "tokens", "tokenizer_tokens")
+# Below this many characters, splitting the text is faster than counting with numpy.
+SPLIT_LIMIT = 8192
+# Every code point str.split() splits on is below this.
+SPACE_LIMIT = 0x3001
+IS_SPACE = np.array([chr(c).isspace() for c in range(SPACE_LIMIT + 1)])
+
+
+class Metadata(msgspec.Struct):
+    license: Any = None
+
+
+class Document(msgspec.Struct):
+    """The fields the stats need, the rest of a document is skipped when decoding."""
+
+    text: Optional[str] = None
+    source: Optional[str] = None
+    metadata: Optional[Metadata] = None
+
+
+def count_text(text: str) -> Dict[str, int]:
+    """Count characters, utf-8 bytes, and whitespace tokens.
+
+    Matches `len(text)`, `len(text.encode("utf-8", "ignore"))`, and
+    `len(text.split())`, but long documents are counted with numpy so a list of
+    all their tokens, and a copy of their bytes, is never built.
+    """
+    if len(text) < SPLIT_LIMIT:
+        utf8_bytes = (
+            len(text) if text.isascii() else len(text.encode("utf-8", "ignore"))
+        )
+        return {
+            "characters": len(text),
+            "bytes": utf8_bytes,
+            "tokens": len(text.split()),
+        }
+    # Lone surrogates are kept as their own code points, and don't have utf-8 bytes.
+    code_points = np.frombuffer(
+        text.encode("utf-32-le", "surrogatepass"), dtype=np.uint32
+    )
+    space = IS_SPACE[np.minimum(code_points, SPACE_LIMIT)]
+    # A token starts at every non-space that follows a space.
+    tokens = np.count_nonzero(space[:-1] & ~space[1:]) + (not space[0])
+    utf8_bytes = (
+        len(code_points)
+        + np.count_nonzero(code_points >= 0x80)
+        + np.count_nonzero(code_points >= 0x800)
+        + np.count_nonzero(code_points >= 0x10000)
+        - 3 * np.count_nonzero((code_points >= 0xD800) & (code_points < 0xE000))
+    )
+    return {"characters": len(text), "bytes": int(utf8_bytes), "tokens": int(tokens)}
+
+
+def length_bin(n: int) -> int:
+    return 0 if n <= 0 else int(math.log2(n) * BINS_PER_OCTAVE) + 1
+
+
+def bin_start(b: int) -> int:
+    """The smallest length in a bin."""
+    return 0 if b == 0 else math.ceil(2 ** ((b - 1) / BINS_PER_OCTAVE))
+
+
+class Stats:
+    """Totals and document length histograms that can be merged across shards."""
+
+    def __init__(self):
+        self.documents = 0
+        self.totals = collections.Counter()
+        self.histograms = collections.defaultdict(collections.Counter)
+        self.min = {}
+        self.max = {}
+
+    def add(self, counts: Dict[str, int]):
+        self.documents += 1
+        for measure, n in counts.items():
+            self.totals[measure] += n
+            self.histograms[measure][length_bin(n)] += 1
+            self.min[measure] = min(self.min.get(measure, n), n)
+            self.max[measure] = max(self.max.get(measure, n), n)
+
+    def merge(self, other: "Stats"):
+        self.documents += other.documents
+        self.totals.update(other.totals)
+        for measure, histogram in other.histograms.items():
+            self.histograms[measure].update(histogram)
+        for measure, n in other.min.items():
+            self.min[measure] = min(self.min.get(measure, n), n)
+        for measure, n in other.max.items():
+            self.max[measure] = max(self.max.get(measure, n), n)
+
+    def percentile(self, measure: str, q: float) -> int:
+        """The start of the histogram bin the q-th percentile document falls in."""
+        histogram = self.histograms[measure]
+        rank = q / 100 * self.documents
+        seen = 0
+        for b in sorted(histogram):
+            seen += histogram[b]
+            if seen >= rank:
+                return max(bin_start(b), self.min[measure])
+        return self.max[measure]
+
+    def to_json(self) -> Dict:
+        return {
+            "documents": self.documents,
+            **{m: self.totals[m] for m in MEASURES if m in self.totals},
+            "lengths": {
+                measure: {
+                    "min": self.min[measure],
+                    "max": self.max[measure],
+                    "percentiles": {
+                        f"p{q}": self.percentile(measure, q) for q in PERCENTILES
+                    },
+                    # Number of documents by the smallest length in each bin.
+                    "histogram": {
+                        bin_start(b): n for b, n in sorted(histogram.items())
+                    },
+                }
+                for measure, histogram in self.histograms.items()
+            },
+        }
+
+    def dump(self) -> Dict:
+        return {
+            "documents": self.documents,
+            "totals": dict(self.totals),
+            "histograms": {m: dict(h) for m, h in self.histograms.items()},
+            "min": self.min,
+            "max": self.max,
+        }
+
+    @classmethod
+    def load(cls, data: Dict) -> "Stats":
+        stats = cls()
+        stats.documents = data["documents"]
+        stats.totals.update(data["totals"])
+        for measure, histogram in data["histograms"].items():
+            stats.histograms[measure].update({int(b): n for b, n in histogram.items()})
+        stats.min.update(data["min"])
+        stats.max.update(data["max"])
+        return stats
+
+
+class ShardStats:
+    """The stats of one shard, overall and by source and license."""
+
+    def __init__(self):
+        self.total = Stats()
+        self.sources = collections.defaultdict(Stats)
+        self.licenses = collections.defaultdict(Stats)
+
+    def add(self, source: str, license: str, counts: Dict[str, int]):
+        self.total.add(counts)
+        self.sources[source].add(counts)
+        self.licenses[license].add(counts)
+
+    def dump(self) -> Dict:
+        return {
+            "total": self.total.dump(),
+            "sources": {k: v.dump() for k, v in self.sources.items()},
+            "licenses": {k: v.dump() for k, v in self.licenses.items()},
+        }
+
+
+def merge_shards(shards: Dict[str, Dict]) -> Dict:
+    """Combine the dumped stats of each shard into the report."""
+    total = Stats()
+    sources = collections.defaultdict(Stats)
+    licenses = collections.defaultdict(Stats)
+    for shard in shards.values():
+        total.merge(Stats.load(shard["total"]))
+        for name, data in shard["sources"].items():
+            sources[name].merge(Stats.load(data))
+        for name, data in shard["licenses"].items():
+            licenses[name].merge(Stats.load(data))
+    return {
+        "total": total.to_json(),
+        "sources": {k: sources[k].to_json() for k in sorted(sources)},
+        "licenses": {k: licenses[k].to_json() for k in sorted(licenses)},
+        "shards": {
+            path: Stats.load(shards[path]["total"]).to_json() for path in sorted(shards)
+        },
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def load_tokenizer(name: str) -> Tokenizer:
+    if os.path.exists(name):
+        return Tokenizer.from_file(name)
+    return Tokenizer.from_pretrained(name)
+
 
 class SizeStatsParallel(BaseParallelProcessor):
     @classmethod
@@ -32,6 +236,7 @@ class SizeStatsParallel(BaseParallelProcessor):
         tokens: int = 0,
         bytes_utf8: int = 0,
         characters: int = 0,
+        tokenizer_tokens: int = 0,
     ):
         return super().increment_progressbar(
             queue,
@@ -40,6 +245,7 @@ class SizeStatsParallel(BaseParallelProcessor):
             tokens=tokens,
             bytes=bytes_utf8,
             characters=characters,
+            tokenizer_tokens=tokenizer_tokens,
         )
 
     @classmethod
@@ -50,70 +256,108 @@ class SizeStatsParallel(BaseParallelProcessor):
         queue: Queue,
         **kwargs,
     ):
-        del destination_path
         logger = cls.get_logger()
         logger.debug("Counting Tokens from Dolma files at %s", source_path)
+        tokenizer = kwargs.get("tokenizer")
+        if tokenizer is not None:
+            tokenizer = load_tokenizer(tokenizer)
+            # Skips computing the offsets when the tokenizers version has it.
+            encode_batch = getattr(
+                tokenizer, "encode_batch_fast", tokenizer.encode_batch
+            )
+        batch_size = kwargs.get("batch_size", 512)
+        write_stats = kwargs.get("write_stats", False)
+        decoder = msgspec.json.Decoder(Optional[Document])
+        stats = ShardStats()
+        progress = collections.Counter()
+        batch: List = []
+        update_interval = kwargs.pop("update_interval", 1)
+
+        def flush():
+            nonlocal update_interval
+            if tokenizer is not None and batch:
+                encodings = encode_batch(
+                    [text for text, *_ in batch], add_special_tokens=False
+                )
+                for (_, _, _, counts), encoding in zip(batch, encodings):
+                    counts["tokenizer_tokens"] = len(encoding.ids)
+            for _, source, license, counts in batch:
+                stats.add(source, license, counts)
+                progress.update(counts)
+            progress["documents"] += len(batch)
+            batch.clear()
+            if progress["documents"] >= update_interval:
+                cls.increment_progressbar(
+                    queue,
+                    documents=progress["documents"],
+                    tokens=progress["tokens"],
+                    bytes_utf8=progress["bytes"],
+                    characters=progress["characters"],
+                    tokenizer_tokens=progress["tokenizer_tokens"],
+                )
+                if queue.qsize() >= mp.cpu_count():
+                    update_interval *= 2
+                progress.clear()
+
         with logger(file=source_path):
             with smart_open.open(source_path) as f:
-                document_count = 0
-                token_count = 0
-                byte_count = 0
-                char_count = 0
-                update_interval = kwargs.pop("update_interval", 1)
-
                 for i, line in enumerate(f):
                     with logger(line=i):
                         try:
-                            try:
-                                data = json.loads(line)
-                            except json.JSONDecodeError:
-                                logger.error(
-                                    "Failed to parse JSON from `%s...`",
-                                    line[:80],
-                                    exc_info=True,
-                                )
-                                continue
-                            # TODO: Dolma file generation should not be adding null lines
-                            if data is None:
-                                continue
-                            # TODO: Make this configurable
-                            if data["text"] is None:
-                                document_count += 1
-                                continue
-                            tokens = data["text"].split()
-                            document_count += 1
-                            token_count += len(tokens)
-                            char_count += len(data["text"])
-                            # There are some sources that have invalid unicode that result
-                            # in rendering errors in webpages. Thus we ignore them here.
-                            # Example: https://math.stackexchange.com/a/8849
-                            byte_count += len(data["text"].encode("utf-8", "ignore"))
-
-                            if document_count % update_interval == 0:
-                                cls.increment_progressbar(
-                                    queue,
-                                    documents=document_count,
-                                    tokens=token_count,
-                                    bytes_utf8=byte_count,
-                                    characters=char_count,
-                                )
-                                if queue.qsize() >= mp.cpu_count():
-                                    update_interval *= 2
-                                document_count = 0
-                                token_count = 0
-                                char_count = 0
-                                byte_count = 0
-                        except Exception as e:
-                            logger.error("Failed to process example", exc_info=True)
-                            raise
-                cls.increment_progressbar(
-                    queue,
-                    shards=1,
-                    documents=document_count,
-                    tokens=token_count,
-                    bytes_utf8=byte_count,
-                    characters=char_count,
-                )
+                            data = decoder.decode(line)
+                        except msgspec.DecodeError:
+                            logger.error(
+                                "Failed to parse JSON from `%s...`",
+                                line[:80],
+                                exc_info=True,
+                            )
+                            continue
+                        # TODO: Dolma file generation should not be adding null lines
+                        if data is None:
+                            continue
+                        text = data.text or ""
+                        license = (
+                            data.metadata.license if data.metadata is not None else None
+                        )
+                        if license is not None and not isinstance(license, str):
+                            license = json.dumps(license)
+                        # There are some sources that have invalid unicode that result
+                        # in rendering errors in webpages. Thus we ignore them in the
+                        # byte count. Example: https://math.stackexchange.com/a/8849
+                        batch.append(
+                            (
+                                text,
+                                data.source or "unknown",
+                                license or "unknown",
+                                count_text(text),
+                            )
+                        )
+                        if len(batch) >= batch_size:
+                            flush()
+            flush()
+            cls.increment_progressbar(
+                queue,
+                shards=1,
+                documents=progress["documents"],
+                tokens=progress["tokens"],
+                bytes_utf8=progress["bytes"],
+                characters=progress["characters"],
+                tokenizer_tokens=progress["tokenizer_tokens"],
+            )
+            if write_stats:
+                with smart_open.open(f"{destination_path}.stats.json", "w") as wf:
+                    json.dump({"path": source_path, **stats.dump()}, wf)
+
+
+def read_shard_stats(stats_dir: str) -> Dict[str, Dict]:
+    shards = {}
+    for root, _, files in os.walk(stats_dir):
+        for name in files:
+            if name.endswith(".stats.json"):
+                with open(os.path.join(root, name)) as f:
+                    data = json.load(f)
+                shards[data.pop("path")] = data
+    return shards
 
 
 def main():
@@ -133,19 +377,46 @@ def main():
     parser.add_argument(
         "--meta", help="Location to store dolma metadata while processing."
     )
+    parser.add_argument(
+        "--tokenizer",
+        help="Also count tokens with this tokenizer, a tokenizer.json file or a Hugging Face Hub name.",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=512,
+        help="How many documents to tokenize at once.",
+    )
+    parser.add_argument(
+        "--output",
+        help="Write the stats by source, license, and shard to this JSON file.",
+    )
     args = parser.parse_args()
 
     source = utils.dolma_input(args.input)
+    if args.tokenizer:
+        # Each process tokenizes on its own.
+        os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
     with utils.maybe_temp_dir(path=args.meta) as meta_dir:
+        stats_dir = os.path.join(meta_dir, "stats")
         processor = SizeStatsParallel(
             source_prefix=source,
-            # Unused
-            destination_prefix=meta_dir,
+            # The stats of each shard are written here when there is an --output.
+            destination_prefix=stats_dir,
             metadata_prefix=meta_dir,
             num_processes=args.processes,
         )
-        processor()
+        processor(
+            tokenizer=args.tokenizer,
+            batch_size=args.batch_size,
+            write_stats=args.output is not None,
+        )
+        if args.output:
+            report = merge_shards(read_shard_stats(stats_dir))
+            with smart_open.open(args.output, "w") as wf:
+                json.dump(report, wf, indent=2)
+            get_logger().info("Wrote the stats to %s", args.output)
 
 
 if __name__ == "__main__":
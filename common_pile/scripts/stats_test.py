@@ -0,0 +1,93 @@
+"""Tests for the dolma size stats."""
+
+import gzip
+import json
+import os
+
+import pytest
+from tokenizers import Tokenizer
+from tokenizers.models import WordLevel
+from tokenizers.pre_tokenizers import Whitespace
+
+from common_pile.scripts import stats
+
+TEXTS = [
+    "",
+    " ",
+    "a",
+    "Hello, world!\n\tHow  are you?",
+    "café 中文　 x y z \U0001f600",
+    "lone \ud800 surrogate",
+]
+
+
+@pytest.mark.parametrize("text", TEXTS + [t * 5000 for t in TEXTS[1:]])
+def test_count_text(text):
+    assert stats.count_text(text) == {
+        "characters": len(text),
+        "bytes": len(text.encode("utf-8", "ignore")),
+        "tokens": len(text.split()),
+    }
+
+
+def test_percentiles():
+    shard = stats.Stats()
+    for n in range(1, 101):
+        shard.add({"tokens": n})
+    merged = stats.Stats.load(json.loads(json.dumps(shard.dump())))
+    merged.merge(shard)
+    report = merged.to_json()
+    assert report["documents"] == 200
+    assert report["tokens"] == 2 * sum(range(1, 101))
+    lengths = report["lengths"]["tokens"]
+    assert (lengths["min"], lengths["max"]) == (1, 100)
+    assert sum(lengths["histogram"].values()) == 200
+    # Bins are a fourth of a doubling wide.
+    assert 50 / 2**0.25 <= lengths["percentiles"]["p50"] <= 50
+    assert 90 / 2**0.25 <= lengths["percentiles"]["p90"] <= 90
+
+
+def test_stats_by_source_and_license(tmp_path):
+    tokenizer = Tokenizer(WordLevel({"[UNK]": 0, "a": 1}, unk_token="[UNK]"))
+    tokenizer.pre_tokenizer = Whitespace()
+    tokenizer.save(str(tmp_path / "tokenizer.json"))
+    os.makedirs(tmp_path / "documents")
+    docs = [
+        {"id": "0", "text": "a b c", "source": "x", "metadata": {"license": "MIT"}},
+        {"id": "1", "text": "a, b", "source": "x", "metadata": {"license": "CC0"}},
+        {"id": "2", "text": None, "source": "y"},
+    ]
+    with gzip.open(tmp_path / "documents" / "0.jsonl.gz", "wt") as wf:
+        for doc in docs:
+            wf.write(json.dumps(doc) + "\n")
+        wf.write("null\n")
+
+    processor = stats.SizeStatsParallel(
+        source_prefix=str(tmp_path / "documents" / "*.jsonl.gz"),
+        destination_prefix=str(tmp_path / "stats"),
+        metadata_prefix=str(tmp_path / "meta"),
+        debug=True,
+    )
+    processor(
+        tokenizer=str(tmp_path / "tokenizer.json"), batch_size=2, write_stats=True
+    )
+    report = stats.merge_shards(stats.read_shard_stats(str(tmp_path / "stats")))
+
+    assert {k: v for k, v in report["total"].items() if k != "lengths"} == {
+        "documents": 3,
+        "characters": 9,
+        "bytes": 9,
+        "tokens": 5,
+        # "a b c" and "a" "," "b".
+        "tokenizer_tokens": 6,
+    }
+    assert {k: v["documents"] for k, v in report["sources"].items()} == {
+        "x": 2,
+        "y": 1,
+    }
+    assert {k: v["tokens"] for k, v in report["licenses"].items()} == {
+        "CC0": 2,
+        "MIT": 3,
+        "unknown": 0,
+    }
+    assert list(report["shards"]) == [str(tmp_path / "documents" / "0.jsonl.gz")]
@@ -0,0 +1,300 @@
+"""Run all of a source's taggers in one pass over its dolma shards.
+
+`dolma tag` is run once per tagger, so every pass re-reads and re-decodes every
+shard and each custom tagger splits the text into paragraphs again. This reads
+the taggers a source needs from the attributes of its mixer config, decodes each
+document once, shares the line and paragraph split between the taggers that
+support it, and writes every tagger's attribute file in the same pass. The files
+are laid out and named like `dolma tag` would, so the mixer configs work as is.
+
+Taggers opt in to the shared split by defining `predict_lines(doc, lines)`, which
+gets `split_paragraphs(text, remove_empty=False)`, or
+`predict_paragraphs(doc, paragraphs)`, which gets `split_paragraphs(text)`.
+"""
+
+import argparse
+import functools
+import glob
+import json
+import multiprocessing as mp
+import os
+import re
+from contextlib import ExitStack
+from queue import Queue
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import msgspec
+import smart_open
+from dolma.core.data_types import (
+    Document,
+    DocumentWithMetadata,
+    InputSpec,
+    InputSpecWithMetadata,
+    OutputSpec,
+    TaggerOutputDictType,
+)
+from dolma.core.parallel import BaseParallelProcessor
+from dolma.core.registry import TaggerRegistry
+from dolma.core.taggers import BaseTagger, BaseTaggerWithMetadata
+from dolma.core.utils import import_modules, make_variable_name, split_paragraphs
+
+from common_pile import utils
+from common_pile.attributes import AttributeWriter, parquet_path
+from common_pile.logs import configure_logging, get_logger
+
+configure_logging()
+
+TAGGER_PLACEHOLDER = "__TAGGER__"
+
+CUSTOM_TAGGERS = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+    "filtering",
+    "custom_taggers",
+    "*_tagger.py",
+)
+
+
+def mixer_config(path: str) -> Tuple[List[str], List[str]]:
+    """The document globs and attributes used by the streams of a mixer config."""
+    with open(path) as f:
+        config = json.load(f)
+    documents, attributes = [], []
+    for stream in config["streams"]:
+        documents.extend(d for d in stream["documents"] if d not in documents)
+        attributes.extend(
+            a for a in stream.get("attributes", []) if a not in attributes
+        )
+    return documents, attributes
+
+
+def resolve_taggers(attributes: Sequence[str]) -> Dict[str, str]:
+    """Map attribute names to the registered taggers that make them.
+
+    `dolma tag` names the attribute directory after the tagger, with anything that
+    isn't a valid variable name replaced by `_`. Attributes that aren't made by a
+    tagger, like the output of `dolma dedupe`, are skipped.
+    """
+    logger = get_logger()
+    registered = {make_variable_name(name): name for name, _ in TaggerRegistry.items()}
+    taggers = {}
+    for attribute in attributes:
+        if attribute in registered:
+            taggers[attribute] = registered[attribute]
+        else:
+            logger.warning("No tagger makes the %s attribute, skipping it.", attribute)
+    return taggers
+
+
+def attributes_prefix(documents: str, name: str = TAGGER_PLACEHOLDER) -> str:
+    """.../documents/*.jsonl.gz -> .../attributes/{name}, where dolma tag writes."""
+    pre_glob = re.split(r"[*?\[]", documents, maxsplit=1)[0]
+    parts = pre_glob.rstrip("/").split("/")
+    if "documents" not in parts:
+        raise ValueError(f"{documents} doesn't have a documents directory.")
+    idx = len(parts) - 1 - parts[::-1].index("documents")
+    return "/".join(parts[:idx] + ["attributes", name])
+
+
+@functools.lru_cache(maxsize=None)
+def load_taggers(taggers: Tuple[Tuple[str, str], ...]) -> Dict[str, BaseTagger]:
+    """Build the taggers once per worker process instead of once per shard."""
+    return {attribute: TaggerRegistry.get(name)() for attribute, name in taggers}
+
+
+@functools.lru_cache(maxsize=None)
+def attribute_key(attribute: str, span_type: str) -> str:
+    """The full name of an attribute, {experiment}__{tagger}__{type} like dolma tag."""
+    return f"{attribute}__{attribute}__{make_variable_name(span_type)}"
+
+
+def tag_document(
+    taggers: Dict[str, BaseTagger], doc: Document
+) -> Dict[str, TaggerOutputDictType]:
+    """Run every tagger on a document, splitting it into lines at most once."""
+    lines = paragraphs = None
+    outputs = {}
+    for attribute, tagger in taggers.items():
+        if hasattr(tagger, "predict_lines"):
+            if lines is None:
+                lines = split_paragraphs(doc.text, remove_empty=False)
+            result = tagger.predict_lines(doc, lines)
+        elif hasattr(tagger, "predict_paragraphs"):
+            if paragraphs is None:
+                if lines is None:
+                    lines = split_paragraphs(doc.text, remove_empty=False)
+                # The same filter split_paragraphs applies by default.
+                paragraphs = [line for line in lines if line.text.strip()]
+            result = tagger.predict_paragraphs(doc, paragraphs)
+        else:
+            result = tagger.predict(doc)
+        outputs[attribute] = tagger.group_output(result)
+    return outputs
+
+
+class FusedTaggerParallel(BaseParallelProcessor):
+    @classmethod
+    def get_logger(cls):
+        return get_logger()
+
+    @classmethod
+    def increment_progressbar(
+        cls,
+        queue: Queue,
+        /,
+        shards: int = 0,
+        documents: int = 0,
+    ):
+        return super().increment_progressbar(queue, shards=shards, documents=documents)
+
+    @classmethod
+    def process_single(
+        cls,
+        source_path: str,
+        destination_path: str,
+        queue: Queue,
+        **kwargs,
+    ):
+        logger = cls.get_logger()
+        import_modules(kwargs.get("tagger_modules"))
+        taggers = load_taggers(tuple(kwargs["taggers"]))
+        update_interval = kwargs.get("update_interval", 1)
+        parquet = kwargs.get("parquet", False)
+
+        with_metadata = any(
+            isinstance(t, BaseTaggerWithMetadata) for t in taggers.values()
+        )
+        if with_metadata:
+            decoder = msgspec.json.Decoder(InputSpecWithMetadata)
+            make_document = DocumentWithMetadata.from_spec
+        else:
+            decoder = msgspec.json.Decoder(InputSpec)
+            make_document = Document.from_spec
+        encoder = msgspec.json.Encoder()
+
+        with logger(file=source_path), ExitStack() as stack:
+            f = stack.enter_context(
+                smart_open.open(source_path, "rt", encoding="utf-8")
+            )
+            outputs = {}
+            for attribute in taggers:
+                path = destination_path.replace(TAGGER_PLACEHOLDER, attribute)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                if parquet:
+                    outputs[attribute] = stack.enter_context(
+                        AttributeWriter(parquet_path(path))
+                    )
+                else:
+                    outputs[attribute] = stack.enter_context(
+                        smart_open.open(path, "wt", encoding="utf-8")
+                    )
+            document_count = 0
+            for i, line in enumerate(f):
+                with logger(line=i):
+                    try:
+                        row = decoder.decode(line)
+                    except msgspec.DecodeError:
+                        logger.error(
+                            "Failed to parse JSON from `%s...`",
+                            line[:80],
+                            exc_info=True,
+                        )
+                        continue
+                    results = tag_document(taggers, make_document(row))
+                    for attribute, result in results.items():
+                        attributes = {
+                            attribute_key(attribute, span_type): spans
+                            for span_type, spans in result.items()
+                        }
+                        if parquet:
+                            outputs[attribute].write(row.id, attributes)
+                            continue
+                        output = OutputSpec(
+                            source=row.source, id=row.id, attributes=attributes
+                        )
+                        outputs[attribute].write(
+                            encoder.encode(output).decode("utf-8") + "\n"
+                        )
+                    document_count += 1
+                    if document_count % update_interval == 0:
+                        cls.increment_progressbar(queue, documents=document_count)
+                        if queue.qsize() >= mp.cpu_count():
+                            update_interval *= 2
+                        document_count = 0
+        cls.increment_progressbar(queue, shards=1, documents=document_count)
+
+
+def main():
+    mp.set_start_method("spawn")
+    parser = argparse.ArgumentParser(
+        description="Run all the taggers a mixer config needs in one pass."
+    )
+    parser.add_argument(
+        "--config",
+        required=True,
+        help="The source's mixer config, its attributes are the taggers to run.",
+    )
+    parser.add_argument(
+        "--input",
+        help="The dolma input directory (or glob), defaults to the documents in the mixer config.",
+    )
+    parser.add_argument(
+        "--taggers", nargs="+", help="Only run these attributes from the mixer config."
+    )
+    parser.add_argument(
+        "--tagger_modules",
+        nargs="+",
+        default=sorted(glob.glob(CUSTOM_TAGGERS)),
+        help="Modules or files that register custom taggers.",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=mp.cpu_count(),
+        help="Number of processors for multicore.",
+    )
+    parser.add_argument("--meta", help="Location of Dolma processing metadata.")
+    parser.add_argument(
+        "--ignore_existing",
+        action="store_true",
+        help="Re-tag shards that were already tagged.",
+    )
+    parser.add_argument(
+        "--parquet",
+        action="store_true",
+        help="Write the attributes as Parquet instead of JSONL, see common_pile/attributes.py.",
+    )
+    args = parser.parse_args()
+    logger = get_logger()
+
+    documents, attributes = mixer_config(args.config)
+    if args.input:
+        documents = [utils.dolma_input(args.input)]
+    if args.taggers:
+        attributes = [a for a in attributes if a in args.taggers]
+    import_modules(args.tagger_modules)
+    taggers = resolve_taggers(attributes)
+    if not taggers:
+        raise ValueError(
+            f"None of the attributes in {args.config} are made by a tagger."
+        )
+    logger.info("Running %s on %s", ", ".join(taggers), ", ".join(documents))
+
+    with utils.maybe_temp_dir(args.meta) as meta_dir:
+        processor = FusedTaggerParallel(
+            source_prefix=documents,
+            destination_prefix=[attributes_prefix(d) for d in documents],
+            metadata_prefix=[
+                os.path.join(meta_dir, str(i)) for i in range(len(documents))
+            ],
+            num_processes=args.processes,
+            ignore_existing=args.ignore_existing,
+        )
+        processor(
+            taggers=list(taggers.items()),
+            tagger_modules=args.tagger_modules,
+            parquet=args.parquet,
+        )
+
+
+if __name__ == "__main__":
+    main()
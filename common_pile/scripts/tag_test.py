@@ -0,0 +1,130 @@
+"""Tests for the fused tagger runner, against the output of dolma tag."""
+
+import gzip
+import json
+import os
+
+import pytest
+from dolma.core.runtime import create_and_run_tagger
+from dolma.core.utils import import_modules
+
+from common_pile import attributes
+from common_pile.scripts import tag
+
+TAGGERS = {
+    "char_length_v1": "char_length_v1",
+    "usgpo_regex_tagger": "usgpo_regex_tagger",
+    "double_newline_tagger": "double_newline_tagger",
+    "usgpo_line_tagger": "usgpo_line_tagger",
+    "paragraph_chunk_tagger": "paragraph_chunk_tagger",
+}
+
+MODULES = [
+    os.path.join(os.path.dirname(tag.CUSTOM_TAGGERS), f"{m}.py")
+    for m in ("regex_tagger", "line_tagger", "paragraph_chunk_tagger")
+]
+
+TEXTS = [
+    "A title\n\n[[Page 3]]\nThis is a line that is long enough to be a paragraph.\n"
+    "This is a line that is long enough to be a paragraph.\nAnd another long enough one, ending here.\nshort\n",
+    "",
+    "\n\n\n[[Page iv]]",
+]
+
+
+def read_attributes(path):
+    with gzip.open(path, "rt") as f:
+        return [json.loads(l) for l in f]
+
+
+@pytest.fixture
+def documents(tmp_path):
+    os.makedirs(tmp_path / "documents")
+    for shard in range(2):
+        with gzip.open(tmp_path / "documents" / f"{shard}.jsonl.gz", "wt") as wf:
+            for i, text in enumerate(TEXTS):
+                doc = {"id": f"{shard}-{i}", "text": text, "source": "test"}
+                wf.write(json.dumps(doc) + "\n")
+    return str(tmp_path / "documents" / "*.jsonl.gz")
+
+
+def test_attributes_prefix():
+    assert tag.attributes_prefix("/data/x/v0/documents/*.jsonl.gz", "t") == (
+        "/data/x/v0/attributes/t"
+    )
+    assert tag.attributes_prefix("data/documents/**/*.gz", "t") == "data/attributes/t"
+    with pytest.raises(ValueError):
+        tag.attributes_prefix("/data/x/*.jsonl.gz")
+
+
+def test_resolve_taggers():
+    import_modules(MODULES)
+    assert tag.resolve_taggers(["usgpo_line_tagger", "global_dedupe"]) == {
+        "usgpo_line_tagger": "usgpo_line_tagger"
+    }
+    assert tag.resolve_taggers(["biodiversity_heritage_library_line_tagger"]) == {
+        "biodiversity_heritage_library_line_tagger": "biodiversity-heritage-library_line_tagger"
+    }
+
+
+def test_matches_dolma_tag(documents, tmp_path):
+    import_modules(MODULES)
+    root = os.path.dirname(os.path.dirname(documents))
+    create_and_run_tagger(
+        documents=[documents],
+        taggers=list(TAGGERS.values()),
+        metadata=str(tmp_path / "meta-dolma"),
+        debug=True,
+    )
+    expected = {
+        a: {
+            s: read_attributes(os.path.join(root, "attributes", a, s))
+            for s in ("0.jsonl.gz", "1.jsonl.gz")
+        }
+        for a in TAGGERS
+    }
+    # Move dolma's output out of the way.
+    os.rename(os.path.join(root, "attributes"), os.path.join(root, "dolma"))
+
+    processor = tag.FusedTaggerParallel(
+        source_prefix=documents,
+        destination_prefix=tag.attributes_prefix(documents),
+        metadata_prefix=str(tmp_path / "meta"),
+        debug=True,
+    )
+    processor(taggers=list(TAGGERS.items()), tagger_modules=MODULES)
+    for attribute, shards in expected.items():
+        for shard, rows in shards.items():
+            assert (
+                read_attributes(os.path.join(root, "attributes", attribute, shard))
+                == rows
+            )
+
+
+def test_parquet_matches_jsonl(documents, tmp_path):
+    root = os.path.dirname(os.path.dirname(documents))
+    for parquet in (False, True):
+        processor = tag.FusedTaggerParallel(
+            source_prefix=documents,
+            destination_prefix=tag.attributes_prefix(documents),
+            metadata_prefix=str(tmp_path / f"meta-{parquet}"),
+            debug=True,
+        )
+        processor(
+            taggers=list(TAGGERS.items()), tagger_modules=MODULES, parquet=parquet
+        )
+    for shard in ("0", "1"):
+        store = attributes.ShardAttributes(
+            os.path.join(root, "documents", f"{shard}.jsonl.gz"), list(TAGGERS)
+        )
+        for attribute in TAGGERS:
+            rows = read_attributes(
+                os.path.join(root, "attributes", attribute, f"{shard}.jsonl.gz")
+            )
+            assert store.ids() == [r["id"] for r in rows]
+            for key in {k for r in rows for k in r["attributes"]}:
+                spans = [
+                    None if s is None else [list(x.values()) for x in s]
+                    for s in store.column(key).to_pylist()
+                ]
+                assert spans == [r["attributes"].get(key) for r in rows]
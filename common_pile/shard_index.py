@@ -0,0 +1,275 @@
+"""An on-disk index from document id to where the document is in its dolma shard.
+
+Each document is indexed by its shard, the file offset of the compressed block
+it starts in, its offset in the decompressed data of that block, and its length.
+A lookup seeks to the block and only decompresses from there to the end of the
+document. The blocks of a gzip shard are its gzip members. Most shards are a
+single member, so `reblock` can rewrite one as a series of members of about
+`BLOCK_SIZE` decompressed bytes each. This is still a valid gzip file with the
+same contents, but then looking up a document decompresses at most one block.
+For uncompressed shards the block is where the line starts.
+
+The index is a SQLite database with one row per document, keyed by id.
+"""
+
+import gzip
+import multiprocessing as mp
+import os
+import sqlite3
+import zlib
+from typing import (
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+import msgspec
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+READ_SIZE = 1 << 20
+BLOCK_SIZE = 1 << 20
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS shards (
+    shard INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    size INTEGER NOT NULL,
+    compressed INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS documents (
+    id TEXT PRIMARY KEY,
+    shard INTEGER NOT NULL,
+    block INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+class Id(msgspec.Struct):
+    id: Union[str, int]
+
+
+class Location(NamedTuple):
+    path: str
+    compressed: bool
+    block: int
+    offset: int
+    length: int
+
+
+class ShardRows(NamedTuple):
+    path: str
+    size: int
+    compressed: bool
+    rows: List[Tuple[str, int, int, int]]
+
+
+def is_gzip(path: str) -> bool:
+    with open(path, "rb") as f:
+        magic = f.read(4)
+    if magic == ZSTD_MAGIC:
+        raise ValueError(
+            f"Only gzip and uncompressed shards can be indexed, not {path}"
+        )
+    return magic[:2] == GZIP_MAGIC
+
+
+def read_blocks(f, compressed: bool, start: int = 0) -> Iterator[Tuple[int, bytes]]:
+    """Yield the decompressed data of a file from `start` on, with its block offset."""
+    f.seek(start)
+    position = start
+    if not compressed:
+        while chunk := f.read(READ_SIZE):
+            yield position, chunk
+            position += len(chunk)
+        return
+    block = start
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    while chunk := f.read(READ_SIZE):
+        position += len(chunk)
+        while chunk:
+            if data := decompressor.decompress(chunk):
+                yield block, data
+            if not decompressor.eof:
+                break
+            # The rest of the chunk is the start of the next gzip member.
+            chunk = decompressor.unused_data
+            block = position - len(chunk)
+            decompressor = zlib.decompressobj(GZIP_WBITS)
+
+
+def index_shard(path: str) -> ShardRows:
+    """Find the (id, block, offset, length) of each document of a shard."""
+    compressed = is_gzip(path)
+    decoder = msgspec.json.Decoder(Id)
+    rows = []
+    line, start = bytearray(), None
+
+    def add():
+        if line.strip():
+            doc_id = decoder.decode(line).id
+            rows.append((str(doc_id), *start, len(line)))
+
+    current, position = None, 0
+    with open(path, "rb") as f:
+        for block, data in read_blocks(f, compressed):
+            if block != current:
+                current, position = block, 0
+            i = 0
+            while i < len(data):
+                if start is None:
+                    start = (block, position + i)
+                j = data.find(b"\n", i)
+                if j == -1:
+                    line += data[i:]
+                    break
+                line += data[i:j]
+                add()
+                line, start = bytearray(), None
+                i = j + 1
+            position += len(data)
+        add()
+    return ShardRows(path, os.path.getsize(path), compressed, rows)
+
+
+def read_document(location: Location) -> bytes:
+    """Read the JSON line of a document, decompressing only from its block on."""
+    with open(location.path, "rb") as f:
+        if not location.compressed:
+            f.seek(location.block + location.offset)
+            return f.read(location.length)
+        end = location.offset + location.length
+        data = bytearray()
+        for _, chunk in read_blocks(f, True, location.block):
+            data += chunk
+            if len(data) >= end:
+                break
+        return bytes(data[location.offset : end])
+
+
+def reblock(path: str, block_size: int = BLOCK_SIZE):
+    """Rewrite a shard as gzip members of about `block_size` decompressed bytes each.
+
+    Lines are never split across members. The file is replaced by way of a
+    temporary file.
+    """
+    tmp_path = f"{path}.tmp"
+    with gzip.open(path, "rb") as f, open(tmp_path, "wb") as wf:
+        block = bytearray()
+        for line in f:
+            block += line
+            if len(block) >= block_size:
+                wf.write(gzip.compress(block))
+                block.clear()
+        if block:
+            wf.write(gzip.compress(block))
+    os.replace(tmp_path, path)
+
+
+class ShardIndex:
+    """Look up documents by id in the shards of an index built with `build`."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+        self.shards = {}
+        self.load_shards()
+
+    def load_shards(self):
+        self.shards = {
+            shard: (path, bool(compressed))
+            for shard, path, compressed in self.db.execute(
+                "SELECT shard, path, compressed FROM shards"
+            )
+        }
+
+    def build(self, paths: Sequence[str], processes: int = 1) -> int:
+        """Index the documents of shards in parallel, returning how many were added.
+
+        Shards that are already indexed are skipped, unless their size changed.
+        When an id is in more than one shard, the first one indexed is kept.
+        """
+        todo = []
+        for path in map(os.path.abspath, paths):
+            row = self.db.execute(
+                "SELECT shard, size FROM shards WHERE path = ?", (path,)
+            ).fetchone()
+            if row is not None:
+                if row[1] == os.path.getsize(path):
+                    continue
+                with self.db:
+                    self.db.execute("DELETE FROM documents WHERE shard = ?", row[:1])
+                    self.db.execute("DELETE FROM shards WHERE shard = ?", row[:1])
+            todo.append(path)
+        added = 0
+        with mp.get_context("spawn").Pool(processes) as pool:
+            for result in pool.imap(index_shard, todo):
+                added += self.add(result)
+        self.load_shards()
+        return added
+
+    def add(self, result: ShardRows) -> int:
+        with self.db:
+            shard = self.db.execute(
+                "INSERT INTO shards (path, size, compressed) VALUES (?, ?, ?)",
+                (result.path, result.size, result.compressed),
+            ).lastrowid
+            before = self.db.total_changes
+            self.db.executemany(
+                "INSERT OR IGNORE INTO documents VALUES (?, ?, ?, ?, ?)",
+                ((doc_id, shard, *row) for doc_id, *row in result.rows),
+            )
+            return self.db.total_changes - before
+
+    def locate(self, doc_id: str) -> Optional[Location]:
+        row = self.db.execute(
+            "SELECT shard, block, offset, length FROM documents WHERE id = ?",
+            (doc_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        path, compressed = self.shards[row[0]]
+        return Location(path, compressed, *row[1:])
+
+    def get(self, doc_id: str) -> Optional[dict]:
+        """Read a document by its id, None if it isn't in the index."""
+        location = self.locate(doc_id)
+        if location is None:
+            return None
+        return msgspec.json.decode(read_document(location))
+
+    def shard(self, doc_id: str) -> Optional[str]:
+        """The path of the shard a document is in."""
+        location = self.locate(doc_id)
+        return None if location is None else location.path
+
+    def ids(self) -> Iterable[str]:
+        return (row[0] for row in self.db.execute("SELECT id FROM documents"))
+
+    def __contains__(self, doc_id: str) -> bool:
+        return (
+            self.db.execute(
+                "SELECT 1 FROM documents WHERE id = ?", (doc_id,)
+            ).fetchone()
+            is not None
+        )
+
+    def __len__(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
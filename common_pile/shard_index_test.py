@@ -0,0 +1,97 @@
+"""Tests for the id to shard offset index."""
+
+import gzip
+import json
+import os
+
+import pytest
+
+from common_pile import shard_index
+
+
+def documents(shard, count=50):
+    return [
+        {"id": f"{shard}-{i}", "text": f"document {i} " * (i * 37 % 200), "source": "s"}
+        for i in range(count)
+    ]
+
+
+def write_shard(path, docs):
+    lines = "".join(json.dumps(d) + "\n" for d in docs)
+    if path.endswith(".gz"):
+        with gzip.open(path, "wt") as wf:
+            wf.write(lines)
+    else:
+        with open(path, "w") as wf:
+            wf.write(lines)
+
+
+@pytest.fixture
+def shards(tmp_path):
+    paths = {
+        str(tmp_path / "00000_x.jsonl.gz"): documents(0),
+        str(tmp_path / "00001_x.jsonl"): documents(1),
+        str(tmp_path / "00002_x.jsonl.gz"): documents(2),
+    }
+    for path, docs in paths.items():
+        write_shard(path, docs)
+    shard_index.reblock(str(tmp_path / "00002_x.jsonl.gz"), block_size=1000)
+    return paths
+
+
+def test_reblock(shards, tmp_path):
+    path = str(tmp_path / "00002_x.jsonl.gz")
+    with gzip.open(path, "rt") as f:
+        assert [json.loads(l) for l in f] == shards[path]
+    rows = shard_index.index_shard(path).rows
+    assert len({block for _, block, _, _ in rows}) > 1
+    # Documents don't span blocks.
+    assert rows[0][1:3] == (0, 0)
+    for (_, block, offset, length), (_, next_block, next_offset, _) in zip(
+        rows, rows[1:]
+    ):
+        expected = 0 if next_block != block else offset + length + 1
+        assert next_offset == expected
+
+
+@pytest.mark.parametrize(
+    "name", ["00000_x.jsonl.gz", "00001_x.jsonl", "00002_x.jsonl.gz"]
+)
+def test_small_reads(shards, tmp_path, monkeypatch, name):
+    # Documents span many of the chunks read from the file.
+    monkeypatch.setattr(shard_index, "READ_SIZE", 64)
+    path = str(tmp_path / name)
+    result = shard_index.index_shard(path)
+    assert [row[0] for row in result.rows] == [d["id"] for d in shards[path]]
+    for row, doc in zip(result.rows, shards[path]):
+        location = shard_index.Location(path, result.compressed, *row[1:])
+        assert json.loads(shard_index.read_document(location)) == doc
+
+
+def test_lookup(shards, tmp_path):
+    with shard_index.ShardIndex(str(tmp_path / "index.sqlite")) as index:
+        assert index.build(list(shards), processes=2) == 150
+        assert len(index) == 150
+        for path, docs in shards.items():
+            for doc in docs:
+                assert index.get(doc["id"]) == doc
+                assert index.shard(doc["id"]) == path
+        assert "0-3" in index
+        assert "3-0" not in index
+        assert index.get("3-0") is None
+        assert sorted(index.ids()) == sorted(
+            d["id"] for ds in shards.values() for d in ds
+        )
+
+
+def test_rebuild(shards, tmp_path):
+    path = str(tmp_path / "index.sqlite")
+    with shard_index.ShardIndex(path) as index:
+        index.build(list(shards))
+    changed = next(iter(shards))
+    write_shard(changed, documents(3, count=10))
+    with shard_index.ShardIndex(path) as index:
+        assert index.build(list(shards)) == 10
+        assert len(index) == 110
+        assert "0-0" not in index
+        assert index.get("3-9") == documents(3, count=10)[9]
@@ -1,40 +1,286 @@
 """Tools to help with xml parsing."""
 
-from typing import List
+import bz2
+import dataclasses
+import gzip
+import io
+import lzma
+import os
+import queue
+import shutil
+import subprocess
+import threading
+from typing import BinaryIO, List, Optional, Set, Tuple
 
 import lxml.etree as ET
 
 from common_pile import logs
 
+# The largest window zstd will use, the IA dumps are compressed with --long=31.
+ZSTD_MAX_WINDOW = 2**31
 
-def iterate_xml(path: str, tag: str):
+
+class Readahead(io.RawIOBase):
+    """Read a stream in a background thread so decompression overlaps parsing.
+
+    Up to `depth` chunks of `chunk_size` bytes are read ahead of the consumer.
+    Most decompressors release the GIL while they work, so the parser keeps
+    going while the next chunk is being decompressed.
+    """
+
+    def __init__(self, f, chunk_size: int = 1 << 20, depth: int = 8, on_close=None):
+        self._f = f
+        self._chunk_size = chunk_size
+        self._queue = queue.Queue(maxsize=depth)
+        self._buffer = memoryview(b"")
+        self._eof = False
+        self._stop = threading.Event()
+        self._on_close = on_close
+        self._thread = threading.Thread(target=self._fill, daemon=True)
+        self._thread.start()
+
+    def _put(self, item) -> bool:
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _fill(self):
+        try:
+            while chunk := self._f.read(self._chunk_size):
+                if not self._put(chunk):
+                    return
+        except Exception as e:
+            # Raise the error in the consumer's thread instead.
+            self._put(e)
+        self._put(b"")
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        if not self._buffer:
+            if self._eof:
+                return 0
+            chunk = self._queue.get()
+            if isinstance(chunk, Exception):
+                self._eof = True
+                raise chunk
+            if not chunk:
+                self._eof = True
+                return 0
+            self._buffer = memoryview(chunk)
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._stop.set()
+            self._thread.join()
+            self._f.close()
+            if self._on_close is not None:
+                self._on_close()
+        super().close()
+
+
+COMPRESSION_EXTENSIONS = {
+    ".zst": "zstd",
+    ".zstd": "zstd",
+    ".gz": "gzip",
+    ".bz2": "bz2",
+    ".xz": "xz",
+    ".7z": "7z",
+}
+
+
+def open_compressed(path: str, compression: Optional[str] = None) -> BinaryIO:
+    """Open a (possibly) compressed file as a stream of decompressed bytes.
+
+    Args:
+      path: The file to open.
+      compression: One of zstd, gzip, bz2, xz, 7z, or none. Inferred from the
+        file extension by default.
+    """
+    if compression is None:
+        compression = COMPRESSION_EXTENSIONS.get(
+            os.path.splitext(path)[1].lower(), "none"
+        )
+    if compression == "none":
+        return open(path, "rb")
+    if compression == "zstd":
+        import zstandard
+
+        f = zstandard.ZstdDecompressor(max_window_size=ZSTD_MAX_WINDOW).stream_reader(
+            open(path, "rb"), read_across_frames=True, closefd=True
+        )
+        return Readahead(f)
+    if compression == "gzip":
+        return Readahead(gzip.open(path, "rb"))
+    if compression == "bz2":
+        return Readahead(bz2.open(path, "rb"))
+    if compression == "xz":
+        return Readahead(lzma.open(path, "rb"))
+    if compression == "7z":
+        # There isn't a streaming 7z decoder for python, so stream the output of
+        # the 7z binary instead.
+        if (seven_zip := shutil.which("7z") or shutil.which("7za")) is None:
+            raise ValueError(f"Reading {path} requires the 7z command line tool.")
+        proc = subprocess.Popen(
+            [seven_zip, "x", "-so", "--", path],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+
+        def wait():
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+
+        return Readahead(proc.stdout, on_close=wait)
+    raise ValueError(f"Unknown compression {compression} for {path}")
+
+
+def iterate_xml(path: str, tag: str, compression: Optional[str] = None):
     """Iterable version of xml parsing, lets us not load the whole thing at once.
 
     Args:
-      path: The path to the xml file
+      path: The path to the xml file, it can be compressed, see `open_compressed`.
       tag: The tag for the xml objects we want to iterate over.
+      compression: The compression used for the file, inferred by default.
 
     See https://web.archive.org/web/20201111201837/http://effbot.org/zone/element-iterparse.htm
     for more details on what it is doing.
     """
     logger = logs.get_logger()
-    context = ET.iterparse(path, events=("start", "end"))
-    context = iter(context)
-    event, root = next(context)
     try:
-        for event, elem in context:
-            # This `.localname` only exists for lxml. Include this or so you can
-            # still do a full namespace match if you need too.
-            if event == "end" and (
-                ET.QName(elem.tag).localname == tag or elem.tag == tag
-            ):
-                yield elem
-                root.clear()
+        with open_compressed(path, compression) as f:
+            context = ET.iterparse(f, events=("start", "end"))
+            context = iter(context)
+            event, root = next(context)
+            for event, elem in context:
+                # This `.localname` only exists for lxml. Include this or so you can
+                # still do a full namespace match if you need too.
+                if event == "end" and (
+                    ET.QName(elem.tag).localname == tag or elem.tag == tag
+                ):
+                    yield elem
+                    root.clear()
     except Exception as e:
         logger.exception(f"Failed iterating over <{tag}> in {path}")
 
 
-def iterate_xmls(paths: List[str], tag: str):
+def iterate_xmls(paths: List[str], tag: str, compression: Optional[str] = None):
     """Iterable version of parsing multiple xml files with the same structure as a single iterator."""
     for path in paths:
-        yield from iterate_xml(path, tag)
+        yield from iterate_xml(path, tag, compression)
+
+
+@dataclasses.dataclass
+class MediaWikiPage:
+    """The parts of a MediaWiki <page> we keep, built one revision at a time.
+
+    Fields are None when the element was missing from the export.
+    """
+
+    title: Optional[str] = None
+    namespace: Optional[str] = None
+    page_id: Optional[str] = None
+    redirect: bool = False
+    revisions: int = 0
+    # The text and timestamp of the latest revision.
+    text: Optional[str] = None
+    has_text: bool = False
+    timestamp: Optional[str] = None
+    # (username, user id) pairs, from every revision or only the latest.
+    contributors: Set[Tuple[str, str]] = dataclasses.field(default_factory=set)
+
+
+def localname(elem) -> str:
+    return ET.QName(elem.tag).localname
+
+
+def revision_contributors(revision) -> Set[Tuple[str, str]]:
+    contribs = [c for c in revision if localname(c) == "contributor"]
+    # When there are multiple contributors, there are multiple contributor
+    # xml items where each one has a single username and id items.
+    names = [u.text for c in contribs for u in c if localname(u) == "username"]
+    names = ["" if n is None else n for n in names]
+    # Save their id too in case they change their username
+    uids = [u.text for c in contribs for u in c if localname(u) == "id"]
+    uids = ["" if u is None else u for u in uids]
+    return set(zip(names, uids))
+
+
+def iterate_mediawiki_pages(
+    path: str, all_authors: bool = True, compression: Optional[str] = None
+):
+    """Stream the pages of a MediaWiki export, including full-history exports.
+
+    Unlike `iterate_xml(path, "page")`, which builds the whole <page> before
+    yielding it, each <revision> is folded into a `MediaWikiPage` and then
+    dropped from the tree as soon as it is closed. The text of earlier revisions
+    is overwritten by later ones, so memory is bounded by the largest single
+    revision instead of the size of the page's history.
+
+    Args:
+      path: The path to the xml file, it can be compressed, see `open_compressed`.
+      all_authors: Collect the contributors from every revision, otherwise only
+        the contributors of the latest revision are kept.
+      compression: The compression used for the file, inferred by default.
+    """
+    logger = logs.get_logger()
+    page_elem, page = None, None
+    try:
+        with open_compressed(path, compression) as f:
+            context = iter(ET.iterparse(f, events=("start", "end")))
+            event, root = next(context)
+            for event, elem in context:
+                name = localname(elem)
+                if event == "start":
+                    if name == "page":
+                        page_elem, page = elem, MediaWikiPage()
+                    continue
+                if page_elem is None or elem.getparent() is not page_elem:
+                    if name == "page" and elem is page_elem:
+                        yield page
+                        page_elem, page = None, None
+                        root.clear()
+                    continue
+                if name == "revision":
+                    page.revisions += 1
+                    text = [t for t in elem if localname(t) == "text"]
+                    page.has_text = bool(text)
+                    page.text = text[0].text if text else None
+                    ts = [t for t in elem if localname(t) == "timestamp"]
+                    page.timestamp = ts[0].text if ts else None
+                    contributors = revision_contributors(elem)
+                    if all_authors:
+                        page.contributors.update(contributors)
+                    else:
+                        page.contributors = contributors
+                    # Drop the revision, and its text, from the page we are building.
+                    elem.clear()
+                    page_elem.remove(elem)
+                elif name == "redirect":
+                    page.redirect = True
+                elif name == "title" and page.title is None:
+                    page.title = elem.text
+                elif name == "ns" and page.namespace is None:
+                    page.namespace = elem.text
+                elif name == "id" and page.page_id is None:
+                    page.page_id = elem.text
+    except Exception as e:
+        logger.exception(f"Failed iterating over <page> in {path}")
+
+
+def iterate_mediawiki_xmls(
+    paths: List[str], all_authors: bool = True, compression: Optional[str] = None
+):
+    """`iterate_mediawiki_pages` over multiple export files as a single iterator."""
+    for path in paths:
+        yield from iterate_mediawiki_pages(path, all_authors, compression)
@@ -0,0 +1,123 @@
+"""Tests for the streaming MediaWiki export parser."""
+
+import bz2
+import gzip
+import io
+import lzma
+
+import pytest
+
+from common_pile import xml
+
+HISTORY = """<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.11/">
+  <siteinfo><sitename>Test</sitename></siteinfo>
+  <page>
+    <title>Main Page</title>
+    <ns>0</ns>
+    <id>1</id>
+    <revision>
+      <id>10</id>
+      <timestamp>2020-01-01T00:00:00</timestamp>
+      <contributor><username>Alice</username><id>100</id></contributor>
+      <text>first</text>
+    </revision>
+    <revision>
+      <id>11</id>
+      <parentid>10</parentid>
+      <timestamp>2021-01-01T00:00:00</timestamp>
+      <contributor><ip>127.0.0.1</ip></contributor>
+      <text>second</text>
+    </revision>
+    <revision>
+      <id>12</id>
+      <parentid>11</parentid>
+      <timestamp>2022-01-01T00:00:00</timestamp>
+      <contributor><username>Bob</username><id>200</id></contributor>
+      <text>third</text>
+    </revision>
+  </page>
+  <page>
+    <title>Old Name</title>
+    <ns>0</ns>
+    <id>2</id>
+    <redirect title="Main Page" />
+    <revision>
+      <id>20</id>
+      <timestamp>2022-02-02T00:00:00</timestamp>
+      <contributor><username>Alice</username><id>100</id></contributor>
+      <text />
+    </revision>
+  </page>
+</mediawiki>
+"""
+
+
+@pytest.fixture
+def history(tmp_path):
+    path = tmp_path / "test-history.xml"
+    path.write_text(HISTORY)
+    return str(path)
+
+
+def test_iterate_mediawiki_pages(history):
+    main, redirect = xml.iterate_mediawiki_pages(history)
+    assert main == xml.MediaWikiPage(
+        title="Main Page",
+        namespace="0",
+        page_id="1",
+        redirect=False,
+        revisions=3,
+        text="third",
+        has_text=True,
+        timestamp="2022-01-01T00:00:00",
+        contributors={("Alice", "100"), ("Bob", "200")},
+    )
+    assert redirect.redirect
+    assert redirect.has_text and redirect.text is None
+
+
+def test_iterate_mediawiki_pages_last_author(history):
+    main, _ = xml.iterate_mediawiki_pages(history, all_authors=False)
+    assert main.contributors == {("Bob", "200")}
+
+
+def test_iterate_mediawiki_xmls(history):
+    pages = list(xml.iterate_mediawiki_xmls([history, history]))
+    assert [p.page_id for p in pages] == ["1", "2", "1", "2"]
+
+
+COMPRESSORS = {"gzip": (gzip, "gz"), "bz2": (bz2, "bz2"), "xz": (lzma, "xz")}
+
+
+@pytest.mark.parametrize("compression", ("gzip", "bz2", "xz", "zstd"))
+def test_iterate_compressed(history, compression):
+    with open(history, "rb") as f:
+        data = f.read()
+    if compression == "zstd":
+        zstandard = pytest.importorskip("zstandard")
+        path = f"{history}.zst"
+        # Use multiple frames and a long window, like the IA dumps.
+        params = zstandard.ZstdCompressionParameters.from_level(3, window_log=31)
+        cctx = zstandard.ZstdCompressor(compression_params=params)
+        with open(path, "wb") as wf:
+            wf.write(cctx.compress(data[:100]) + cctx.compress(data[100:]))
+    else:
+        module, ext = COMPRESSORS[compression]
+        path = f"{history}.{ext}"
+        with module.open(path, "wb") as wf:
+            wf.write(data)
+    assert list(xml.iterate_mediawiki_pages(path)) == list(
+        xml.iterate_mediawiki_pages(history)
+    )
+    assert len(list(xml.iterate_xml(path, "revision"))) == 4
+
+
+def test_readahead():
+    data = bytes(range(256)) * 1000
+    with xml.Readahead(io.BytesIO(data), chunk_size=1000, depth=2) as f:
+        assert f.read(10) == data[:10]
+        assert f.read() == data[10:]
+    # Closing before the stream is consumed shouldn't hang the reader thread.
+    f = xml.Readahead(io.BytesIO(data), chunk_size=10, depth=1)
+    f.read(5)
+    f.close()
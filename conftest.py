@@ -0,0 +1,8 @@
+import os
+import tempfile
+
+# Keep the logs of scripts imported by the tests out of the source tree.
+os.environ.setdefault(
+    "COMMON_PILE_LOG_FILE",
+    os.path.join(tempfile.mkdtemp(prefix="common_pile_"), "common_pile_log.txt"),
+)
@@ -0,0 +1,144 @@
+"""Time the paragraph_chunk_tagger on long books.
+
+Books are the `--top` longest documents in `--input`, or synthetic books with many
+distinct chapter and running headers when no input is given. For each book this
+reports the time for the whole tagger and for the header dedup on its own, next to
+the old approach of comparing each header to every kept header.
+
+    python benchmark_paragraph_chunk_tagger.py --input "data/project_gutenberg/v0/documents/*.jsonl.gz"
+"""
+
+import argparse
+import glob
+import heapq
+import json
+import random
+import string
+import time
+
+import smart_open
+from dolma.core.data_types import Document
+from dolma.core.utils import split_paragraphs
+from paragraph_chunk_tagger import (
+    HeaderIndex,
+    ParagraphChunkTagger,
+    get_headers,
+    get_text_blocks,
+)
+from rapidfuzz.fuzz import ratio
+
+parser = argparse.ArgumentParser(description="Benchmark the paragraph chunk tagger.")
+parser.add_argument(
+    "--input", help="Glob of dolma shards to take the longest documents from."
+)
+parser.add_argument("--top", type=int, default=5, help="How many books to time.")
+parser.add_argument(
+    "--chapters", type=int, default=1000, help="Chapters in each synthetic book."
+)
+parser.add_argument(
+    "--repeats", type=int, default=3, help="Take the best time of this many runs."
+)
+parser.add_argument("--seed", type=int, default=0)
+
+
+def longest_documents(paths, top):
+    heap = []
+    for path in paths:
+        with smart_open.open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                data = json.loads(line)
+                item = (len(data["text"]), data["id"], data["text"])
+                if len(heap) < top:
+                    heapq.heappush(heap, item)
+                else:
+                    heapq.heappushpop(heap, item)
+    return [(doc_id, text) for _, doc_id, text in sorted(heap, reverse=True)]
+
+
+def synthetic_book(chapters, rng):
+    def sentence():
+        return " ".join(
+            "".join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 9)))
+            for _ in range(12)
+        )
+
+    title = "THE HISTORY OF " + "".join(rng.choices(string.ascii_uppercase, k=8))
+    lines = []
+    for chapter in range(chapters):
+        name = " ".join(
+            "".join(rng.choices(string.ascii_uppercase, k=rng.randint(3, 8)))
+            for _ in range(3)
+        )
+        for page in range(3):
+            # A running header with the page number, then the chapter title on its first page.
+            lines += [f"{title} {chapter * 3 + page}", ""]
+            if page == 0:
+                lines += [f"CHAPTER {chapter + 1}. {name}", ""]
+            lines += [sentence() for _ in range(rng.randint(3, 8))] + [""]
+    return "\n".join(lines)
+
+
+def quadratic_dedup(headers, threshold=70):
+    kept = []
+    for header in headers:
+        if not any(ratio(header.lower(), k.lower()) >= threshold for k in kept):
+            kept.append(header)
+    return len(kept)
+
+
+def indexed_dedup(headers):
+    index = HeaderIndex()
+    for header in headers:
+        if header not in index:
+            index.add(header)
+    return len(index.exact)
+
+
+def best_time(fn, arg, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn(arg)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main(args):
+    if args.input:
+        books = longest_documents(sorted(glob.glob(args.input)), args.top)
+    else:
+        rng = random.Random(args.seed)
+        books = [
+            (f"synthetic-{i}", synthetic_book(args.chapters, rng))
+            for i in range(args.top)
+        ]
+
+    tagger = ParagraphChunkTagger()
+    for doc_id, text in books:
+        doc = Document(source="benchmark", version="v0", id=doc_id, text=text)
+        tag_time, _ = best_time(tagger.predict, doc, args.repeats)
+        stripped = [
+            line.text.strip() for line in split_paragraphs(text, remove_empty=False)
+        ]
+        # The lines the tagger checks for duplicates, headers outside of text blocks.
+        headers = [
+            line
+            for line, is_header, in_block in zip(
+                stripped, get_headers(stripped), get_text_blocks(stripped)
+            )
+            if is_header and not in_block
+        ]
+        indexed_time, kept = best_time(indexed_dedup, headers, args.repeats)
+        quadratic_time, quadratic_kept = best_time(quadratic_dedup, headers, 1)
+        assert kept == quadratic_kept, (doc_id, kept, quadratic_kept)
+        print(
+            f"{doc_id}: {len(text) / 1e6:.1f}M chars, {len(headers)} headers ({kept} kept), "
+            f"tagger {tag_time:.2f}s, header dedup {indexed_time:.3f}s vs {quadratic_time:.3f}s pairwise"
+        )
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,174 @@
+"""Mine frequent boilerplate lines from a source's shards into a line tagger config.
+
+A line (paragraph) is counted at most once per document, and lines that show up in
+at least `--min_docs` documents are written to `line_tagger_configs/{name}.json`,
+most frequent first, along with the compiled `.lineidx` the `LineTagger` loads.
+Counting is done on 64 bit hashes, and the text of the frequent lines is recovered
+in a second pass. The first pass doesn't keep a counter of every line in memory,
+which grows with the number of distinct lines in the corpus. Instead it writes the
+hash of each (document, line) pair, 8 bytes each, to one of `--partitions` files
+on disk, split by hash. Then it counts one partition at a time by sorting it. The
+peak memory is about 3x the size of the largest partition file, so raise
+`--partitions` for bigger corpora. The counts are still exact.
+
+    python build_line_index.py --input "data/news/v0/documents/*.jsonl.gz" --name news-dolma
+"""
+
+import argparse
+import glob
+import json
+import os
+import tempfile
+
+import numpy as np
+import smart_open
+import tqdm
+from dolma.core.utils import split_paragraphs
+from line_tagger import (
+    CONFIG_DIR,
+    LINE_INDEX_SUFFIX,
+    compile_line_index,
+    hash_line,
+    normalize_line,
+)
+
+parser = argparse.ArgumentParser(description="Mine boilerplate lines for a LineTagger.")
+parser.add_argument(
+    "--input", required=True, help="Glob of dolma shards to mine lines from."
+)
+parser.add_argument(
+    "--name", required=True, help="The name of the config, i.e. news-dolma."
+)
+parser.add_argument(
+    "--output_dir", default=CONFIG_DIR, help="Where to write the config and index."
+)
+parser.add_argument(
+    "--min_docs",
+    type=int,
+    default=100,
+    help="Only keep lines that appear in this many documents.",
+)
+parser.add_argument(
+    "--min_length",
+    type=int,
+    default=10,
+    help="Ignore lines shorter than this many characters.",
+)
+parser.add_argument("--max_lines", type=int, help="Only keep the most frequent lines.")
+parser.add_argument("--max_docs", type=int, help="Stop after this many documents.")
+parser.add_argument(
+    "--merge", action="store_true", help="Keep the lines already in the config."
+)
+parser.add_argument(
+    "--partitions",
+    type=int,
+    default=16,
+    help="How many parts to split the line hashes into, each is counted on its own.",
+)
+parser.add_argument(
+    "--work_dir",
+    help="Where to write the line hashes, defaults to a temporary directory.",
+)
+
+# How many hashes are buffered in memory before they are written to the partitions.
+FLUSH_SIZE = 1 << 22
+
+
+def iterate_documents(paths, max_docs=None):
+    seen = 0
+    for path in paths:
+        with smart_open.open(path) as f:
+            for line in f:
+                if max_docs is not None and seen >= max_docs:
+                    return
+                if line.strip():
+                    seen += 1
+                    yield json.loads(line)["text"]
+
+
+def document_lines(text, min_length):
+    """The unique lines in a document that are long enough to count."""
+    lines = (normalize_line(p.text) for p in split_paragraphs(text))
+    return {l for l in lines if len(l) >= min_length}
+
+
+def write_hashes(documents, min_length, partitions, work_dir):
+    """Write the hash of every line of each document to the partition files."""
+    paths = [os.path.join(work_dir, f"{p:05d}.u64") for p in range(partitions)]
+    buffers = [[] for _ in range(partitions)]
+    buffered = 0
+
+    def flush():
+        for path, buffer in zip(paths, buffers):
+            with open(path, "ab") as wf:
+                np.array(buffer, dtype=np.uint64).tofile(wf)
+            buffer.clear()
+
+    for text in documents:
+        for l in document_lines(text, min_length):
+            h = hash_line(l)
+            # The high bits are the crc32, the low ones are a poorly mixed adler32.
+            buffers[(h >> 32) % partitions].append(h)
+            buffered += 1
+        if buffered >= FLUSH_SIZE:
+            flush()
+            buffered = 0
+    flush()
+    return paths
+
+
+def count_partition(path, min_docs):
+    """The (hash, count) of the lines of one partition in at least `min_docs` documents."""
+    hashes, counts = np.unique(np.fromfile(path, dtype=np.uint64), return_counts=True)
+    keep = counts >= min_docs
+    return list(zip(hashes[keep].tolist(), counts[keep].tolist()))
+
+
+def main(args):
+    paths = sorted(glob.glob(args.input))
+    if not paths:
+        raise ValueError(f"No shards match {args.input}")
+
+    if args.work_dir:
+        os.makedirs(args.work_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+        documents = tqdm.tqdm(
+            iterate_documents(paths, args.max_docs), desc="Hashing lines"
+        )
+        partitions = write_hashes(documents, args.min_length, args.partitions, work_dir)
+        frequent = []
+        for path in tqdm.tqdm(partitions, desc="Counting lines"):
+            frequent.extend(count_partition(path, args.min_docs))
+    # Most frequent first, ties in hash order so they don't depend on the partitions.
+    frequent.sort(key=lambda x: (-x[1], x[0]))
+    frequent = frequent[: args.max_lines]
+    print(f"Found {len(frequent)} lines in at least {args.min_docs} documents.")
+
+    texts = {}
+    wanted = dict(frequent)
+    for text in tqdm.tqdm(
+        iterate_documents(paths, args.max_docs), desc="Finding line text"
+    ):
+        for l in document_lines(text, args.min_length):
+            if (h := hash_line(l)) in wanted and h not in texts:
+                texts[h] = l
+        if len(texts) == len(wanted):
+            break
+    lines = [texts[h] for h, _ in frequent if h in texts]
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    config_path = os.path.join(args.output_dir, f"{args.name}.json")
+    if args.merge and os.path.exists(config_path):
+        with open(config_path) as f:
+            existing = json.load(f)
+        known = {normalize_line(l) for l in existing}
+        lines = existing + [l for l in lines if l not in known]
+    with open(config_path, "w") as wf:
+        json.dump(lines, wf, indent=4, ensure_ascii=False)
+    compile_line_index(lines, f"{config_path}{LINE_INDEX_SUFFIX}")
+    print(f"Wrote {len(lines)} lines to {config_path}")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args)
@@ -1,133 +1,228 @@
+"""Taggers that mark paragraphs that exactly match known boilerplate lines.
+
+Each source's lines live in `line_tagger_configs/*.json`. They are compiled into a
+`.lineidx` file next to the json, a sorted array of 64 bit hashes of the stripped
+lines, which is memory mapped so every dolma worker process shares one copy through
+the page cache instead of building its own set of strings. The index is rebuilt
+whenever the json is newer. Use `build_line_index.py` to mine new configs from a
+source's shards.
+"""
+
+import bisect
+import functools
 import json
+import mmap
+import os
+import struct
+import zlib
+from typing import Iterable, List, Optional
+
+import numpy as np
 from dolma.core.data_types import DocResult, Document, Span, TextSlice
 from dolma.core.utils import split_paragraphs
 from dolma import add_tagger, BaseTagger
 
+CONFIG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "line_tagger_configs")
+
+LINE_INDEX_MAGIC = b"LINEIDX1"
+LINE_INDEX_HEADER = struct.Struct("<8sQQ")  # magic, number of hashes, number of shapes
+LINE_INDEX_SUFFIX = ".lineidx"
+
+
+def normalize_line(line: str) -> str:
+    return line.strip()
+
+
+def hash_line(line: str) -> int:
+    """A stable 64 bit hash of a normalized line (python's hash changes per process).
+
+    Two cheap checksums side by side are plenty to avoid collisions for a few thousand
+    lines, and are much faster than a cryptographic hash on every paragraph.
+    """
+    data = line.encode("utf-8", "surrogatepass")
+    return zlib.crc32(data) << 32 | zlib.adler32(data)
+
+
+def line_shape(line: str) -> int:
+    """The length and first and last characters of a normalized line, a cheap prefilter."""
+    return len(line) << 42 | ord(line[0]) << 21 | ord(line[-1]) if line else 0
+
+
+def compile_line_index(lines: Iterable[str], output_path: str):
+    lines = [normalize_line(l) for l in lines]
+    hashes = np.unique(np.fromiter((hash_line(l) for l in lines), dtype="<u8", count=len(lines)))
+    shapes = np.unique(np.fromiter((line_shape(l) for l in lines), dtype="<u8", count=len(lines)))
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as wf:
+        wf.write(LINE_INDEX_HEADER.pack(LINE_INDEX_MAGIC, len(hashes), len(shapes)))
+        wf.write(hashes.tobytes())
+        wf.write(shapes.tobytes())
+    # Workers can start at the same time, the rename means they never see a partial index.
+    os.replace(tmp_path, output_path)
+
+
+class LineIndex:
+    """Membership checks against a sorted, memory mapped array of line hashes.
+
+    Most paragraphs can be ruled out by their length and first and last characters, so
+    only the ones that pass that check get hashed and looked up.
+    """
+
+    def __init__(self, hashes: np.ndarray, shapes: np.ndarray, _mmap: Optional[mmap.mmap] = None):
+        self.hashes = hashes
+        # bisect on a memoryview avoids numpy's per call overhead for the few
+        # candidates in each document.
+        self._sorted = memoryview(np.ascontiguousarray(hashes, dtype="<u8")).cast("B").cast("Q")
+        self.shapes = frozenset(shapes.tolist())
+        self._mmap = _mmap
+
+    @classmethod
+    def from_lines(cls, lines: Iterable[str]) -> "LineIndex":
+        lines = [normalize_line(l) for l in lines]
+        return cls(
+            np.unique(np.fromiter((hash_line(l) for l in lines), dtype="<u8", count=len(lines))),
+            np.fromiter((line_shape(l) for l in lines), dtype="<u8", count=len(lines)),
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "LineIndex":
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, num_hashes, num_shapes = LINE_INDEX_HEADER.unpack_from(mm)
+        if magic != LINE_INDEX_MAGIC:
+            raise ValueError(f"{path} is not a compiled line index.")
+        offset = LINE_INDEX_HEADER.size
+        hashes = np.frombuffer(mm, dtype="<u8", count=num_hashes, offset=offset)
+        shapes = np.frombuffer(mm, dtype="<u8", count=num_shapes, offset=offset + 8 * num_hashes)
+        return cls(hashes, shapes, mm)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __contains__(self, line: str) -> bool:
+        """Check a normalized line."""
+        if line_shape(line) not in self.shapes:
+            return False
+        h = hash_line(line)
+        i = bisect.bisect_left(self._sorted, h)
+        return i < len(self._sorted) and self._sorted[i] == h
+
+    def matches(self, lines: List[str]) -> List[int]:
+        """The indices of the lines that are in the index."""
+        shapes = self.shapes
+        matches = []
+        for i, line in enumerate(lines):
+            line = line.strip()
+            # line_shape inlined, this runs on every paragraph.
+            if (len(line) << 42 | ord(line[0]) << 21 | ord(line[-1]) if line else 0) in shapes and line in self:
+                matches.append(i)
+        return matches
+
+
+@functools.lru_cache(maxsize=None)
+def load_line_index(config: str) -> LineIndex:
+    """Load the compiled index for a json config, (re)building it if it is stale."""
+    config_path = config if os.path.isabs(config) else os.path.join(CONFIG_DIR, config)
+    index_path = f"{config_path}{LINE_INDEX_SUFFIX}"
+    if not os.path.exists(index_path) or os.path.getmtime(index_path) < os.path.getmtime(config_path):
+        with open(config_path) as f:
+            compile_line_index(json.load(f), index_path)
+    return LineIndex.load(index_path)
+
+
 class LineTagger(BaseTagger):
-    def __init__(self, lines):
-        self.lines = set([l.strip() for l in lines])
-    
-    def predict_slice(self, text_slice: TextSlice) -> Span:
-        if text_slice.text.strip() in self.lines:
+    """Tag paragraphs that are one of the lines in `CONFIG` (or the lines passed in)."""
+
+    CONFIG: Optional[str] = None
+
+    def __init__(self, lines: Optional[Iterable[str]] = None):
+        if lines is not None:
+            self.index = LineIndex.from_lines(lines)
+        else:
+            self.index = load_line_index(self.CONFIG)
+
+    def predict_slice(self, text_slice: TextSlice) -> Optional[Span]:
+        if self.index.matches([text_slice.text]):
             return Span(start=text_slice.start, end=text_slice.end, type="line", score=1.0)
 
+    def predict_slices(self, units: List[TextSlice]) -> List[Span]:
+        return [
+            Span(start=units[i].start, end=units[i].end, type="line", score=1.0)
+            for i in self.index.matches([unit.text for unit in units])
+        ]
+
+    def predict_paragraphs(self, doc: Document, paragraphs: List[TextSlice]) -> DocResult:
+        return DocResult(doc=doc, spans=self.predict_slices(paragraphs))
+
     def predict(self, doc: Document) -> DocResult:
-        spans = []
-        units = split_paragraphs(doc.text)
-        for unit in units:
-            pred = self.predict_slice(unit)
-            if pred:
-                spans.append(pred)
-        return DocResult(doc=doc, spans=spans)
+        return self.predict_paragraphs(doc, split_paragraphs(doc.text))
 
 
 @add_tagger("usgpo_line_tagger")
 class usgpoLineTagger(LineTagger):
-    def __init__(self):
-        with open("./line_tagger_configs/usgpo.json", "r") as f:
-            lines = json.load(f)
-        super().__init__(lines)
-    
+    CONFIG = "usgpo.json"
+
 
 @add_tagger("biodiversity-heritage-library_line_tagger")
 class biodiversity_heritage_libraryLineTagger(LineTagger):
-    def __init__(self):
-        with open("./line_tagger_configs/biodiversity-heritage-library.json", "r") as f:
-            lines = json.load(f)
-        super().__init__(lines)
+    CONFIG = "biodiversity-heritage-library.json"
 
 
 @add_tagger("stackexchange-dolma_line_tagger")
 class stackexchange_dolmaLineTagger(LineTagger):
-    def __init__(self):
-        with open("./line_tagger_configs/stackexchange-dolma.json", "r") as f:
-            lines = json.load(f)
-        super().__init__(lines)
-    
+    CONFIG = "stackexchange-dolma.json"
+
 
 @add_tagger("public-domain-review_line_tagger")
 class public_domain_reviewLineTagger(LineTagger):
-    def __init__(self):
-        with open("./line_tagger_configs/public-domain-review.json", "r") as f:
-            lines = json.load(f)
-        super().__init__(lines)
-    
+    CONFIG = "public-domain-review.json"
+
 
 @add_tagger("news-dolma_line_tagger")
 class news_dolmaLineTagger(LineTagger):
-    def __init__(self):
-        with open("./line_tagger_configs/news-dolma.json", "r") as f:
-            lines = json.load(f)
-        super().__init__(lines)
-    
+    CONFIG = "news-dolma.json"
+
 
 @add_tagger("licensed_pubmed_line_tagger")
 class licensed_pubmedLineTagger(LineTagger):
-    def __init__(self):
-        with open("./line_tagger_configs/licensed_pubmed.json", "r") as f:
-            lines = json.load(f)
-        super().__init__(lines)
-    
+    CONFIG = "licensed_pubmed.json"
+
 
 @add_tagger("uk_hansard_line_tagger")
 class uk_hansardLineTagger(LineTagger):
-    def __init__(self):
-        with open("./line_tagger_configs/uk_hansard.json", "r") as f:
-            lines = json.load(f)
-        super().__init__(lines)
-    
+    CONFIG = "uk_hansard.json"
+
 
 @add_tagger("ubuntu-chat-dolma_line_tagger")
 class ubuntu_chat_dolmaLineTagger(LineTagger):
-    def __init__(self):
-        with open("./line_tagger_configs/ubuntu-chat-dolma.json", "r") as f:
-            lines = json.load(f)
-        super().__init__(lines)
-    
+    CONFIG = "ubuntu-chat-dolma.json"
+
 
 @add_tagger("USPTO_line_tagger")
 class USPTOLineTagger(LineTagger):
-    def __init__(self):
-        with open("./line_tagger_configs/USPTO.json", "r") as f:
-            lines = json.load(f)
-        super().__init__(lines)
-    
+    CONFIG = "USPTO.json"
+
 
 @add_tagger("ca_hansard_line_tagger")
 class ca_hansardLineTagger(LineTagger):
-    def __init__(self):
-        with open("./line_tagger_configs/ca_hansard.json", "r") as f:
-            lines = json.load(f)
-        super().__init__(lines)
-    
+    CONFIG = "ca_hansard.json"
+
 
 @add_tagger("wiki-dolma_line_tagger")
 class wiki_dolmaLineTagger(LineTagger):
-    def __init__(self):
-        with open("./line_tagger_configs/wiki-dolma.json", "r") as f:
-            lines = json.load(f)
-        super().__init__(lines)
-    
+    CONFIG = "wiki-dolma.json"
+
 
 @add_tagger("public_library_1929_dolma_line_tagger")
 class public_library_1929_dolmaLineTagger(LineTagger):
-    def __init__(self):
-        with open("./line_tagger_configs/public_library_1929_dolma.json", "r") as f:
-            lines = json.load(f)
-        super().__init__(lines)
-    
+    CONFIG = "public_library_1929_dolma.json"
+
 
 @add_tagger("project_gutenberg-dolma_line_tagger")
 class project_gutenberg_dolmaLineTagger(LineTagger):
-    def __init__(self):
-        with open("./line_tagger_configs/project_gutenberg-dolma.json", "r") as f:
-            lines = json.load(f)
-        super().__init__(lines)
-    
+    CONFIG = "project_gutenberg-dolma.json"
+
 
 @add_tagger("regulations_line_tagger")
 class regulationsLineTagger(LineTagger):
-    def __init__(self):
-        with open("./line_tagger_configs/regulations.json", "r") as f:
-            lines = json.load(f)
-        super().__init__(lines)
+    CONFIG = "regulations.json"
@@ -1,59 +1,117 @@
+import bisect
 import re
+from typing import Dict, List
 
 from dolma.core.data_types import DocResult, Document, Span, TextSlice
 from dolma.core.utils import split_paragraphs
 from dolma import add_tagger, BaseTagger
 from rapidfuzz.fuzz import ratio
+from rapidfuzz.process import extractOne
+
+HEADER = re.compile(r"[0-9A-Za-z\s\.,\:]+$")
+
+
+def get_text_blocks(stripped_lines: List[str], min_line_length=30, min_lines_in_block=3) -> List[bool]:
+    """Mark the lines that are part of a block of at least `min_lines_in_block` long lines.
+
+    A short, non-empty line right after a block ends it and is part of it too.
+    """
+    n = len(stripped_lines)
+    # run[i] is how many long lines there are in a row starting at line i.
+    run = [0] * (n + 1)
+    for i in range(n - 1, -1, -1):
+        if len(stripped_lines[i]) > min_line_length:
+            run[i] = run[i + 1] + 1
+    mask = [False] * n
+    i = 0
+    while i < n:
+        # The lines left at the end of the document only need to all be long.
+        if run[i] >= min(min_lines_in_block, n - i):
+            end = i + run[i]
+            if end < n and stripped_lines[end]:
+                end += 1
+            mask[i:end] = [True] * (end - i)
+            i = end
+        else:
+            i += 1
+    return mask
+
+
+def get_headers(stripped_lines: List[str], min_header_length=5) -> List[bool]:
+    return [len(line) > min_header_length and HEADER.match(line) is not None for line in stripped_lines]
+
+
+class HeaderIndex:
+    """The headers kept so far, to find near duplicates of a new header.
+
+    A header is a duplicate when its `ratio` with any kept header is at least
+    `threshold` (ignoring case). That ratio can't reach the threshold when the
+    lengths are too different, so kept headers are bucketed by length and only the
+    buckets in range are scored with `extractOne` and a score cutoff. Most duplicates
+    are running headers that match the same kept header over and over, so the kept
+    headers that matched recently are tried first. Headers are only lowercased, so
+    `extractOne` is called without a processor (before rapidfuzz 3 its default also
+    stripped punctuation).
+    """
+
+    RECENT = 8
+
+    def __init__(self, threshold: float = 70):
+        self.threshold = threshold
+        self.by_length: Dict[int, List[str]] = {}
+        self.lengths: List[int] = []
+        self.exact = set()
+        # A header that was a duplicate once always is, kept headers are never removed.
+        self.duplicates = set()
+        self.recent: List[str] = []
+
+    def add(self, header: str):
+        header = header.lower()
+        if header in self.exact:
+            return
+        self.exact.add(header)
+        if len(header) not in self.by_length:
+            bisect.insort(self.lengths, len(header))
+            self.by_length[len(header)] = []
+        self.by_length[len(header)].append(header)
+
+    def length_range(self, length: int):
+        # ratio <= 200 * min(a, b) / (a + b), the bounds are loosened by one so
+        # rounding never drops a candidate, the cutoff makes the exact decision.
+        t = self.threshold
+        return (t * length) // (200 - t) - 1, ((200 - t) * length) // t + 1
+
+    def __contains__(self, header: str) -> bool:
+        header = header.lower()
+        if header in self.exact or header in self.duplicates:
+            return True
+        if self.recent and extractOne(header, self.recent, scorer=ratio, processor=None, score_cutoff=self.threshold) is not None:
+            self.duplicates.add(header)
+            return True
+        low, high = self.length_range(len(header))
+        lengths = self.lengths[bisect.bisect_left(self.lengths, low):bisect.bisect_right(self.lengths, high)]
+        candidates = [h for length in lengths for h in self.by_length[length]]
+        match = extractOne(header, candidates, scorer=ratio, processor=None, score_cutoff=self.threshold) if candidates else None
+        if match is None:
+            return False
+        self.duplicates.add(header)
+        self.recent = [match[0]] + [h for h in self.recent if h != match[0]][:self.RECENT - 1]
+        return True
 
 
 @add_tagger("paragraph_chunk_tagger")
 class ParagraphChunkTagger(BaseTagger):
     def predict(self, doc: Document) -> DocResult:
-        def get_text_blocks(lines, min_line_length=30, min_lines_in_block=3):
-            mask = []
-
-            valid_lines = [len(line.text.strip()) > min_line_length for line in lines]
-            curr_index = 0
-            while curr_index < len(lines):
-                # Detect blocks of text that look like paragraphs
-                if all(valid_lines[curr_index: curr_index + min_lines_in_block]):
-                    # Get the whole block
-                    while curr_index < len(lines) and valid_lines[curr_index]:
-                        mask.append(True)
-                        curr_index += 1
-                    # Detect a short line ending a text block
-                    if curr_index < len(lines) and len(lines[curr_index].text.strip()) > 0:
-                        mask.append(True)
-                        curr_index += 1
-                else:
-                    mask.append(False)
-                    curr_index += 1
-            return mask
-        
-        def get_headers(lines, min_header_length=5):
-            mask = []
-            for line in lines:
-                if len(line.text.strip()) > min_header_length and re.match(r"[0-9A-Za-z\s\.,\:]+$", line.text.strip()):
-                    mask.append(True)
-                else:
-                    mask.append(False)
-            return mask
+        # N.b. this just splits on newline
+        return self.predict_lines(doc, split_paragraphs(doc.text, remove_empty=False))
 
-        
-        def header_already_seen(header, previous_headers, threshold=70):
-            for previous_header in previous_headers:
-                if ratio(header.lower(), previous_header.lower()) >= threshold:
-                    return True
-            return False
+    def predict_lines(self, doc: Document, lines: List[TextSlice]) -> DocResult:
+        stripped_lines = [line.text.strip() for line in lines]
 
+        text_block_mask = get_text_blocks(stripped_lines)
+        header_mask = get_headers(stripped_lines)
 
-        # N.b. this just splits on newline
-        lines = split_paragraphs(doc.text, remove_empty=False)
-        
-        text_block_mask = get_text_blocks(lines)
-        header_mask = get_headers(lines)
-        
-        headers = set()
+        headers = HeaderIndex()
         spans = []
         for i in range(len(lines)):
             # Check if this line is part of a text block
@@ -75,13 +133,13 @@ class ParagraphChunkTagger(BaseTagger):
                     spans.append(Span(start=lines[i].end - 1, end=lines[i].end, type="paragraph_terminal_newline", score=1.0))
 
             # Check if this line is a header and only keep one instance of each header to avoid keeping things like repeated chapter names at the top of each page
-            elif header_mask[i] and not header_already_seen(lines[i].text.strip(), headers) and i + 1 < len(lines):
+            elif header_mask[i] and i + 1 < len(lines) and stripped_lines[i] not in headers:
                 j = i + 1
-                while j < len(lines) and len(lines[j].text.strip()) == 0:
+                while j < len(lines) and len(stripped_lines[j]) == 0:
                     j += 1
                 if j < len(lines) and text_block_mask[j]:
                     spans.append(Span(start=lines[i].start, end=lines[i].end, type="paragraph_chunk", score=1.0))
-                    headers.add(lines[i].text.strip())
+                    headers.add(stripped_lines[i])
                 else:
                     spans.append(Span(start=lines[i].start, end=lines[i].end, type="paragraph_chunk", score=0.0))
             else:
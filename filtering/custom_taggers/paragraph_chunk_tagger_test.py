@@ -0,0 +1,96 @@
+"""Tests that HeaderIndex finds the same duplicate headers as the pairwise check."""
+
+import os
+import random
+import sys
+
+import pytest
+from dolma.core.utils import import_modules
+from rapidfuzz.fuzz import ratio
+
+# Import it the way dolma does, so the tagger is only registered once.
+import_modules(
+    [
+        os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "paragraph_chunk_tagger.py"
+        )
+    ]
+)
+paragraph_chunk_tagger = sys.modules["paragraph_chunk_tagger"]
+
+
+def pairwise(headers, threshold=70):
+    """The original check, a header is compared with every kept header."""
+    kept, seen = [], []
+    for header in headers:
+        duplicate = any(ratio(header.lower(), k.lower()) >= threshold for k in kept)
+        seen.append(duplicate)
+        if not duplicate:
+            kept.append(header)
+    return seen
+
+
+def indexed(headers, threshold=70):
+    index = paragraph_chunk_tagger.HeaderIndex(threshold)
+    seen = []
+    for header in headers:
+        duplicate = header in index
+        seen.append(duplicate)
+        if not duplicate:
+            index.add(header)
+    return seen
+
+
+@pytest.mark.parametrize(
+    "kept,header",
+    [
+        # 6 edits over 20 characters is a ratio of exactly 70.
+        ("abcdefg", "abcdefgxxxxxx"),
+        ("abcdefgxxxxxx", "abcdefg"),
+        ("Chapter One", "chapter on."),
+        # Only the case differs.
+        ("THE END", "the end"),
+    ],
+)
+def test_threshold(kept, header):
+    assert ratio(kept.lower(), header.lower()) >= 70
+    assert indexed([kept, header]) == pairwise([kept, header]) == [False, True]
+
+
+@pytest.mark.parametrize(
+    "kept,header",
+    [
+        # Just past the length bound, 200 * 7 / (7 + 14) < 70.
+        ("abcdefg", "abcdefgxxxxxxx"),
+        ("abcdefgxxxxxxx", "abcdefg"),
+        # Punctuation counts, the default processor of rapidfuzz < 3 stripped it.
+        ("a.b.c.d.e.", "abcde"),
+    ],
+)
+def test_below_threshold(kept, header):
+    assert ratio(kept.lower(), header.lower()) < 70
+    assert indexed([kept, header]) == pairwise([kept, header]) == [False, False]
+
+
+def test_matches_pairwise():
+    rng = random.Random(0)
+    alphabet = "abcdeABC .:"
+    base = ["".join(rng.choices(alphabet, k=rng.randint(3, 30))) for _ in range(50)]
+
+    def header():
+        h = list(rng.choice(base))
+        # A few edits, so many of the headers are close to the threshold.
+        for _ in range(rng.randint(0, 8)):
+            i = rng.randint(0, len(h))
+            op = rng.random()
+            if op < 0.4:
+                h.insert(i, rng.choice(alphabet))
+            elif op < 0.8 and i < len(h):
+                del h[i]
+            elif i < len(h):
+                h[i] = rng.choice(alphabet)
+        return "".join(h)
+
+    for _ in range(20):
+        headers = [header() for _ in range(200)]
+        assert indexed(headers) == pairwise(headers)
@@ -1,46 +1,158 @@
+import mmap
+import os
+import struct
 from typing import Any, Dict, List, Optional, Tuple, Union
 
 from dolma.core.data_types import Document, DocResult, Span
 from dolma import add_tagger, BaseTagger
 import numpy as np
 from blingfire import text_to_words
-from cached_path import cached_path
+import cached_path
 
 
 GOOGLE_1T_CORPUS = (
     "https://ai2-s2-research-public.s3-us-west-2.amazonaws.com/lucas/google-1T-unigram/unigram_freq.csv"
 )
 
+# The compiled vocab is an open addressing hash table, a header followed by a uint64
+# array of word hashes (0 marks an empty slot) and a float32 array of their log
+# probabilities. The header is padded to 32 bytes so the arrays are aligned when the
+# file is memory mapped.
+VOCAB_MAGIC = b"UNIGRAM2"
+VOCAB_HEADER = struct.Struct("<8sIIQd")  # magic, word width, log2 table size, vocab size, <unk> log p
+VOCAB_SUFFIX = ".unigram.bin"
+
+
+def _mix(h: np.ndarray) -> np.ndarray:
+    """The splitmix64 finalizer, vectorized."""
+    h = (h ^ (h >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return h ^ (h >> np.uint64(31))
+
+
+def hash_words(words: List[bytes], width: int) -> np.ndarray:
+    """Hash utf-8 encoded words 8 bytes at a time, for all words at once.
+
+    Words are truncated to `width` bytes. The width always has one more 8 byte chunk
+    than the longest vocab word, so a longer word can't hash the same as a vocab word.
+    """
+    chunks = np.array(words, dtype=f"S{width}").view("<u8").reshape(len(words), width // 8)
+    h = np.zeros(len(words), dtype=np.uint64)
+    for i in range(chunks.shape[1]):
+        h = _mix(h ^ chunks[:, i])
+    # 0 marks empty slots in the table.
+    h[h == 0] = 1
+    return h
+
+
+def compile_vocab(word_counts_path: str, output_path: str, load_factor: float = 0.5):
+    """Convert the word,count csv into the binary format read by `UnigramPerplexityPredictor`."""
+    with open(word_counts_path) as f:
+        word_counts = {
+            word: int(count) for word, count in (line.strip().split(",", 1) for line in f) if count.isnumeric()
+        }
+    word_total_log = np.log2(sum(word_counts.values()))
+    # <unk> token has fictional count of √vocab_size + 1
+    unk = np.log2(np.sqrt(len(word_counts)) + 1) - word_total_log
+
+    words = [word.encode("utf-8") for word in word_counts]
+    width = (max(map(len, words), default=0) // 8 + 1) * 8
+    hashes = hash_words(words, width)
+    if len(np.unique(hashes)) != len(hashes):
+        raise ValueError(f"Hash collision in the vocab from {word_counts_path}")
+    logp = (np.log2(np.fromiter(word_counts.values(), dtype=np.float64)) - word_total_log).astype("<f4")
+
+    bits = max(1, int(np.ceil(np.log2(max(1, len(hashes)) / load_factor))))
+    mask = np.uint64((1 << bits) - 1)
+    table = np.zeros(1 << bits, dtype="<u8")
+    table_logp = np.zeros(1 << bits, dtype="<f4")
+    # Linear probing, every round each word still without a slot tries the next one.
+    pending = np.arange(len(hashes))
+    slots = hashes & mask
+    while len(pending):
+        free = table[slots] == 0
+        # When several words want the same free slot, the first one gets it.
+        taken, first = np.unique(slots[free], return_index=True)
+        winners = pending[free][first]
+        table[taken] = hashes[winners]
+        table_logp[taken] = logp[winners]
+        keep = np.ones(len(pending), dtype=bool)
+        keep[np.flatnonzero(free)[first]] = False
+        pending, slots = pending[keep], (slots[keep] + np.uint64(1)) & mask
+
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as wf:
+        wf.write(VOCAB_HEADER.pack(VOCAB_MAGIC, width, bits, len(hashes), unk))
+        wf.write(table.tobytes())
+        wf.write(table_logp.tobytes())
+    # Many tagger processes can start at once, the rename makes sure they only ever
+    # see a complete file.
+    os.replace(tmp_path, output_path)
+
+
+def local_word_counts(word_counts_path: str) -> str:
+    if os.path.exists(word_counts_path):
+        return word_counts_path
+    # Reuse the download without asking the server if it changed on every startup.
+    return cached_path.find_latest_cached(word_counts_path) or str(cached_path.cached_path(word_counts_path))
+
 
 class UnigramPerplexityPredictor:
     """Predicts the perplexity of a passage based on the unigram distribution
-    probability of the words in a large corpus."""
+    probability of the words in a large corpus.
+
+    The vocab is compiled once into a memory mapped binary next to the word counts,
+    so starting a tagger is just an mmap, shared through the page cache by every
+    process. Words are looked up by hashing them all at once and probing the hash
+    table for every word together.
+    """
 
     UNK = "<unk>"
 
     def __init__(self, word_counts_path: str = GOOGLE_1T_CORPUS):
-        local_word_counts_path = cached_path(word_counts_path)
-        with open(local_word_counts_path) as f:
-            word_counts = {
-                word: int(count) for word, count in (line.strip().split(",", 1) for line in f) if count.isnumeric()
-            }
+        local_word_counts_path = local_word_counts(word_counts_path)
+        vocab_path = f"{local_word_counts_path}{VOCAB_SUFFIX}"
+        if not os.path.exists(vocab_path) or os.path.getmtime(vocab_path) < os.path.getmtime(local_word_counts_path):
+            compile_vocab(local_word_counts_path, vocab_path)
 
-        word_total = sum(word_counts.values())
-        word_total_log = np.log2(word_total)
-        self.words_logp = {word: np.log2(count) - word_total_log for word, count in word_counts.items()}
+        with open(vocab_path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.width, bits, _, self.unk_logp = VOCAB_HEADER.unpack_from(self._mmap)
+        if magic != VOCAB_MAGIC:
+            raise ValueError(f"{vocab_path} is not a compiled unigram vocab.")
+        self.mask = np.uint64((1 << bits) - 1)
+        self.hashes = np.frombuffer(self._mmap, dtype="<u8", count=1 << bits, offset=VOCAB_HEADER.size)
+        self.logp = np.frombuffer(self._mmap, dtype="<f4", count=1 << bits, offset=VOCAB_HEADER.size + (8 << bits))
 
-        # <unk> token has fictional count of √vocab_size + 1
-        self.words_logp[self.UNK] = np.log2(np.sqrt(len(self.words_logp)) + 1) - word_total_log
+    def log_ps(self, words: List[bytes]) -> np.ndarray:
+        """The log probability of each (lowercased, utf-8 encoded) word."""
+        h = hash_words(words, self.width)
+        result = np.full(len(h), self.unk_logp, dtype=np.float64)
+        pending = np.arange(len(h))
+        slots = h & self.mask
+        # Probe all the words at once, the table is at most half full so this only
+        # takes a few rounds.
+        while len(pending):
+            found = self.hashes[slots]
+            hit = found == h[pending]
+            result[pending[hit]] = self.logp[slots[hit]]
+            keep = ~hit & (found != 0)
+            pending, slots = pending[keep], (slots[keep] + np.uint64(1)) & self.mask
+        return result
 
     def log_p(self, word: str) -> float:
-        return self.words_logp.get(word.lower(), self.words_logp[self.UNK])
+        return float(self.log_ps([word.lower().encode("utf-8")])[0])
 
     def predict(self, text: Union[str, List[str]]) -> float:
         if isinstance(text, str):
-            text = text_to_words(text).split()
-
-        log_prob = sum(self.log_p(word) / len(text) for word in text)
-        return log_prob
+            # Lowercasing the space joined words is the same as lowercasing each one.
+            text = text_to_words(text).lower().split()
+        else:
+            text = [word.lower() for word in text]
+        words = [word.encode("utf-8") for word in text]
+        if not words:
+            return 0
+        return float(self.log_ps(words).sum() / len(words))
 
 
 @add_tagger("perplexity_tagger")
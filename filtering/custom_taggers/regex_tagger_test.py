@@ -0,0 +1,145 @@
+"""Tests that the regex taggers tag the same spans as the original per-pattern taggers."""
+
+import os
+import random
+import re
+import sys
+
+import pytest
+from dolma.core.data_types import Document
+from dolma.core.utils import import_modules, split_paragraphs
+
+# Import it the way dolma does, so the taggers are only registered once.
+import_modules(
+    [os.path.join(os.path.dirname(os.path.abspath(__file__)), "regex_tagger.py")]
+)
+regex_tagger = sys.modules["regex_tagger"]
+
+
+def reference_document_spans(patterns, text):
+    """The original RegexDocumentTagger, a finditer per pattern."""
+    return [
+        (m.start(), m.end(), "regex") for p in patterns for m in re.finditer(p, text)
+    ]
+
+
+def reference_paragraph_spans(patterns, text):
+    """The original RegexTagger, a span for each paragraph that any pattern matches."""
+    return [
+        (unit.start, unit.end, "regex")
+        for unit in split_paragraphs(text)
+        if any(re.match(p, unit.text) for p in patterns)
+    ]
+
+
+def spans(tagger, text):
+    result = tagger.predict(Document(source="test", id="0", text=text))
+    return [(s.start, s.end, s.type) for s in result.spans]
+
+
+def random_texts(count=300, seed=0):
+    rng = random.Random(seed)
+    pieces = [
+        " ",
+        "  ",
+        "\n",
+        "\n\n",
+        "12",
+        "[[Page 3]]",
+        "[[Page iv]]",
+        "ab",
+        "bc",
+        "cd",
+        "word",
+    ]
+    for _ in range(count):
+        yield "".join(rng.choices(pieces, k=rng.randint(0, 30)))
+
+
+def test_overlapping_patterns():
+    assert spans(regex_tagger.RegexDocumentTagger(["ab", "bc"]), "abc") == [
+        (0, 2, "regex"),
+        (1, 3, "regex"),
+    ]
+    tagger = regex_tagger.RegexDocumentTagger({"x": ["ab"], "y": ["bc", "b"]})
+    assert spans(tagger, "abcab") == [
+        (0, 2, "x"),
+        (3, 5, "x"),
+        (1, 3, "y"),
+        (1, 2, "y"),
+        (4, 5, "y"),
+    ]
+
+
+@pytest.mark.parametrize(
+    "patterns,expected",
+    [
+        (["  ", "\n\n"], True),
+        (["ab", "cd", "\n\n"], True),
+        # A suffix of one is a prefix of the other.
+        (["ab", "bc"], False),
+        (["abc", "b"], False),
+        (["ab", "ab"], False),
+        (["ab", "a+"], False),
+        (["ab", ""], False),
+    ],
+)
+def test_disjoint(patterns, expected):
+    assert regex_tagger.disjoint(patterns) == expected
+
+
+@pytest.mark.parametrize(
+    "patterns",
+    [
+        {"x": ["ab"], "y": ["cd", "\n\n"]},
+        {"x": ["  "], "y": ["\n\n"]},
+        # These overlap, so they are scanned once per pattern.
+        {"x": ["ab", "bc"], "y": ["b"]},
+    ],
+)
+def test_typed_document_spans(patterns):
+    tagger = regex_tagger.RegexDocumentTagger(patterns)
+    assert tagger.engine.single_scan == regex_tagger.disjoint(
+        [p for ps in patterns.values() for p in ps]
+    )
+    for text in random_texts():
+        expected = [
+            (m.start(), m.end(), t)
+            for t, ps in patterns.items()
+            for p in ps
+            for m in re.finditer(p, text)
+        ]
+        assert spans(tagger, text) == expected
+
+
+def test_paragraph_types():
+    tagger = regex_tagger.RegexTagger({"x": [r"\d"], "y": ["a", r"\d+$"]})
+    assert spans(tagger, "12\na\nb") == [(0, 3, "x"), (0, 3, "y"), (3, 5, "y")]
+
+
+@pytest.mark.parametrize("name", sorted(regex_tagger.REGEX_TAGGERS))
+def test_matches_reference(name):
+    cls = regex_tagger.REGEX_TAGGERS[name]
+    tagger = cls()
+    reference = (
+        reference_document_spans
+        if issubclass(cls, regex_tagger.RegexDocumentTagger)
+        else reference_paragraph_spans
+    )
+    for text in random_texts():
+        assert spans(tagger, text) == reference(cls.PATTERNS, text)
+
+
+def test_combined():
+    names = ["usgpo_regex_tagger", "double_space_tagger", "double_newline_tagger"]
+    combined = regex_tagger.CombinedRegexTagger(names)
+    # The whitespace taggers share one scan of the document.
+    assert combined.document_tagger.engine.single_scan
+    for text in random_texts():
+        expected = []
+        for name in names[1:] + names[:1]:
+            expected.extend(
+                (start, end, name)
+                for start, end, _ in spans(regex_tagger.REGEX_TAGGERS[name](), text)
+            )
+        assert spans(combined, text) == expected
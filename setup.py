@@ -68,6 +68,9 @@ setup(
         "console_scripts": [
             "size-stats-dolma = common_pile.scripts.stats:main",
             "remove-none-dolma = common_pile.scripts.remove_none:main",
+            "tag-dolma = common_pile.scripts.tag:main",
+            "mix-dolma = common_pile.scripts.mix:main",
+            "columnar-attributes-dolma = common_pile.scripts.columnar_attributes:main",
         ]
     },
 )
@@ -1,3 +1,4 @@
+import pylatexenc
 import pylatexenc.latex2text
 import os
 import re
@@ -5,6 +6,8 @@ import signal
 from charset_normalizer import from_bytes
 from pylatexenc.macrospec import ParsedMacroArgs
 
+from common_pile.cache import memoize
+
 # Custom handler for the \href macro to prevent crashes
 def href_simplify_repl(node: ParsedMacroArgs, l2tobj: pylatexenc.latex2text.LatexNodes2Text):
     """
@@ -137,6 +140,16 @@ def timeout_handler(signum, frame):
 signal.signal(signal.SIGALRM, timeout_handler)
 
 
+# Bump the version when the overrides in l2t_db change so cached text is redone.
+@memoize(
+    "pylatexenc-latex2text",
+    version=f"{pylatexenc.__version__}-1",
+    config={"math_mode": "verbatim"},
+)
+def latex_to_text(latex):
+    return pylatexenc.latex2text.LatexNodes2Text(math_mode="verbatim", latex_context=l2t_db).latex_to_text(latex)
+
+
 def extract_text_from_latex(latex_filename):
     base_dir = os.path.dirname(latex_filename)
     latex = read_file_content(latex_filename)
@@ -157,7 +170,7 @@ def extract_text_from_latex(latex_filename):
     # Set an alarm for 60 seconds
     signal.alarm(60)
     try:
-        text = pylatexenc.latex2text.LatexNodes2Text(math_mode="verbatim", latex_context=l2t_db).latex_to_text(latex)
+        text = latex_to_text(latex)
     except TimeoutException:
         print(f"WARNING: Timeout parsing {latex_filename}")
     except Exception:
@@ -0,0 +1,155 @@
+"""A compact, precompiled matcher for domain, subdomain, and path-prefix rules.
+
+Rules are written one per line:
+
+    example.com           # example.com and www.example.com
+    *.example.com         # example.com and any subdomain of it
+    example.com/wiki/     # only urls on example.com whose path starts with /wiki/
+
+A leading `www.` is ignored on both rules and urls, which matches how the
+original filter added both `www.` and bare versions of every domain. Unlike
+the original filter, which compared the exact netloc, hosts are also matched
+without their case, port, or credentials, so `http://User@Example.com:8080/`
+matches `example.com`.
+
+The rules are compiled into a sorted, newline delimited file of
+`reversed-host<TAB>kind<TAB>path-prefixes` entries (`com.example	*	`) that is
+memory mapped and binary searched. Each worker maps the same file, so the rule
+set is shared through the page cache instead of being pickled into every task.
+"""
+
+import collections
+import functools
+import mmap
+import os
+import re
+from typing import Dict, Iterable, List, Optional, Tuple
+
+EXACT = "="
+SUBDOMAINS = "*"
+
+# The host ends at the first /, ? or #, and the path at the first ? or #.
+HOST_AND_PATH = re.compile(r"([^/?#]*)([^?#]*)")
+
+
+def normalize_host(host: str) -> str:
+    host = host.strip().lower().rstrip(".")
+    # Drop the port and any credentials.
+    host = host.rsplit("@", 1)[-1].split(":", 1)[0]
+    if host.startswith("www."):
+        host = host[len("www.") :]
+    return host
+
+
+def reverse_host(host: str) -> str:
+    return ".".join(reversed(host.split(".")))
+
+
+def parse_rule(rule: str) -> Optional[Tuple[str, str, str]]:
+    """Convert a rule line into (reversed host, kind, path prefix)."""
+    rule = rule.split("#", 1)[0].strip()
+    if not rule:
+        return None
+    if "://" in rule:
+        rule = rule.split("://", 1)[1]
+    host, slash, path = rule.partition("/")
+    kind = EXACT
+    if host.startswith("*."):
+        kind = SUBDOMAINS
+        host = host[len("*.") :]
+    elif host.startswith("."):
+        kind = SUBDOMAINS
+        host = host[len(".") :]
+    return reverse_host(normalize_host(host)), kind, f"{slash}{path}"
+
+
+def compile_rules(rules: Iterable[str], output_path: str) -> str:
+    """Compile rule lines into the sorted on-disk format used by `DomainMatcher`."""
+    entries: Dict[Tuple[str, str], set] = collections.defaultdict(set)
+    for rule in rules:
+        if (parsed := parse_rule(rule)) is None:
+            continue
+        key, kind, path = parsed
+        entries[(key, kind)].add(path)
+    tmp_path = f"{output_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as wf:
+        for (key, kind), paths in sorted(entries.items()):
+            # A rule with no path matches the whole host, so it subsumes any prefixes.
+            paths = "" if "" in paths else " ".join(sorted(paths))
+            wf.write(f"{key}\t{kind}\t{paths}\n")
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+def compile_rules_file(rules_path: str, output_path: Optional[str] = None) -> str:
+    output_path = (
+        output_path if output_path is not None else f"{rules_path}.domain_index"
+    )
+    with open(rules_path, encoding="utf-8") as f:
+        return compile_rules(f, output_path)
+
+
+class DomainMatcher:
+    """Binary search over the mmapped, sorted rule file."""
+
+    def __init__(self, index_path: str):
+        self.index_path = index_path
+        with open(index_path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                self.data = b""
+            else:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # Hits per matched rule (the bare host of the rule).
+        self.counts = collections.Counter()
+
+    def _line_start(self, pos: int) -> int:
+        return self.data.rfind(b"\n", 0, pos) + 1
+
+    def _lookup(self, key: str) -> List[Tuple[str, str]]:
+        """Return the (kind, paths) entries for an exact reversed host."""
+        target = key.encode("utf-8") + b"\t"
+        lo, hi = 0, len(self.data)
+        # Find the first line whose key is >= target.
+        while lo < hi:
+            mid = self._line_start((lo + hi) // 2)
+            end = self.data.find(b"\n", mid)
+            if self.data[mid:end] < target:
+                lo = end + 1
+            else:
+                hi = mid
+        results = []
+        while self.data[lo : lo + len(target)] == target:
+            end = self.data.find(b"\n", lo)
+            _, kind, paths = self.data[lo:end].decode("utf-8").split("\t")
+            results.append((kind, paths))
+            lo = end + 1
+        return results
+
+    def match(self, host: str, path: str = "/") -> Optional[str]:
+        """Return the matching rule's host if this host/path is covered, otherwise None."""
+        if not self.data:
+            return None
+        labels = normalize_host(host).split(".")
+        path = path or "/"
+        # Walk from the top level domain down, i.e. com, example.com, www.example.com
+        for i in range(len(labels) - 1, -1, -1):
+            rule_host = ".".join(labels[i:])
+            for kind, paths in self._lookup(reverse_host(rule_host)):
+                if kind == EXACT and i != 0:
+                    continue
+                if not paths or any(path.startswith(p) for p in paths.split(" ")):
+                    self.counts[rule_host] += 1
+                    return rule_host
+        return None
+
+    def match_url(self, url: str) -> Optional[str]:
+        # This is cheaper than urlparse, and we only need the host and path.
+        _, _, rest = url.partition("://")
+        host, path = HOST_AND_PATH.match(rest or url).groups()
+        return self.match(host, path)
+
+
+@functools.lru_cache(maxsize=None)
+def load_matcher(index_path: str) -> DomainMatcher:
+    """Load a matcher once per process."""
+    return DomainMatcher(index_path)
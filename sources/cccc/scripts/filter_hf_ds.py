@@ -1,8 +1,13 @@
 import argparse
+import collections
+import glob
+import json
 import os
 from pathlib import Path
+from queue import Queue
 from tempfile import TemporaryDirectory
-from urllib.parse import urlparse
+
+from domain_matcher import compile_rules_file, load_matcher
 
 from common_pile import logs
 from common_pile.write import ShardParallelProcessor
@@ -18,30 +23,35 @@ logger = logs.get_logger("CC")
 class ShardCCProcessor(ShardParallelProcessor):
     @classmethod
     def process_example(cls, example: dict, **kwargs) -> dict | None:
-        return example if filter_condition(example, kwargs["urls"]) else None
-
-
-def read_file_to_list(file_path: str) -> list[str]:
-    res = []
-    with open(file_path, "r") as file:
-        urls = [line.strip() for line in file]
-    for x in urls:
-        if x.startswith("www."):
-            res.append(x.removeprefix("www."))
-        else:
-            res.append("www." + x)
-        res.append(x)
+        matcher = load_matcher(kwargs["urls_index"])
+        return example if filter_condition(example, matcher) else None
 
-    return res
+    @classmethod
+    def process_single(
+        cls, source_path: str, destination_path: str, queue: Queue, **kwargs
+    ):
+        matcher = load_matcher(kwargs["urls_index"])
+        matcher.counts.clear()
+        super().process_single(source_path, destination_path, queue, **kwargs)
+        # Each shard records its own per-domain counts, main() sums them up.
+        counts_path = os.path.join(
+            kwargs["counts_dir"], f"{source_path.replace('/', '_')}.json"
+        )
+        with open(counts_path, "w") as wf:
+            json.dump(matcher.counts, wf)
 
 
-def extract_suburls(url: str) -> str:
-    return urlparse(url).netloc
+def filter_condition(item: dict, matcher) -> bool:
+    """Filters the data to only include the URLs matched by the urls.txt rules"""
+    return matcher.match_url(item["metadata"]["warc_url"]) is not None
 
 
-def filter_condition(item: dict, urls: set) -> bool:
-    """Filters the data to only include the URLs in the urls.txt file"""
-    return extract_suburls(item["metadata"]["warc_url"]) in urls
+def merge_counts(counts_dir: str) -> collections.Counter:
+    counts = collections.Counter()
+    for path in glob.glob(os.path.join(counts_dir, "*.json")):
+        with open(path) as f:
+            counts.update(json.load(f))
+    return counts
 
 
 def setup_argparser() -> argparse.ArgumentParser:
@@ -52,7 +62,15 @@ def setup_argparser() -> argparse.ArgumentParser:
         "--urls-file",
         type=str,
         required=True,
-        help="Path to the newline delimited textfile containing URLs to keep.",
+        help="Path to the newline delimited textfile containing URLs to keep. "
+        "Lines can be a domain (example.com), a domain and its subdomains "
+        "(*.example.com), or a domain and path prefix (example.com/wiki/). "
+        "Hosts are matched ignoring case, a leading www., and any port.",
+    )
+    parser.add_argument(
+        "--counts-file",
+        type=str,
+        help="Where to write the number of kept documents per domain, defaults to ${dest_dir}/domain_counts.json",
     )
     parser.add_argument(
         "--source-dir",
@@ -83,19 +101,36 @@ def setup_argparser() -> argparse.ArgumentParser:
 def main():
     args = setup_argparser().parse_args()
 
-    URLS = set(read_file_to_list(args.urls_file))
     source_dir = Path(args.source_dir)
     dest_dir = Path(args.dest_dir)
     num_processes = args.num_processes
+    counts_file = (
+        args.counts_file
+        if args.counts_file is not None
+        else str(dest_dir / "domain_counts.json")
+    )
 
     with TemporaryDirectory() as tempdir:
+        # Compile the rules once, workers mmap the result instead of getting
+        # a copy of the url set pickled into each of their tasks.
+        urls_index = compile_rules_file(
+            args.urls_file, os.path.join(tempdir, "urls.domain_index")
+        )
+        counts_dir = os.path.join(tempdir, "counts")
+        os.makedirs(counts_dir)
         processor = ShardCCProcessor(
             source_prefix=str(source_dir / "*" / "*.json.gz"),
             destination_prefix=str(dest_dir),
-            metadata_prefix=tempdir,
+            metadata_prefix=os.path.join(tempdir, "meta"),
             num_processes=num_processes,
         )
-        processor(debug=args.debug, urls=URLS)
+        processor(debug=args.debug, urls_index=urls_index, counts_dir=counts_dir)
+        counts = merge_counts(counts_dir)
+
+    os.makedirs(os.path.dirname(counts_file) or ".", exist_ok=True)
+    with open(counts_file, "w") as wf:
+        json.dump(dict(counts.most_common()), wf, indent=2)
+    logger.info("Kept documents from %d domains, see %s", len(counts), counts_file)
 
 
 if __name__ == "__main__":
@@ -5,17 +5,17 @@ preparing for dolma, in this file.
 """
 
 import argparse
+import ast
+import csv
+import dataclasses
 import functools
-import glob
 import gzip
-import itertools
 import json
+import multiprocessing as mp
 import os
-import re
 from datetime import datetime
+from typing import Dict, Iterator, List, Set, Tuple
 
-import jsonlines
-import pandas as pd
 from constants import HF_MAPPING
 from tqdm import tqdm
 
@@ -63,23 +63,24 @@ parser.add_argument(
 parser.add_argument(
     "--shard_size", type=int, default=1, help="Size, in GB, for each shard."
 )
+parser.add_argument(
+    "--processes",
+    type=int,
+    default=mp.cpu_count(),
+    help="Number of input files to convert in parallel.",
+)
 
 SOURCE_NAME = "Data Provenance Initiative"
 
 
-def unique_dpi_dataset_names(folder_path):
-    unique_doc_ids = set()
-
-    jsonl_paths = os.path.join(folder_path, "**/*.jsonl.gz")
-    jsonl_files = glob.glob(jsonl_paths, recursive=True)
+@dataclasses.dataclass(frozen=True)
+class DatasetInfo:
+    """The metadata from include.csv that is attached to each example."""
 
-    for file_path in tqdm(jsonl_files, desc="Processing files"):
-        with gzip.open(file_path, "rt") as f:
-            for line in f:
-                data = json.loads(line)
-                doc_id = data["metadata"]["dataset_id"]
-                unique_doc_ids.add(doc_id)
-    return unique_doc_ids
+    licenses: List[str]
+    license_url: str
+    languages: List[str]
+    url: str
 
 
 def listdir_nohidden(path):
@@ -91,80 +92,101 @@ def listdir_nohidden(path):
     return [os.path.join(path, f) for f in os.listdir(path) if not f.startswith(".")]
 
 
-def read_jsonl_gz(inpath: str):
+def iterate_jsonl_gz(inpath: str) -> Iterator[Dict]:
     with gzip.open(inpath, "rb") as fp:
-        return [json.loads(l) for l in fp]
+        for line in fp:
+            yield json.loads(line)
 
 
-def extract_licenses(license_list, gh_license):
+def extract_licenses(license_list: List[Dict[str, str]], gh_license: str) -> List[str]:
     license_set = set()
-    for license_dict in eval(license_list):
+    for license_dict in license_list:
         if license_dict["License"] != "Unspecified":
             license_set.add(str(LICENSE_MAPPER[license_dict["License"]]))
     if gh_license:
         license_set = list(license_set) + [str(LICENSE_MAPPER[gh_license])]
-    return license_set
-
-
-def file_to_dolma(path: str, include_df: str, source_name: str = SOURCE_NAME):
+    return sorted(license_set)
+
+
+def load_include(path: str) -> Dict[str, DatasetInfo]:
+    """Parse include.csv once into a lookup from dataset id to its metadata.
+
+    The list columns are python literals, so they are parsed with `literal_eval`
+    instead of `eval`.
+    """
+    dataset_info = {}
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            licenses = ast.literal_eval(row["Licenses"]) if row["Licenses"] else []
+            dataset_info[row["Dataset ID"]] = DatasetInfo(
+                licenses=extract_licenses(licenses, row["GitHub License"]),
+                # When a dataset has multiple licenses, the last url is used.
+                license_url=licenses[-1]["License URL"] if licenses else "",
+                languages=(
+                    ast.literal_eval(row["Languages"]) if row["Languages"] else []
+                ),
+                url=row["Dataset URL"],
+            )
+    return dataset_info
+
+
+def file_to_dolma(
+    path: str,
+    dataset_info: Dict[str, DatasetInfo],
+    seen: Set[str],
+    source_name: str = SOURCE_NAME,
+) -> Iterator[Dict]:
     logger = get_logger()
     logger.info(f"Converting {path} to the dolma format.")
 
-    valid_ids = set(include_df["Dataset ID"])
-
-    dset_to_licenses = {
-        row["Dataset ID"]: extract_licenses(row["Licenses"], row["GitHub License"])
-        for _, row in include_df.iterrows()
-    }
-    dset_to_license_urls = {
-        row["Dataset ID"]: entry["License URL"]
-        for _, row in include_df.iterrows()
-        for entry in eval(row["Licenses"])
-    }
-    dset_to_langs = {
-        row["Dataset ID"]: eval(row["Languages"]) for _, row in include_df.iterrows()
-    }
-    dset_to_urls = {
-        row["Dataset ID"]: row["Dataset URL"] for _, row in include_df.iterrows()
-    }
-
-    dset_collection = read_jsonl_gz(path)
-
-    results = []
-    for i, ex in enumerate(dset_collection):
+    for i, ex in enumerate(iterate_jsonl_gz(path)):
         dataset_id = ex["dataset"]
 
         assert (
-            dataset_id in valid_ids
+            dataset_id in dataset_info
         ), f"Dataset ID '{dataset_id}' not found in include.csv"
-
-        license_names = dset_to_licenses[dataset_id]
-        langs = dset_to_langs[dataset_id]
-        url = dset_to_urls[dataset_id]
-        license_urls = dset_to_license_urls[dataset_id]
+        info = dataset_info[dataset_id]
+        seen.add(dataset_id)
 
         input_text = ex["inputs"]
         target_text = ex.get("labels", ex.get("targets", ""))
         # If target_text isn't found, the strip will remove the extra newline
         text = f"{input_text}\n{target_text}".strip()
-        results.append(
-            {
-                "id": f"{ex['dataset']}-{i}",
-                "text": text,
-                "source": source_name,
-                "added": datetime.utcnow().isoformat(),
-                "metadata": {
-                    "license": sorted(license_names),
-                    "license_url": license_urls,
-                    "language": langs,
-                    "url": url,
-                    "dataset_id": dataset_id,
-                    "response": target_text,
-                },
-            }
-        )
-
-    return results
+        yield {
+            "id": f"{ex['dataset']}-{i}",
+            "text": text,
+            "source": source_name,
+            "added": datetime.utcnow().isoformat(),
+            "metadata": {
+                "license": info.licenses,
+                "license_url": info.license_url,
+                "language": info.languages,
+                "url": info.url,
+                "dataset_id": dataset_id,
+                "response": target_text,
+            },
+        }
+
+
+def convert_file(
+    path: str,
+    dataset_info: Dict[str, DatasetInfo],
+    outdir: str,
+    filename: str,
+    shard_size: int,
+) -> Tuple[str, Set[str]]:
+    """Convert a single input file into its own dolma shards, returns the dataset ids seen."""
+    seen = set()
+    # Each input file gets its own shard names so workers don't clobber each other.
+    stem = os.path.basename(path).split(".")[0]
+    to_dolma(
+        file_to_dolma(path, dataset_info, seen),
+        outdir,
+        f"{stem}.{filename}",
+        shard_size,
+        quiet=True,
+    )
+    return path, seen
 
 
 def main(args):
@@ -172,17 +194,28 @@ def main(args):
 
     os.makedirs(args.outdir, exist_ok=True)
 
-    include_df = pd.read_csv(args.include).fillna("")
+    dataset_info = load_include(args.include)
 
     paths = listdir_nohidden(args.indir)
-    examples = itertools.chain(
-        *(file_to_dolma(path, include_df=include_df) for path in paths)
+    if not paths:
+        logger.warning(f"No files to convert in {args.indir}")
+        return
+    convert = functools.partial(
+        convert_file,
+        dataset_info=dataset_info,
+        outdir=args.outdir,
+        filename=args.filename,
+        shard_size=args.shard_size,
     )
-    to_dolma(examples, args.outdir, args.filename, args.shard_size)
-
-    valid_dpi_ids = set(include_df["Dataset ID"])
-    unique_dpi_ids = unique_dpi_dataset_names(args.outdir)
-    unseen_dpi_ids = valid_dpi_ids - unique_dpi_ids
+    unique_dpi_ids = set()
+    with mp.Pool(min(args.processes, len(paths))) as pool:
+        for path, seen in tqdm(
+            pool.imap_unordered(convert, paths), total=len(paths), desc="Files"
+        ):
+            logger.info(f"Finished {path}, {len(seen)} datasets")
+            unique_dpi_ids |= seen
+
+    unseen_dpi_ids = set(dataset_info) - unique_dpi_ids
     logger.info(f"Unseen Datasets: {len(unseen_dpi_ids)} | {unseen_dpi_ids}")
     logger.info(f"Total Unique Datasets: {len(unique_dpi_ids)}")
 
@@ -1,6 +1,13 @@
+"""Keep books whose head or tail contains an explicit permissive license statement."""
+
 import argparse
+import collections
+import functools
+import json
+import multiprocessing as mp
 import os
 import shutil
+from typing import Dict, List, Optional, Sequence, Tuple
 
 from tqdm import tqdm
 
@@ -54,40 +61,172 @@ parser = argparse.ArgumentParser(
 )
 parser.add_argument("--input-files", nargs="+", help="Input files")
 parser.add_argument("--output-dir", type=str, help="Path to the output directory")
-args = parser.parse_args()
+parser.add_argument(
+    "--report",
+    help="Where to write the JSON report of matches, defaults to ${output_dir}/cc_filter_report.json",
+)
+parser.add_argument(
+    "--window-fraction",
+    type=float,
+    default=0.05,
+    help="Fraction of the file (in bytes) to search at both the head and the tail.",
+)
+parser.add_argument(
+    "--min-window-bytes",
+    type=int,
+    default=16_384,
+    help="Minimum number of bytes to search at both the head and the tail.",
+)
+parser.add_argument(
+    "--num-workers", type=int, default=mp.cpu_count(), help="Number of processes."
+)
 
 
-os.makedirs(args.output_dir, exist_ok=True)
+class KeywordAutomaton:
+    """Aho-Corasick automaton that finds the first of many keywords in one pass."""
 
-copied_files = 0
-pbar = tqdm(args.input_files)
-for file in pbar:
-    basename = os.path.basename(file)
-    id = os.path.splitext(basename)[0]
+    def __init__(self, keywords: Sequence[str]):
+        self.keywords = list(keywords)
+        # Each state is a dict of char -> next state. State 0 is the root.
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        # The keyword indices that end at each state, includes the ones inherited
+        # from the failure links so we don't need to walk them while scanning.
+        self.output: List[List[int]] = [[]]
+        for i, keyword in enumerate(self.keywords):
+            self._add(keyword, i)
+        self._build_failure_links()
+
+    def _add(self, keyword: str, idx: int):
+        state = 0
+        for char in keyword:
+            if char not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+                self.goto[state][char] = len(self.goto) - 1
+            state = self.goto[state][char]
+        self.output[state].append(idx)
+
+    def _build_failure_links(self):
+        queue = collections.deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, nxt in self.goto[state].items():
+                queue.append(nxt)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                fail = self.goto[fail].get(char, 0)
+                # Children of the root fail back to the root, not to themselves.
+                self.fail[nxt] = fail if fail != nxt else 0
+                self.output[nxt].extend(self.output[self.fail[nxt]])
 
-    output_path = os.path.join(args.output_dir, id[:2], basename)
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    def search(self, text: str) -> Optional[Tuple[str, int]]:
+        """Return the first (keyword, start offset) found in text, or None."""
+        goto, fail, output = self.goto, self.fail, self.output
+        state = 0
+        for i, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                keyword = self.keywords[output[state][0]]
+                return keyword, i - len(keyword) + 1
+        return None
 
+
+AUTOMATON = KeywordAutomaton(CC_KEYWORDS)
+
+
+def read_head_and_tail(
+    path: str, window_fraction: float, min_window_bytes: int
+) -> Tuple[str, str, int]:
+    """Read only the start and end of a file, returns (head, tail, tail_offset).
+
+    If the windows overlap the whole file is returned as the head and the tail
+    is empty so a keyword can't be missed at the seam.
+    """
+    size = os.path.getsize(path)
+    window = max(int(size * window_fraction), min_window_bytes)
+    with open(path, "rb") as f:
+        if 2 * window >= size:
+            return f.read().decode("utf-8", "ignore"), "", size
+        head = f.read(window)
+        f.seek(size - window)
+        tail = f.read(window)
+    # Windows can split a multi-byte character, just drop the partial bytes.
+    return head.decode("utf-8", "ignore"), tail.decode("utf-8", "ignore"), size - window
+
+
+def check_file(
+    path: str, window_fraction: float = 0.05, min_window_bytes: int = 16_384
+) -> Dict:
+    """Search a single book for a license statement, returns a report entry."""
+    basename = os.path.basename(path)
+    id = os.path.splitext(basename)[0]
     if id in WHITELIST_IDS:
-        shutil.copy(file, output_path)
-        copied_files += 1
-        continue
+        return {"id": id, "path": path, "match": "whitelist"}
+    head, tail, tail_offset = read_head_and_tail(
+        path, window_fraction, min_window_bytes
+    )
+    if found := AUTOMATON.search(head):
+        keyword, offset = found
+        return {
+            "id": id,
+            "path": path,
+            "match": keyword,
+            "region": "head",
+            "offset": offset,
+        }
+    if found := AUTOMATON.search(tail):
+        keyword, offset = found
+        # The offset in the tail is in characters, so the absolute position is approximate.
+        return {
+            "id": id,
+            "path": path,
+            "match": keyword,
+            "region": "tail",
+            "offset": tail_offset + offset,
+        }
+    return {"id": id, "path": path, "match": None}
+
 
-    with open(file, "r") as f:
-        lines = f.readlines()
-        text = "\n".join(lines)
+def main(args):
+    os.makedirs(args.output_dir, exist_ok=True)
+    report_path = (
+        args.report
+        if args.report is not None
+        else os.path.join(args.output_dir, "cc_filter_report.json")
+    )
 
-    line_idx = max(len(lines) // 20, 150)
-    start_and_end_lines = "\n".join(lines[:line_idx] + lines[-line_idx:])
+    report = {}
+    copied_files = 0
+    check = functools.partial(
+        check_file,
+        window_fraction=args.window_fraction,
+        min_window_bytes=args.min_window_bytes,
+    )
+    with mp.Pool(args.num_workers) as pool:
+        pbar = tqdm(
+            pool.imap_unordered(check, args.input_files, chunksize=16),
+            total=len(args.input_files),
+        )
+        for result in pbar:
+            report[result["id"]] = result
+            if result["match"] is None:
+                continue
+            basename = os.path.basename(result["path"])
+            output_path = os.path.join(args.output_dir, result["id"][:2], basename)
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            shutil.copy(result["path"], output_path)
+            copied_files += 1
+            pbar.set_description(f"Copied {copied_files} files")
 
-    found = False
-    for keyword in CC_KEYWORDS:
-        if keyword in start_and_end_lines:
-            found = True
-            break
+    with open(report_path, "w") as wf:
+        json.dump(report, wf, indent=2)
 
-    if found:
-        shutil.copy(file, output_path)
-        copied_files += 1
 
-    pbar.set_description(f"Copied {copied_files} files")
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args)
@@ -10,13 +10,19 @@ os.environ["IN_STREAMLIT"] = "true"  # Avoid multiprocessing inside surya
 
 
 import argparse
+import functools
 import gc
 import glob
 import hashlib
+import importlib.metadata
+import json
 import math
+import time
 import traceback
+import unicodedata
 
 import magic
+import pypdfium2 as pdfium
 import torch.multiprocessing as mp
 from marker.config.parser import ConfigParser
 from marker.config.printer import CustomClickPrinter
@@ -26,6 +32,8 @@ from marker.output import output_exists, save_output
 from marker.settings import settings
 from tqdm import tqdm
 
+from common_pile.cache import memoize
+
 configure_logging()
 
 
@@ -53,32 +61,50 @@ def worker_exit():
         pass
 
 
-def process_single_pdf(fpath):
-    config = {
-        "output_format": "markdown",
-        "disable_image_extraction": True,
-        "disable_links": True,
-        "disable_multiprocessing": True,
-    }
-    config_parser = ConfigParser(config)
+MARKER_CONFIG = {
+    "output_format": "markdown",
+    "disable_image_extraction": True,
+    "disable_links": True,
+    "disable_multiprocessing": True,
+}
+
+
+def read_bytes(fpath):
+    with open(fpath, "rb") as f:
+        return f.read()
+
+
+@memoize(
+    "marker-pdf-markdown",
+    version=functools.partial(importlib.metadata.version, "marker-pdf"),
+    config=MARKER_CONFIG,
+    key_fn=read_bytes,
+)
+def convert_pdf(fpath):
+    config_parser = ConfigParser(MARKER_CONFIG)
 
     converter_cls = config_parser.get_converter_cls()
     config_dict = config_parser.generate_config_dict()
     config_dict["disable_tqdm"] = True
 
-    try:
-        converter = converter_cls(
-            config=config_dict,
-            artifact_dict=model_refs,
-            processor_list=config_parser.get_processors(),
-            renderer=config_parser.get_renderer(),
-            llm_service=config_parser.get_llm_service(),
-        )
-        rendered = converter(fpath)
-        markdown = rendered.markdown
+    converter = converter_cls(
+        config=config_dict,
+        artifact_dict=model_refs,
+        processor_list=config_parser.get_processors(),
+        renderer=config_parser.get_renderer(),
+        llm_service=config_parser.get_llm_service(),
+    )
+    rendered = converter(fpath)
+    markdown = rendered.markdown
 
-        del rendered
-        del converter
+    del rendered
+    del converter
+    return markdown
+
+
+def process_single_pdf(fpath):
+    try:
+        markdown = convert_pdf(fpath)
     except Exception as e:
         print(f"Error converting {fpath}: {e}")
         print(traceback.format_exc())
@@ -89,6 +115,76 @@ def process_single_pdf(fpath):
     return markdown, fpath
 
 
+def text_layer_quality(pages):
+    """Score the embedded text of a PDF, returns (page coverage, garbage ratio, chars per page).
+
+    Page coverage is the fraction of pages with a non-trivial amount of text and
+    the garbage ratio is the fraction of non-whitespace characters that are
+    replacement/private use/control characters, which is what broken font
+    encodings and OCR-less scans tend to produce.
+    """
+    if not pages:
+        return 0.0, 1.0, 0.0
+    covered = sum(len(p.strip()) >= 200 for p in pages)
+    total = 0
+    garbage = 0
+    for page in pages:
+        for char in page:
+            if char.isspace():
+                continue
+            total += 1
+            if char == "\ufffd" or unicodedata.category(char) in ("Co", "Cc", "Cs"):
+                garbage += 1
+    return covered / len(pages), garbage / max(total, 1), total / len(pages)
+
+
+def triage_pdf(
+    fpath, min_page_coverage=0.8, max_garbage_ratio=0.01, min_chars_per_page=500
+):
+    """Extract the embedded text layer and decide if the PDF needs to go to marker.
+
+    Returns the text (None when marker is needed) and a record of the decision.
+    """
+    start = time.perf_counter()
+    record = {"path": fpath}
+    try:
+        pdf = pdfium.PdfDocument(fpath)
+        try:
+            pages = []
+            for page in pdf:
+                textpage = page.get_textpage()
+                pages.append(textpage.get_text_range())
+                textpage.close()
+                page.close()
+        finally:
+            pdf.close()
+        coverage, garbage_ratio, chars_per_page = text_layer_quality(pages)
+        record.update(
+            pages=len(pages),
+            coverage=coverage,
+            garbage_ratio=garbage_ratio,
+            chars_per_page=chars_per_page,
+        )
+        if (
+            coverage >= min_page_coverage
+            and garbage_ratio <= max_garbage_ratio
+            and chars_per_page >= min_chars_per_page
+        ):
+            record["decision"] = "text_layer"
+            # pdfium uses \r\n line endings.
+            text = "\n\n".join(p.replace("\r\n", "\n").strip() for p in pages)
+        else:
+            record["decision"] = "marker"
+            text = None
+    except Exception as e:
+        print(f"Error reading text layer of {fpath}: {e}")
+        record["decision"] = "marker"
+        record["error"] = str(e)
+        text = None
+    record["triage_seconds"] = time.perf_counter() - start
+    return text, record
+
+
 def get_output_path(fpath, output_dir):
     base_name = os.path.basename(fpath)
     id = os.path.splitext(base_name)[0]
@@ -99,6 +195,13 @@ def output_exists(fpath, output_dir):
     return os.path.exists(get_output_path(fpath, output_dir))
 
 
+def write_output(text, fpath, output_dir):
+    output_path = get_output_path(fpath, output_dir)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with open(output_path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+
 def get_slice(f, num_slices):
     return int(hashlib.sha256(f.encode("utf-8")).hexdigest(), 16) % num_slices
 
@@ -110,6 +213,12 @@ def main(
     num_slices,
     device="cuda:0",
     num_workers=5,
+    triage=True,
+    triage_workers=None,
+    triage_log=None,
+    min_page_coverage=0.8,
+    max_garbage_ratio=0.01,
+    min_chars_per_page=500,
     **kwargs,
 ):
     os.makedirs(output_dir, exist_ok=True)
@@ -127,6 +236,46 @@ def main(
             "Set start method to spawn twice. This may be a temporary issue with the script. Please try running it again."
         )
 
+    total_bytes_written = 0
+    num_errors = 0
+    if triage:
+        # Born-digital PDFs have a usable text layer, only send scans and PDFs
+        # with broken text to marker's (slow on CPU) models.
+        triage_log = (
+            triage_log
+            if triage_log is not None
+            else os.path.join(output_dir, f"triage-{slice_idx}.jsonl")
+        )
+        triage_fn = functools.partial(
+            triage_pdf,
+            min_page_coverage=min_page_coverage,
+            max_garbage_ratio=max_garbage_ratio,
+            min_chars_per_page=min_chars_per_page,
+        )
+        needs_marker = []
+        triage_start = time.perf_counter()
+        with mp.Pool(processes=triage_workers or mp.cpu_count()) as pool, open(
+            triage_log, "a"
+        ) as log:
+            pbar = tqdm(desc="Triaging PDFs", unit=" files")
+            for text, record in pool.imap_unordered(triage_fn, files_to_convert):
+                if text is None:
+                    needs_marker.append(record["path"])
+                else:
+                    write_output(text, record["path"], output_dir)
+                    total_bytes_written += len(text)
+                log.write(json.dumps(record) + "\n")
+                pbar.update(1)
+                pbar.set_postfix({"Marker": len(needs_marker)})
+            pbar.close()
+        print(
+            f"Triage took {time.perf_counter() - triage_start:.1f}s, "
+            f"{len(needs_marker)} PDFs need marker."
+        )
+        files_to_convert = needs_marker
+        if not files_to_convert:
+            return
+
     if settings.TORCH_DEVICE == "mps" or settings.TORCH_DEVICE_MODEL == "mps":
         model_dict = None
     else:
@@ -135,8 +284,7 @@ def main(
             v.model.share_memory()
 
     print(f"Converting with {num_workers} processes and saving to {output_dir}")
-    total_bytes_written = 0
-    num_errors = 0
+    marker_start = time.perf_counter()
     with mp.Pool(
         processes=num_workers,
         initializer=worker_init,
@@ -153,10 +301,7 @@ def main(
                 continue
 
             total_bytes_written += len(markdown)
-            output_path = get_output_path(fpath, output_dir)
-            os.makedirs(os.path.dirname(output_path), exist_ok=True)
-            with open(output_path, "w", encoding="utf-8") as f:
-                f.write(markdown)
+            write_output(markdown, fpath, output_dir)
             pbar.update(1)
 
             pbar.set_postfix(
@@ -164,6 +309,7 @@ def main(
             )
 
         pbar.close()
+    print(f"Marker conversion took {time.perf_counter() - marker_start:.1f}s")
 
 
 if __name__ == "__main__":
@@ -182,6 +328,39 @@ if __name__ == "__main__":
     parser.add_argument("--num-workers", type=int, default=5)
     parser.add_argument("--slice-idx", type=int, default=0)
     parser.add_argument("--num-slices", type=int, default=5)
+    parser.add_argument(
+        "--no-triage",
+        action="store_false",
+        dest="triage",
+        help="Send every PDF to marker instead of using the embedded text layer when it is good.",
+    )
+    parser.add_argument(
+        "--triage-workers",
+        type=int,
+        help="Number of CPU processes used to extract and score text layers.",
+    )
+    parser.add_argument(
+        "--triage-log",
+        help="JSONL file to record triage decisions and timings, defaults to ${output_directory}/triage-${slice_idx}.jsonl",
+    )
+    parser.add_argument(
+        "--min-page-coverage",
+        type=float,
+        default=0.8,
+        help="Fraction of pages that need text to skip marker.",
+    )
+    parser.add_argument(
+        "--max-garbage-ratio",
+        type=float,
+        default=0.01,
+        help="Max fraction of unprintable characters in the text layer to skip marker.",
+    )
+    parser.add_argument(
+        "--min-chars-per-page",
+        type=int,
+        default=500,
+        help="Min average characters per page in the text layer to skip marker.",
+    )
     args = parser.parse_args()
 
     main(
@@ -191,4 +370,10 @@ if __name__ == "__main__":
         args.num_slices,
         device=args.device,
         num_workers=args.num_workers,
+        triage=args.triage,
+        triage_workers=args.triage_workers,
+        triage_log=args.triage_log,
+        min_page_coverage=args.min_page_coverage,
+        max_garbage_ratio=args.max_garbage_ratio,
+        min_chars_per_page=args.min_chars_per_page,
     )
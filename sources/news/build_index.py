@@ -31,6 +31,11 @@ def main(args):
     page_list = utils.build_url_index(args.url)
     page_list = sorted(set(page_list))
     logger.info(f"Found {len(page_list)} pages.")
+    # The index keeps every page, but report what download/parse will skip.
+    url_filter = utils.URLFilter()
+    kept = sum(url_filter.filter(page_list))
+    logger.info(f"{kept} pages pass the url filter.")
+    url_filter.log_counts()
     page_index = [
         {"idx": idx, "url": url, "filename": f"{utils.url_to_filename(url)}.html"}
         for idx, url in enumerate(page_list)
@@ -1,16 +1,20 @@
-"""Download all the files from a site."""
+"""Download all the files from a site.
+
+Pages are downloaded with `common_pile.download`, which waits `--wait` seconds
+between requests to the same domain without blocking requests to other ones.
+Finished urls are recorded in a journal in the output dir, so re-running
+resumes where we left off, and `--refresh` re-checks already downloaded pages
+with conditional requests.
+"""
 
 import argparse
-import functools
 import json
-import multiprocessing.dummy as mp
 import os
 import random
-import time
 
 import utils
 
-from common_pile import logs, scrape
+from common_pile import download, logs
 
 parser = argparse.ArgumentParser(description="Download pages from a news site.")
 parser.add_argument(
@@ -31,7 +35,13 @@ parser.add_argument(
     "--num_workers",
     type=int,
     default=32,
-    help="Number of workers",
+    help="The max number of requests in flight across all domains.",
+)
+parser.add_argument(
+    "--per_domain",
+    type=int,
+    default=1,
+    help="The max number of requests in flight to a single domain.",
 )
 parser.add_argument(
     "--test_run",
@@ -40,44 +50,30 @@ parser.add_argument(
 )
 parser.add_argument(
     "--wait",
-    type=int,
+    type=float,
     default=1,
-    help="Time to wait between requests.",
+    help="Time to wait between requests to the same domain.",
+)
+parser.add_argument(
+    "--refresh",
+    action="store_true",
+    help="Re-request downloaded pages, only fetching them again if they changed.",
 )
 parser.add_argument(
     "--dry_run", action="store_true", help="Don't actually download anything."
 )
 
 
-def get_pages(
-    page_index, output_dir, overwrite: bool = True, wait: int = 0, dry_run: bool = False
-):
-    idx = page_index["idx"]
-    url = page_index["url"]
-    filename = page_index["filename"]
-
-    page_file_path = os.path.join(output_dir, filename)
+def get_tasks(page_index, output_dir, dry_run: bool = False):
     logger = logs.get_logger("news")
-
-    if not utils.filter_url(url):
-        return
-
-    if not overwrite and os.path.exists(page_file_path):
-        logger.info(f"{page_file_path} already exists, not downloading.")
-        return
-
-    if dry_run:
-        logger.info(f"Not downloading {url} as --dry_run was set.")
-        return
-    try:
-        logger.info(f"Downloading {url}")
-        page = scrape.get_page(url)
-        with open(page_file_path, "wb") as fp:
-            fp.write(page.content)
-    except Exception as err:
-        logger.error(f"Failed to fetch {url}")
-    if wait:
-        time.sleep(wait)
+    url_filter = utils.URLFilter()
+    for page in url_filter.filter_index(page_index):
+        url = page["url"]
+        if dry_run:
+            logger.info(f"Not downloading {url} as --dry_run was set.")
+            continue
+        yield download.DownloadTask(url, os.path.join(output_dir, page["filename"]))
+    url_filter.log_counts()
 
 
 def main(args):
@@ -103,21 +99,21 @@ def main(args):
         random.shuffle(page_index)
         page_index = page_index[: args.test_run]
 
-    # Download all pages
-    # We don't process the results, they are just written to disk, so we
-    # use map to make sure it actually gets run.
     logger.info(f"Saving pages to {args.output_dir}")
-    with mp.Pool(args.num_workers) as p:
-        _ = p.map(
-            functools.partial(
-                get_pages,
-                output_dir=args.output_dir,
-                overwrite=args.overwrite,
-                wait=args.wait,
-                dry_run=args.dry_run,
-            ),
-            page_index,
-        )
+    stats = download.download_urls(
+        list(get_tasks(page_index, args.output_dir, args.dry_run)),
+        args.output_dir,
+        delay=args.wait,
+        concurrency=args.num_workers,
+        per_domain=args.per_domain,
+        refresh=args.refresh,
+        overwrite=args.overwrite,
+    )
+    logger.info(
+        f"Downloaded {stats.downloaded} pages ({stats.bytes:,} bytes), "
+        f"{stats.not_modified} unchanged, {stats.skipped} skipped, "
+        f"{stats.failed} failed."
+    )
 
 
 if __name__ == "__main__":
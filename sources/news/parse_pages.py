@@ -1,17 +1,29 @@
-"""Parse pages from html to plain text and format with dolma."""
+"""Parse pages from html to plain text and format with dolma.
+
+The index is streamed in chunks of `--pages_per_shard` pages, and each chunk is
+parsed by a worker that writes its own dolma shard, so the parent never holds
+the parsed pages. Parses are cached (see `common_pile.cache`) by the page bytes
+plus the `--tag`/`--attrs` selector, so changing the selector for one site only
+reparses that site's pages.
+"""
 
 import argparse
 import functools
+import glob
+import itertools
 import json
 import multiprocessing as mp
 import os
 from datetime import datetime
+from typing import Dict, Iterator, List
 
+import smart_open
 import utils
 from charset_normalizer import from_bytes
 
 from common_pile import licenses, logs
-from common_pile.write import to_dolma
+from common_pile.cache import content_key, get_cache
+from common_pile.write import serialize_datetime, shard_name
 
 parser = argparse.ArgumentParser(description="Parse pages downloaded from a News Sites")
 parser.add_argument(
@@ -30,9 +42,6 @@ parser.add_argument(
 )
 parser.add_argument("--source_name", required=True, help="The name of the datasource.")
 parser.add_argument("--filename", help="The base filename for our data.")
-parser.add_argument(
-    "--shard_size", type=int, default=1, help="Size, in GB, for each shard."
-)
 parser.add_argument("--license", type=str, default="CC-BY", help="Type of license")
 parser.add_argument(
     "--tag", type=str, default="div", help="Tag for the article or content"
@@ -40,9 +49,23 @@ parser.add_argument(
 parser.add_argument("--attrs", type=json.loads, default=None, help="dict of attributes")
 parser.add_argument(
     "--num_workers",
+    type=int,
     default=mp.cpu_count(),
     help="Number of workers",
 )
+parser.add_argument(
+    "--pages_per_shard",
+    type=int,
+    default=1000,
+    help="How many pages each worker task parses and writes as one shard.",
+)
+parser.add_argument(
+    "--cache_dir",
+    help="Where to cache parsed pages. Defaults to $COMMON_PILE_CACHE_DIR, no caching if unset.",
+)
+
+# Bump this when utils.parse_page changes its output to invalidate the cache.
+PARSER_VERSION = "1"
 
 
 LICENSE_MAP = {
@@ -52,6 +75,27 @@ LICENSE_MAP = {
 }
 
 
+def read_index(path: str) -> Iterator[Dict]:
+    with open(path) as f:
+        for l in f:
+            if line := l.strip():
+                yield json.loads(line)
+
+
+def parse_html(html_bytes: bytes, tag: str = "div", attrs=None, cache=None):
+    """Decode and parse a page, returns (text, date, author)."""
+    cache = cache if cache is not None else get_cache()
+    key = content_key(
+        html_bytes, "news-parse-page", PARSER_VERSION, {"tag": tag, "attrs": attrs}
+    )
+    if (result := cache.get(key)) is not None:
+        return tuple(result)
+    html = str(from_bytes(html_bytes).best())
+    result = utils.parse_page(html, tag=tag, attrs=attrs)
+    cache.put(key, result, "news-parse-page")
+    return result
+
+
 def parse_page(
     page_index,
     input_dir: str,
@@ -60,6 +104,7 @@ def parse_page(
     source_name: str,
     tag: str = "div",
     attrs=None,
+    cache=None,
 ):
     idx = page_index["idx"]
     url = page_index["url"]
@@ -71,12 +116,11 @@ def parse_page(
     if not utils.filter_url(url):
         return
 
-    logger.info(f"Parsing article in {html_path}")
+    logger.debug(f"Parsing article in {html_path}")
     if os.path.exists(html_path):
         with open(html_path, "rb") as f:
-            html = str(from_bytes(f.read()).best())
-        # TODO: Clean up date and author field.
-        text, date, author = utils.parse_page(html, tag=tag, attrs=attrs)
+            # TODO: Clean up date and author field.
+            text, date, author = parse_html(f.read(), tag=tag, attrs=attrs, cache=cache)
 
         return {
             "id": idx,
@@ -94,6 +138,35 @@ def parse_page(
         logger.warning(f"Article {url} exists in the index but is not downloaded.")
 
 
+def parse_shard(
+    shard, output_dir: str, filename: str, cache=None, **kwargs
+) -> Dict[str, int]:
+    """Parse a chunk of the index and write it as one dolma shard, in a worker."""
+    shard_idx, pages = shard
+    cache = cache if cache is not None else get_cache()
+    hits, misses = cache.stats.hits, cache.stats.misses
+    written = 0
+    shard_file = os.path.join(output_dir, shard_name(filename, shard_idx))
+    with smart_open.open(f"{shard_file}.tmp", "w", compression=".gz") as wf:
+        for page in pages:
+            if (data := parse_page(page, cache=cache, **kwargs)) is not None:
+                wf.write(json.dumps(data, default=serialize_datetime) + "\n")
+                written += 1
+    os.replace(f"{shard_file}.tmp", shard_file)
+    return {
+        "pages": len(pages),
+        "written": written,
+        "cache_hits": cache.stats.hits - hits,
+        "cache_misses": cache.stats.misses - misses,
+    }
+
+
+def batched(iterable, n: int) -> Iterator[List]:
+    it = iter(iterable)
+    while batch := list(itertools.islice(it, n)):
+        yield batch
+
+
 def main(args):
     logger = logs.get_logger("news")
     args.input_dir = (
@@ -101,12 +174,12 @@ def main(args):
         if args.input_dir is not None
         else os.path.dirname(args.index_path)
     )
-    with open(args.index_path) as f:
-        page_index = [json.loads(line) for l in f if (line := l.strip())]
-
-    if not page_index:
+    # Peek at the index so we still fail fast when it is empty.
+    page_index = read_index(args.index_path)
+    if (first := next(page_index, None)) is None:
         logger.error(f"{args.index_path} is empty.")
         raise ValueError(f"{args.index_path} is empty.")
+    page_index = itertools.chain([first], page_index)
 
     os.makedirs(args.output_dir, exist_ok=True)
     today = datetime.utcnow()
@@ -114,11 +187,18 @@ def main(args):
     args.filename = (
         args.filename if args.filename is not None else f"{args.source_name}.jsonl.gz"
     )
+    # Shards from a previous run with more pages would otherwise be left behind.
+    for stale in glob.iglob(os.path.join(args.output_dir, f"*_{args.filename}")):
+        os.remove(stale)
 
+    totals = {}
     with mp.Pool(args.num_workers) as p:
-        page_data = p.imap(
+        results = p.imap_unordered(
             functools.partial(
-                parse_page,
+                parse_shard,
+                output_dir=args.output_dir,
+                filename=args.filename,
+                cache=get_cache(args.cache_dir),
                 input_dir=args.input_dir,
                 today=today,
                 license_type=LICENSE_MAP[args.license],
@@ -126,11 +206,17 @@ def main(args):
                 source_name=f"news-{args.source_name}",
                 attrs=args.attrs,
             ),
-            page_index,
+            enumerate(batched(page_index, args.pages_per_shard)),
         )
-        page_data = filter(lambda p: p is not None, page_data)
-
-        to_dolma(page_data, args.output_dir, args.filename, args.shard_size)
+        for result in results:
+            for k, v in result.items():
+                totals[k] = totals.get(k, 0) + v
+    logger.info(
+        "Parsed %d pages into %d documents, %d parses were cached.",
+        totals.get("pages", 0),
+        totals.get("written", 0),
+        totals.get("cache_hits", 0),
+    )
 
 
 if __name__ == "__main__":
@@ -1,8 +1,10 @@
 """Utilities for parsing news data."""
 
+import collections
+import functools
 import re
 import urllib.parse
-from typing import Sequence
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
 
 from bs4 import BeautifulSoup, NavigableString
 from usp.tree import sitemap_tree_for_homepage
@@ -64,20 +66,106 @@ BLOCK_PATHS = (
 )
 
 
-def filter_url(url: str, path_blocklist: Sequence[str] = BLOCK_PATHS) -> bool:
-    logger = logs.get_logger("news")
-    url_p = urllib.parse.urlparse(url)
-    path = url_p.path
-    if url_p.netloc in ("youtu.be", "youtube.com", "www.youtube.com"):
-        logger.info(f"Skipping {url} as it is a youtube link.")
-        return False
-    if path == "/":
-        logger.info(f"Skipping {url} as it is the root")
-        return False
-    if m := re.search(rf"(?P<path>{'|'.join(path_blocklist)})", path):
-        logger.info(f"Skipping {url} as it has {m.group('path')} in its path.")
+YOUTUBE_HOSTS = ("youtu.be", "youtube.com", "www.youtube.com")
+
+# Rule names used for urls that are skipped for something other than their path.
+YOUTUBE = "youtube"
+ROOT = "root"
+
+
+# scheme://host/path?query#fragment, urls with ;params or whitespace that
+# urlparse would strip are left to urlparse.
+SIMPLE_URL = re.compile(
+    r"[A-Za-z]+://([^/?#;\t\r\n]*)([^?#;\t\r\n]*)(?:[?#][^\t\r\n]*)?"
+)
+
+
+def compile_alternation(rules: Sequence[str]) -> Optional[re.Pattern]:
+    if not rules:
+        return None
+    return re.compile("|".join(f"(?:{rule})" for rule in rules))
+
+
+class URLFilter:
+    """A compiled url blocklist that counts how often each rule is hit.
+
+    The path rules are compiled once into two alternations, the `^` anchored
+    rules that only need to be tried at the start of the path and the rest,
+    which is much faster than searching with all of them at every position.
+    The rule that blocked a url is only looked up once we know there is a hit.
+    """
+
+    def __init__(
+        self,
+        path_blocklist: Sequence[str] = BLOCK_PATHS,
+        blocked_hosts: Sequence[str] = YOUTUBE_HOSTS,
+    ):
+        self.path_blocklist = tuple(path_blocklist)
+        self.blocked_hosts = frozenset(blocked_hosts)
+        # A `|` could be a top level alternation, so only strip the `^` when
+        # it clearly anchors the whole rule.
+        anchored = [
+            r for r in self.path_blocklist if r.startswith("^") and "|" not in r
+        ]
+        self.anchored = compile_alternation([r[1:] for r in anchored])
+        self.unanchored = compile_alternation(
+            [r for r in self.path_blocklist if r not in anchored]
+        )
+        self.rules = [(rule, re.compile(rule)) for rule in self.path_blocklist]
+        self.counts = collections.Counter()
+        self.logger = logs.get_logger("news")
+
+    @staticmethod
+    def split(url: str) -> Tuple[str, str]:
+        """Get the (host, path) of a url, without the cost of a full urlparse."""
+        if m := SIMPLE_URL.fullmatch(url):
+            return m.group(1), m.group(2)
+        url_p = urllib.parse.urlparse(url)
+        return url_p.netloc, url_p.path
+
+    def reason(self, url: str) -> Optional[str]:
+        """The rule that blocks this url, None if it is allowed."""
+        host, path = self.split(url)
+        if host in self.blocked_hosts:
+            return YOUTUBE
+        if path == "/":
+            return ROOT
+        if (self.anchored is not None and self.anchored.match(path)) or (
+            self.unanchored is not None and self.unanchored.search(path)
+        ):
+            return next(rule for rule, regex in self.rules if regex.search(path))
+        return None
+
+    def __call__(self, url: str) -> bool:
+        """True if we should keep this url."""
+        if (rule := self.reason(url)) is None:
+            return True
+        self.counts[rule] += 1
+        self.logger.debug(f"Skipping {url}, it matches {rule}.")
         return False
-    return True
+
+    def filter(self, urls: Iterable[str]) -> List[bool]:
+        """Check a batch of urls, i.e. a whole sitemap."""
+        return [self(url) for url in urls]
+
+    def filter_index(
+        self, page_index: Iterable[Dict], key: str = "url"
+    ) -> Iterator[Dict]:
+        """Yield the index entries whose url we should keep."""
+        return (page for page in page_index if self(page[key]))
+
+    def log_counts(self):
+        for rule, count in self.counts.most_common():
+            self.logger.info(f"Skipped {count} urls matching {rule}.")
+
+
+@functools.lru_cache(maxsize=None)
+def get_url_filter(path_blocklist: Tuple[str] = BLOCK_PATHS) -> URLFilter:
+    return URLFilter(path_blocklist)
+
+
+def filter_url(url: str, path_blocklist: Sequence[str] = BLOCK_PATHS) -> bool:
+    return get_url_filter(tuple(path_blocklist))(url)
 
 
 def clean_authors(author_text):
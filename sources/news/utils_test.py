@@ -0,0 +1,118 @@
+"""Tests that the compiled URLFilter keeps the same urls as the original filter_url."""
+
+import importlib.util
+import os
+import random
+import re
+import urllib.parse
+
+import pytest
+
+# Load it under its own name, `utils` is also the name of other sources' utils.
+spec = importlib.util.spec_from_file_location(
+    "news_utils", os.path.join(os.path.dirname(os.path.abspath(__file__)), "utils.py")
+)
+utils = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(utils)
+
+
+def reference_filter_url(url, path_blocklist=utils.BLOCK_PATHS):
+    """The original filter_url, a urlparse and one search of all the rules."""
+    url_p = urllib.parse.urlparse(url)
+    path = url_p.path
+    if url_p.netloc in ("youtu.be", "youtube.com", "www.youtube.com"):
+        return False
+    if path == "/":
+        return False
+    if re.search(rf"(?P<path>{'|'.join(path_blocklist)})", path):
+        return False
+    return True
+
+
+URLS = [
+    # Articles we keep.
+    "https://www.example.com/2024/01/02/a-news-story/",
+    "https://example.com/news/story-about-tags",
+    "https://example.com/about-the-election/",
+    "https://example.com/aboutus",
+    "https://example.com/news/contact-tracing",
+    "https://example.com/news/img_1.png",
+    "https://example.com/news/screenshot-1",
+    "https://example.com/tagsx/",
+    "https://example.com/visualstags/",
+    "https://example.com/Category/x/",
+    "https://m.youtube.com/watch?v=1",
+    "https://youtube.com.example.com/story",
+    "https://example.com",
+    "https://example.com/story?page=/tags/",
+    "https://example.com/story#/author/",
+    # Urls that are blocked.
+    "https://youtu.be/abc",
+    "https://youtube.com/watch?v=1",
+    "https://www.youtube.com/",
+    "https://example.com/",
+    "https://example.com/?p=1",
+    "https://example.com/tag/politics/",
+    "https://example.com/tags/politics/",
+    "https://example.com/news/category/world/",
+    "https://example.com/visuals_tags/x/",
+    "https://example.com/visual_tags/",
+    "https://example.com/visual_location/x/",
+    "https://example.com/about",
+    "https://example.com/about-us",
+    "https://example.com/about-us/team/",
+    "https://example.com/contact",
+    "https://example.com/contact-us/",
+    "https://example.com/img_1234.jpg",
+    "https://example.com/screenshot-2024/",
+    "https://example.com/shop/my-account/orders/",
+    "https://example.com/author/jane-doe/",
+    # Urls the fast path leaves to urlparse.
+    "https://example.com/story;params/tag/",
+    "https://example.com/tag/;params",
+    "https://example.com/story with spaces/tag/",
+    "https://example.com/\tabout",
+    "example.com/tag/x/",
+    "/about",
+    "",
+]
+
+
+@pytest.mark.parametrize("url", URLS)
+def test_matches_reference(url):
+    expected = reference_filter_url(url)
+    url_filter = utils.URLFilter()
+    assert url_filter(url) == expected
+    assert utils.filter_url(url) == expected
+    if not expected:
+        assert sum(url_filter.counts.values()) == 1
+
+
+def test_reason():
+    url_filter = utils.URLFilter()
+    assert url_filter.reason("https://youtu.be/abc") == utils.YOUTUBE
+    assert url_filter.reason("https://example.com/") == utils.ROOT
+    assert url_filter.reason("https://example.com/about-us") == "^/about(?:-us)?$"
+    assert url_filter.reason("https://example.com/x/tags/y") == "/tags?/"
+    assert url_filter.reason("https://example.com/story") is None
+
+
+def test_fuzzed_urls():
+    rng = random.Random(0)
+    hosts = ["example.com", "youtu.be", "www.youtube.com", "EXAMPLE.com:80", ""]
+    pieces = ["/", "about", "-us", "tag", "s", "visuals", "_tags", "img_", "contact"]
+    pieces += ["x", "?", "#", ";", " ", "\t", "%2F", "screenshot-", "category"]
+    url_filter = utils.URLFilter()
+    for _ in range(20000):
+        scheme = rng.choice(["https://", "http://", ""])
+        path = "".join(rng.choices(pieces, k=rng.randint(0, 8)))
+        url = f"{scheme}{rng.choice(hosts)}{path}"
+        assert url_filter(url) == reference_filter_url(url), url
+
+
+def test_filter_index():
+    url_filter = utils.URLFilter()
+    index = [{"url": url} for url in URLS]
+    kept = list(url_filter.filter_index(index))
+    assert kept == [page for page in index if reference_filter_url(page["url"])]
+    assert url_filter.filter(URLS) == [reference_filter_url(url) for url in URLS]
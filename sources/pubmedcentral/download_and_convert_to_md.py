@@ -13,6 +13,7 @@ import xml.etree.ElementTree as ET
 from tqdm import tqdm
 
 from common_pile import logs
+from common_pile.cache import memoize
 from common_pile.scrape import get_page
 
 parser = argparse.ArgumentParser(description="Convert xml documents to markdown.")
@@ -158,6 +159,40 @@ def download(f_url: str, output_dir: str):
         logger.error(traceback.print_exc())
 
 
+def read_bytes(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+# pandoc options:
+#   --quiet is to suppress messages
+#   --from jats specifies the input format as Journal Article Tag Suite (https://jats.nlm.nih.gov/)
+#   --to markdown is the output format (what pandoc infers from a .md output file)
+#   --wrap=none is to prevent pandoc from wrapping lines
+PANDOC_OPTIONS = ["--quiet", "--from", "jats", "--to", "markdown", "--wrap=none"]
+
+
+def pandoc_version() -> str:
+    result = subprocess.run(["pandoc", "--version"], capture_output=True, text=True)
+    return result.stdout.split("\n")[0]
+
+
+@memoize(
+    "pandoc-jats-markdown",
+    version=pandoc_version,
+    config={"options": PANDOC_OPTIONS},
+    key_fn=read_bytes,
+)
+def jats_to_markdown(nxml: str) -> str:
+    result = subprocess.run(
+        ["pandoc", *PANDOC_OPTIONS, nxml],
+        capture_output=True,
+        check=True,
+        encoding="utf-8",
+    )
+    return result.stdout
+
+
 def extract_and_convert_tarball(t: str, output_dir: str):
     if not os.path.exists(t):
         return
@@ -189,26 +224,11 @@ def extract_and_convert_tarball(t: str, output_dir: str):
         ) as f:
             json.dump(metadata, f, ensure_ascii=False)
 
-        # convert nxml to markdown
-        # pandoc options:
-        #   --quiet is to suppress messages
-        #   --from jats specifies the input format as Journal Article Tag Suite (https://jats.nlm.nih.gov/)
-        #   -o is the output file
-        #   --wrap=none is to prevent pandoc from wrapping lines
-        options = [
-            "pandoc",
-            "--quiet",
-            "--from",
-            "jats",
-            nxml,
-            "-o",
-            f"{pmcid}.md",
-            "--wrap=none",
-        ]
-        subprocess.run(options)
+        markdown = jats_to_markdown(nxml)
+        with open(f"{output_dir}/{pmcid}.md", "w", encoding="utf-8") as f:
+            f.write(markdown)
 
         # remove extracted files
-        os.rename(f"{pmcid}.md", f"{output_dir}/{pmcid}.md")
         shutil.rmtree(nxml.split("/")[0], ignore_errors=True)
 
     except:
@@ -8,14 +8,17 @@ import os
 import smart_open
 from tqdm import tqdm
 
-from common_pile import utils
+from common_pile import shard_index, utils
 from common_pile.write import to_dolma
 
 parser = argparse.ArgumentParser(description="Collect all ids from dolma files.")
 parser.add_argument("--input", required=True, help="The input dir.")
 parser.add_argument("--old", required=True, help="The old dolma data.")
 parser.add_argument(
-    "--ids", default="ids.json", help="Where to save the resulting file."
+    "--ids",
+    default="ids.json",
+    help="The ids of --input, from collect-ids.py or a .sqlite index built by "
+    "common_pile/scripts/id_to_shard.py.",
 )
 parser.add_argument(
     "--filename", default="*.jsonl.gz", help="The default file name glob pattern."
@@ -41,8 +44,11 @@ def next_shard(input_dir, filename):
 def main():
     args = parser.parse_args()
 
-    with open(args.ids) as f:
-        ids = set(json.load(f))
+    if args.ids.endswith(".sqlite"):
+        ids = shard_index.ShardIndex(args.ids)
+    else:
+        with open(args.ids) as f:
+            ids = set(json.load(f))
 
     shard_idx = next_shard(args.input, args.filename)
 
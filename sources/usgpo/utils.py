@@ -1,16 +1,7 @@
-import time
-
-import requests
-
-from common_pile import logs
+from common_pile import scrape
 
 
 def api_query(endpoint, headers, params):
-    logger = logs.get_logger("usgpo")
-    response = requests.get(endpoint, headers=headers, params=params)
-    if response.status_code == 429:
-        # Sleep for an hour if we've hit the rate-limit
-        logger.info("Exceeded rate-limit, sleeping for one hour")
-        time.sleep(60 * 60)
-        response = requests.get(endpoint, headers=headers, params=params)
-    return response
+    # The shared client waits for the `Retry-After` the api sends with a 429 (and
+    # slows down afterwards) instead of sleeping for an hour.
+    return scrape.get_client().get(endpoint, headers=headers, params=params)
@@ -7,6 +7,8 @@ import polars as pl
 import pypandoc
 from rich.progress import track
 
+from common_pile.cache import memoize
+
 
 def batched(iterable, n):
     it = iter(iterable)
@@ -14,10 +16,19 @@ def batched(iterable, n):
         yield batch
 
 
+@memoize(
+    "pandoc-html-plain",
+    version=pypandoc.get_pandoc_version,
+    config={"extra_args": ["--quiet"]},
+)
+def html_to_plain(html_string: str) -> str:
+    return pypandoc.convert_text(html_string, "plain", "html", extra_args=["--quiet"])
+
+
 def parse_html(claims: bool, html_string: str) -> str:
     if not html_string:
         return ""
-    text = pypandoc.convert_text(html_string, "plain", "html", extra_args=["--quiet"])
+    text = html_to_plain(html_string)
     # remove single newlines that are not surrounded by other newlines as those are likely line length formatting.
     new_line_pattern = r"(?<!\n)\n(?!\n)"
     # also add line-breaks after <number><periods> for claims (as they are all numbered).
@@ -62,19 +62,18 @@ def download_and_extract(
                     f"Failed to remove {dest} after a failed download.", exc_info=True
                 )
             return dest
+    if dl_file["name"].endswith(".zst"):
+        # zstd compressed dumps are single xml files compressed with --long=31,
+        # to_dolma.py streams them through the parser without writing the
+        # (much larger) uncompressed xml to disk.
+        logger.info(f"Leaving {dl_file['name']} compressed, it is read as a stream.")
+        return dest
     logger.info(f"Extracting download at {dest}.")
     try:
         # pyunpack wraps multiple extraction tools, and picks the right one.
         pyunpack.Archive(os.path.join(dest, dl_file["name"])).extractall(dest)
     except:
-        # The main error I saw was that zstd compressed data uses the flag
-        # --long=31. We can't pass this flag to pyunpack so we need to run
-        # zstd ourselves.
         logger.error("Pyunpack uncompression failed.", exc_info=True)
-        if dl_file["name"].endswith(".zst"):
-            logger.info("Extracting download to {dest} with tweaked zst.")
-            compressed = os.path.join(dest, dl_file["name"])
-            uncompressed = utils.zst_uncompress(compressed)
     return dest
 
 
@@ -1,6 +1,9 @@
 """Convert wiki dumps from the internet archive to dolma."""
 
 import argparse
+import collections
+import concurrent.futures
+import dataclasses
 import datetime
 import functools
 import glob
@@ -9,7 +12,10 @@ import math
 import multiprocessing as mp
 import os
 import re
+import shutil
+import time
 import uuid
+from typing import Dict, List
 
 import pandas as pd
 import pytz
@@ -19,7 +25,11 @@ from common_pile import logs
 from common_pile.licenses import PermissiveLicenses
 from common_pile.utils import dolma_output
 from common_pile.write import to_dolma
-from common_pile.xml import iterate_xmls
+from common_pile.xml import (
+    COMPRESSION_EXTENSIONS,
+    MediaWikiPage,
+    iterate_mediawiki_xmls,
+)
 
 parser = argparse.ArgumentParser(
     description="Convert Downloaded Wiki dumps from the internet archive to dolma."
@@ -46,6 +56,24 @@ parser.add_argument(
     action="store_true",
     help="Should we skip pages that are redirects to others?",
 )
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=min(4, os.cpu_count()),
+    help="How many wikis to convert at once, 1 converts them serially.",
+)
+parser.add_argument(
+    "--per_device",
+    type=int,
+    default=2,
+    help="The most conversions reading from the same disk at once.",
+)
+parser.add_argument(
+    "--batch_mb",
+    type=float,
+    default=64,
+    help="Wikis smaller than this (in MB) are grouped into jobs of about this size.",
+)
 
 
 def format_old(
@@ -113,55 +141,44 @@ def format_old(
 
 
 def format_xml(
-    xml,
+    page: MediaWikiPage,
     source_name: str,
     wiki: str,
     url: str,
     dump_url: str,
     license: PermissiveLicenses,
-    all_authors: bool = True,
     skip_redirect: bool = True,
 ):
-    """Convert a -history.xml file to the dolma format."""
+    """Convert a page streamed from a -history.xml file to the dolma format."""
     # TODO: This is shared with the generic dolma version, but more robust, should be unified.
     logger = logs.get_logger()
-    if skip_redirect and [x for x in xml if x.tag.endswith("redirect")]:
+    if skip_redirect and page.redirect:
         # Don't log this as we haven't extracted any information to make the log
         # entry useful.
         # logger.info("Skipping page as it is a redirect.")
         return None
 
-    revisions = [r for r in xml if r.tag.endswith("revision")]
-    if not revisions:
+    if not page.revisions:
         logger.error(f"Failed to parse revision for page", extra={"wiki": wiki})
         return None
-    text = [t for t in revisions[-1] if t.tag.endswith("text")]
-    if not text:
+    if not page.has_text:
         logger.error(f"Failed to parse page text", extra={"wiki": wiki})
-        text = None
-    else:
-        text = text[0].text
+    text = page.text
 
-    page_namespace = [ns for ns in xml if ns.tag.endswith("ns")]
-    if not page_namespace:
+    page_namespace = page.namespace
+    if page_namespace is None:
         page_namespace = ""
         logger.warning(f"Failed to parse namespace", extra={"wiki": wiki})
-    else:
-        page_namespace = page_namespace[0].text
 
-    page_id = [pid for pid in xml if pid.tag.endswith("id")]
-    if not page_id:
+    page_id = page.page_id
+    if page_id is None:
         logger.warning(f"Filed to find page id, generating uuid", extra={"wiki": wiki})
         page_id = uuid.uuid4()
-    else:
-        page_id = page_id[0].text
 
-    ts = [ts for ts in revisions[-1] if ts.tag.endswith("timestamp")]
-    if not ts:
+    ts = page.timestamp
+    if ts is None:
         logger.warning("Failed to parse timestamp, using default", extra={"wiki": wiki})
         ts = "1970-01-01"
-    else:
-        ts = ts[0].text
     try:
         created = datetime.datetime.fromisoformat(ts).replace(tzinfo=None)
     except TypeError:
@@ -170,37 +187,10 @@ def format_xml(
         )
         created = datetime.datetime.fromisoformat("1970-01-01").replace(tzinfo=None)
 
-    page_title = [t for t in xml if t.tag.endswith("title")]
-    if not page_title:
+    page_title = page.title
+    if page_title is None:
         logger.warning(f"Failed to parse page title", extra={"wiki": wiki})
         page_title = ""
-    else:
-        page_title = page_title[0].text
-
-    contributors = set()
-    if all_authors:
-        for revision in revisions:
-            contribs = [c for c in revision if c.tag.endswith("contributor")]
-            # When there are multiple contributors, there are multiple contributor
-            # xml items where each one has a single username and id items.
-            names = [u.text for c in contribs for u in c if u.tag.endswith("username")]
-            name = ["" if n is None else n for n in name]
-            # Save their id too in case they change their username
-            uid = [u.text for c in contribs for u in c if u.tag.endswith("id")]
-            uid = ["" if u is None else u for u in uid]
-            contributors.update(zip(names, uid))
-    else:
-        # We already checked if revisions was empty above, so we will always
-        # have a revisions[-1] to check.
-        contrib = [c for c in revisions[-1] if c.tag.endswith("contributor")]
-        # When there are multiple contributors, there are multiple contributor
-        # xml items where each one has a single username and id items.
-        name = [u.text for c in contrib for u in c if u.tag.endswith("username")]
-        name = ["" if n is None else n for n in name]
-        # Save their id too in case they change their username
-        uid = [u.text for c in contrib for u in c if u.tag.endswith("id")]
-        uid = ["" if u is None else u for u in uid]
-        contributors.update(zip(name, uid))
 
     return {
         "id": f"{page_namespace}-{page_id}",
@@ -210,7 +200,7 @@ def format_xml(
         "created": created.isoformat(),
         "metadata": {
             "license": str(license),
-            "authors": sorted(contributors),
+            "authors": sorted(page.contributors),
             "url": url,
             "wiki": wiki,
             "dump_url": dump_url,
@@ -229,6 +219,7 @@ def convert_wiki(
     shard_size: int,
     all_authors: bool = True,
     skip_redirect: bool = True,
+    quiet: bool = False,
 ):
     """Convert a wiki into the dolma format, support new and old style wikis."""
     logger = logs.get_logger()
@@ -246,11 +237,13 @@ def convert_wiki(
     # Use a shadow dir to allow for starting and stopping in the middle of
     # conversion. This lets us skip processing wikis that already have an
     # output without worrying that the output is incomplete.
-    shadow_dir = os.path.join(output_dir, utils.wiki_to_dir(ident), "shadow")
-    os.makedirs(shadow_dir, exist_ok=True)
+    shadow_dir = shadow_path(output_dir, ident)
     if os.path.exists(dolma_dir):
         logger.warning(f"{dolma_dir} already exists, skipping")
         return
+    # Anything left in the shadow dir is from an interrupted run.
+    shutil.rmtree(shadow_dir, ignore_errors=True)
+    os.makedirs(shadow_dir, exist_ok=True)
     logger.info(f"Writing Dolma documents to {shadow_dir}, shadowing {dolma_dir}")
 
     # Checking for an old style wiki.
@@ -274,11 +267,13 @@ def convert_wiki(
         )
     else:
         logger.info(f"Wiki: {ident} is a new-style dump.")
-        export_pages = glob.glob(os.path.join(wiki_path, "*-history.xml"))
+        export_pages = find_history(wiki_path)
         if not export_pages:
             logger.error(f"Can't find *-histroy.xml file for wiki: {ident}")
             return None
-        pages = iterate_xmls(export_pages, tag="page")
+        # Revisions are folded into each page as they are parsed, so pages with
+        # long histories don't need to fit in memory.
+        pages = iterate_mediawiki_xmls(export_pages, all_authors=all_authors)
         pages = map(
             functools.partial(
                 format_xml,
@@ -287,14 +282,13 @@ def convert_wiki(
                 dump_url=wiki["metadata"].get("identifier-access"),
                 url=wiki["metadata"].get("originalurl"),
                 license=PermissiveLicenses.from_string(wiki["metadata"]["licenseurl"]),
-                all_authors=all_authors,
                 skip_redirect=skip_redirect,
             ),
             pages,
         )
     # Wiki processing is all via iterators so we don't have memory issues.
     pages = filter(lambda p: p is not None, pages)
-    to_dolma(pages, shadow_dir, filename, shard_size)
+    to_dolma(pages, shadow_dir, filename, shard_size, quiet=quiet)
     # Move the shadow page to the real output location
     try:
         os.makedirs(os.path.dirname(dolma_dir), exist_ok=True)
@@ -306,9 +300,155 @@ def convert_wiki(
     # dir as it will be incomplete, but its presense would cause this
     # wiki to be skipped when resuming processing.
     except Exception:
-        os.remove(os.path.dirname(dolma_dir))
+        logger.exception(f"Failed to move {shadow_dir} to {dolma_dir}")
+        shutil.rmtree(dolma_dir, ignore_errors=True)
+        shutil.rmtree(shadow_dir, ignore_errors=True)
     finally:
-        os.rmdir(os.path.dirname(shadow_dir))
+        # Clean up the (now empty) nested dirs the shadow was in, other wikis
+        # being converted at the same time may still be using them.
+        try:
+            os.removedirs(os.path.dirname(shadow_dir))
+        except OSError:
+            pass
+
+
+def find_history(wiki_path: str) -> List[str]:
+    """Find the -history.xml files of a dump, these can still be compressed."""
+    if export_pages := glob.glob(os.path.join(wiki_path, "*-history.xml")):
+        return export_pages
+    return [
+        p
+        for p in glob.glob(os.path.join(wiki_path, "*-history.xml.*"))
+        if os.path.splitext(p)[1].lower() in COMPRESSION_EXTENSIONS
+    ]
+
+
+def shadow_path(output_dir: str, ident: str) -> str:
+    """Where a wiki is written while it is being converted.
+
+    This lives outside of the final output dir, whose existence marks a wiki as
+    done.
+    """
+    return os.path.join(output_dir, "shadow", utils.wiki_to_dir(ident))
+
+
+def dump_size(path: str) -> int:
+    """The total size, in bytes, of the files in a wiki dump."""
+    return sum(
+        os.path.getsize(os.path.join(root, f))
+        for root, _, files in os.walk(path)
+        for f in files
+    )
+
+
+@dataclasses.dataclass
+class ConversionJob:
+    """A batch of wikis converted, serially, by one worker."""
+
+    device: int
+    size: int = 0
+    wikis: List[Dict] = dataclasses.field(default_factory=list)
+
+
+def plan_jobs(
+    wiki_metadata: List[Dict], dump_dir: str, output_dir: str, batch_bytes: int
+) -> List[ConversionJob]:
+    """Group wikis into jobs, largest first, batching small wikis together.
+
+    Wikis that are already converted are dropped here so we don't spend a
+    worker on them.
+    """
+    logger = logs.get_logger()
+    sized = []
+    for wiki in wiki_metadata:
+        if "metadata" not in wiki:
+            # Let convert_wiki log the malformed record.
+            sized.append((0, 0, wiki))
+            continue
+        ident = wiki["metadata"]["identifier"]
+        if os.path.exists(os.path.join(output_dir, utils.wiki_to_dir(ident))):
+            continue
+        wiki_path = os.path.join(dump_dir, utils.wiki_to_dir(ident))
+        if not os.path.exists(wiki_path):
+            sized.append((0, 0, wiki))
+            continue
+        sized.append((dump_size(wiki_path), os.stat(wiki_path).st_dev, wiki))
+    logger.info(
+        f"{len(sized)} wikis left to convert, "
+        f"{len(wiki_metadata) - len(sized)} are already done."
+    )
+    sized.sort(key=lambda s: s[0], reverse=True)
+    jobs = []
+    # Small wikis are mostly per-file overhead, so fill a shared job per device
+    # until it reaches batch_bytes.
+    batches = {}
+    for size, device, wiki in sized:
+        if size >= batch_bytes:
+            jobs.append(ConversionJob(device, size, [wiki]))
+            continue
+        batch = batches.setdefault(device, ConversionJob(device))
+        batch.size += size
+        batch.wikis.append(wiki)
+        if batch.size >= batch_bytes:
+            jobs.append(batches.pop(device))
+    jobs.extend(batches.values())
+    return jobs
+
+
+def run_job(job: ConversionJob, convert) -> ConversionJob:
+    logger = logs.get_logger()
+    for wiki in job.wikis:
+        try:
+            convert(wiki)
+        except Exception:
+            ident = wiki.get("metadata", {}).get("identifier")
+            logger.exception(f"Failed to convert wiki {ident}")
+    return job
+
+
+def schedule(jobs: List[ConversionJob], convert, workers: int, per_device: int):
+    """Run jobs, largest first, with at most `per_device` running per disk.
+
+    A lot of the conversion time is spent reading the dumps, so running many
+    conversions against the same disk just makes them fight over it, but
+    conversions reading from different disks can run side by side.
+    """
+    logger = logs.get_logger()
+    total = sum(job.size for job in jobs)
+    done = 0
+    start = time.time()
+    pending = collections.defaultdict(collections.deque)
+    for job in sorted(jobs, key=lambda j: j.size, reverse=True):
+        pending[job.device].append(job)
+    active = collections.Counter()
+    running = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        while pending or running:
+            # Start the largest waiting jobs on disks that have a free slot.
+            while len(running) < workers:
+                ready = [d for d, queue in pending.items() if active[d] < per_device]
+                if not ready:
+                    break
+                device = max(ready, key=lambda d: pending[d][0].size)
+                job = pending[device].popleft()
+                if not pending[device]:
+                    del pending[device]
+                active[device] += 1
+                running[pool.submit(run_job, job, convert)] = job
+            finished, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in finished:
+                job = running.pop(future)
+                active[job.device] -= 1
+                if e := future.exception():
+                    logger.error(f"Conversion worker failed: {e}")
+                done += job.size
+                elapsed = time.time() - start
+                logger.info(
+                    f"Converted {done / 1e9:.2f}/{total / 1e9:.2f} GB of dumps "
+                    f"in {elapsed:.0f}s ({done / 1e6 / max(elapsed, 1e-9):.1f} MB/s)"
+                )
 
 
 def main(args):
@@ -341,10 +481,26 @@ def main(args):
         skip_redirect=not args.include_redirects,
     )
 
-    # Run the action convert function, without a for loop.
-    # Note: I looked at using mp.Pool here, but there is so much disk IO
-    # that I was seeing much slower speeds than doing it serially.
-    list(map(convert, wiki_metadata))
+    if args.workers <= 1:
+        # Run the action convert function, without a for loop.
+        list(map(convert, wiki_metadata))
+        return
+    # Note: A plain mp.Pool over the wikis was slower than running serially as
+    # the workers fought over the disk. The scheduler limits how many
+    # conversions read from each disk at once and starts the largest dumps first
+    # so they don't become the tail.
+    jobs = plan_jobs(
+        wiki_metadata,
+        args.dump_dir,
+        args.output_dir,
+        batch_bytes=int(args.batch_mb * 1000 * 1000),
+    )
+    schedule(
+        jobs,
+        functools.partial(convert, quiet=True),
+        workers=args.workers,
+        per_device=args.per_device,
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,111 @@
+"""Tests for planning and scheduling the conversion of archived wikis."""
+
+import collections
+import json
+import os
+import sys
+import time
+import uuid
+
+import pytest
+from wiki.archive import utils
+
+# to_dolma is run from its own directory and imports its utils as `utils`, which
+# is also the name of the scrape utils other tests import.
+previous = sys.modules.get("utils")
+sys.modules["utils"] = utils
+try:
+    from wiki.archive import to_dolma
+finally:
+    if previous is None:
+        del sys.modules["utils"]
+    else:
+        sys.modules["utils"] = previous
+
+
+def wiki(ident, **metadata):
+    return {"metadata": {"identifier": ident, **metadata}}
+
+
+def write_dump(dump_dir, ident, size):
+    path = os.path.join(dump_dir, utils.wiki_to_dir(ident))
+    os.makedirs(path)
+    with open(os.path.join(path, f"{ident}-history.xml"), "wb") as wf:
+        wf.write(b"x" * size)
+
+
+def test_plan_jobs(tmp_path):
+    dump_dir, output_dir = str(tmp_path / "dumps"), str(tmp_path / "out")
+    sizes = {"wiki-big": 500, "wiki-bigger": 900, "wiki-a": 40, "wiki-b": 30}
+    sizes.update({"wiki-c": 20, "wiki-d": 10, "wiki-done": 1000})
+    for ident, size in sizes.items():
+        write_dump(dump_dir, ident, size)
+    os.makedirs(os.path.join(output_dir, utils.wiki_to_dir("wiki-done")))
+    wikis = [wiki(ident) for ident in sizes] + [wiki("wiki-missing"), {}]
+
+    jobs = to_dolma.plan_jobs(wikis, dump_dir, output_dir, batch_bytes=60)
+    device = os.stat(dump_dir).st_dev
+    idents = [[w.get("metadata", {}).get("identifier") for w in j.wikis] for j in jobs]
+    # Big dumps get their own job, largest first. The small ones are batched
+    # until a batch reaches batch_bytes, and the last batch holds what is left.
+    # Wikis whose dumps we couldn't size are batched together, and left for
+    # convert_wiki to report.
+    assert idents == [
+        ["wiki-bigger"],
+        ["wiki-big"],
+        ["wiki-a", "wiki-b"],
+        ["wiki-c", "wiki-d"],
+        ["wiki-missing", None],
+    ]
+    assert [j.size for j in jobs] == [900, 500, 70, 30, 0]
+    assert [j.device for j in jobs] == [device] * 4 + [0]
+
+
+def record_conversion(wiki):
+    """Convert function for the scheduler, records when each wiki ran."""
+    start = time.time()
+    time.sleep(0.2)
+    record = {**wiki["metadata"], "start": start, "end": time.time()}
+    with open(os.path.join(wiki["metadata"]["log"], f"{uuid.uuid4()}.json"), "w") as wf:
+        json.dump(record, wf)
+
+
+def max_overlap(runs):
+    events = sorted([(r["start"], 1) for r in runs] + [(r["end"], -1) for r in runs])
+    running = peak = 0
+    for _, change in events:
+        running += change
+        peak = max(peak, running)
+    return peak
+
+
+@pytest.mark.parametrize("per_device", [1, 2])
+def test_schedule_per_device(tmp_path, per_device):
+    log = str(tmp_path)
+    jobs = [
+        to_dolma.ConversionJob(
+            device, size, [wiki(f"{device}-{size}", device=device, size=size, log=log)]
+        )
+        for device in range(2)
+        for size in (10, 40, 30, 20)
+    ]
+    to_dolma.schedule(jobs, record_conversion, workers=4, per_device=per_device)
+
+    runs = []
+    for name in os.listdir(log):
+        with open(os.path.join(log, name)) as f:
+            runs.append(json.load(f))
+    assert len(runs) == len(jobs)
+    by_device = collections.defaultdict(list)
+    for run in runs:
+        by_device[run["device"]].append(run)
+    for device_runs in by_device.values():
+        assert max_overlap(device_runs) == per_device
+        # Each disk starts its largest jobs first, the ones submitted together
+        # can start in any order.
+        order = [r["size"] for r in sorted(device_runs, key=lambda r: r["start"])]
+        assert sorted(order[:per_device], reverse=True) == [40, 30][:per_device]
+        if per_device == 1:
+            assert order == [40, 30, 20, 10]
+    # Different disks convert side by side.
+    assert max_overlap(runs) == 2 * per_device
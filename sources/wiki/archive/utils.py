@@ -8,7 +8,7 @@ import re
 import urllib.parse
 from typing import List, Optional, Protocol, Sequence, Set, Tuple, TypeVar
 
-import tenacity
+import requests
 
 from common_pile import licenses, logs, scrape
 
@@ -20,9 +20,9 @@ def check_alive(item) -> bool:
     if "originalurl" not in item["metadata"]:
         return False
     try:
-        r = scrape.get_page(item["metadata"]["originalurl"])
-        return r.status_code == 200
-    except tenacity.RetryError:
+        scrape.get_page(item["metadata"]["originalurl"])
+        return True
+    except (RuntimeError, requests.RequestException):
         return False
 
 
@@ -290,22 +290,6 @@ def wiki_to_dir(wiki_id, chars: int = 2, levels: int = 2):
     return os.path.join(*parts)
 
 
-def zst_uncompress(compressed, uncompressed=None):
-    """Uncompress a file using zstd with the `--long=31` flag."""
-    if uncompressed is None:
-        uncompressed = re.sub(r"\.zst$", "", compressed)
-        LOGGER.info(
-            "Uncompressed target for {compressed} not provided, using {uncompressed}"
-        )
-    with open(uncompressed, "w") as wf:
-        # TODO: Add error handling, namely, delete the (wrong) uncompressed
-        # file is there are errors.
-        subprocess.run(
-            ["/usr/bin/zstd", "-c", "-d", "--long=31", "--", compressed], stdout=wf
-        )
-    return uncompressed
-
-
 KNOWN_BAD = frozenset(
     {
         # Only has a torrent file
@@ -0,0 +1,61 @@
+"""Tests for the archived wiki utilities."""
+
+import http.server
+import socket
+import threading
+
+import pytest
+from wiki.archive import utils
+
+from common_pile import scrape
+
+
+class StatusHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(404 if self.path == "/dead" else 200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StatusHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_port}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture(autouse=True)
+def client(monkeypatch):
+    # Don't back off between retries of the failures these tests make on purpose.
+    c = scrape.Client(max_retries=0)
+    monkeypatch.setattr(scrape, "get_client", lambda: c)
+    return c
+
+
+def unused_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_check_alive(server):
+    assert utils.check_alive({"metadata": {"originalurl": f"{server}/wiki"}})
+
+
+def test_check_alive_dead_wiki(server):
+    assert not utils.check_alive({"metadata": {"originalurl": f"{server}/dead"}})
+
+
+def test_check_alive_unreachable():
+    url = f"http://127.0.0.1:{unused_port()}/wiki"
+    assert not utils.check_alive({"metadata": {"originalurl": url}})
+
+
+def test_check_alive_without_url():
+    assert not utils.check_alive({"metadata": {}})
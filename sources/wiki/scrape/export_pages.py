@@ -8,17 +8,25 @@ points of concern are:
 * limit: The maximum number of revisions to return, limited at 1000.
 * history: It mentions there are cases where this doesn't return all the revisions.
 * listauthors: This didn't seem active on any of the wikis I tested on.
+
+Several batches are exported at once through a `common_pile.scrape.Client`,
+which reuses keep-alive connections and rate limits the wiki so
+`--requests_per_second` bounds the load no matter how many are in flight (it
+slows down further if the wiki starts returning 429s). Responses are streamed straight into their shard file, and shards that
+already exist are skipped, so an interrupted export can just be re-run.
 """
 
 
 import argparse
+import concurrent.futures
 import os
 import urllib.parse
-from typing import List
+from typing import List, Optional
 
-from utils import enumerate_pages, get_page, get_wiki_name
+from tenacity import retry, stop_after_attempt, wait_random_exponential
+from utils import enumerate_pages, get_wiki_name
 
-from common_pile import logs
+from common_pile import logs, scrape
 
 parser = argparse.ArgumentParser(description="Export mediawikis as XML")
 parser.add_argument("--wiki", required=True, help="The wiki url we are exporting.")
@@ -30,7 +38,28 @@ parser.add_argument(
 # Using firefox I didn't have issues sending a lot of pages at once, but I was
 # getting URI too long errors when using requests.
 parser.add_argument(
-    "--page_limit", default=35, help="The max number of pages to export at once."
+    "--page_limit",
+    default=35,
+    type=int,
+    help="The max number of pages to export at once.",
+)
+parser.add_argument(
+    "--concurrency",
+    default=4,
+    type=int,
+    help="The number of export requests to have in flight at once.",
+)
+parser.add_argument(
+    "--requests_per_second",
+    default=1.0,
+    type=float,
+    help="The max rate of export requests to the wiki, <= 0 means no limit.",
+)
+parser.add_argument(
+    "--burst",
+    default=1,
+    type=int,
+    help="How many requests can be sent back to back before the rate limit kicks in.",
 )
 parser.add_argument(
     "--test_pages", default=None, type=int, help="The number of test pages to retrieve."
@@ -46,7 +75,21 @@ parser.add_argument(
 )
 
 
-def export_pages(wiki: str, pages: List[str]):
+def shard_path(output_dir: str, shard_idx: int) -> str:
+    return os.path.join(output_dir, f"{shard_idx:>05}-pages.xml")
+
+
+# The client already retries failed requests, this is for connections that
+# drop while we are streaming the body.
+@retry(stop=stop_after_attempt(3), wait=wait_random_exponential(multiplier=1, max=30))
+def export_pages(
+    wiki: str,
+    pages: List[str],
+    path: str,
+    client: Optional[scrape.Client] = None,
+    chunk_size: int = 1024 * 1024,
+) -> int:
+    """Export pages into the xml file at `path`, returns the number of bytes written."""
     # Note: We don't quote the newline ourselves as requests will do it too and
     # you'll get `%250A` instead of `%0A` in the url.
     pages = "\n".join(pages).strip("\n")
@@ -54,10 +97,69 @@ def export_pages(wiki: str, pages: List[str]):
     # of things (with the /wiki/ being for readers), we use it here to start looking
     # for pages because it is more consistent (some wiki's want /w/index.php and
     # some just want /index.php).
-    return get_page(
+    client = client if client is not None else scrape.get_client()
+    with client.get(
         urllib.parse.urljoin(wiki, "/wiki/Special:Export"),
         params={"pages": pages, "history": 1},
-    )
+        stream=True,
+    ) as resp:
+        if resp.status_code != 200:
+            logs.get_logger().warning(
+                "Failed request to %s: %d, %s", resp.url, resp.status_code, resp.reason
+            )
+            raise RuntimeError(f"Failed request to {resp.url}")
+        # Write to a temp file so a shard only exists once it is complete, this
+        # is what lets us resume by skipping existing shards.
+        tmp_path = f"{path}.tmp"
+        written = 0
+        with open(tmp_path, "wb") as wf:
+            for chunk in resp.iter_content(chunk_size=chunk_size):
+                written += wf.write(chunk)
+    os.replace(tmp_path, path)
+    return written
+
+
+def plan_shards(pages: List[str], page_limit: int, test_pages: Optional[int] = None):
+    """Split pages into (shard_idx, batch) pairs, in the same order as before."""
+    for i, j in enumerate(range(0, len(pages), page_limit)):
+        yield i, pages[j : j + page_limit]
+        if test_pages and j > test_pages:
+            break
+
+
+def export_shards(
+    wiki: str,
+    pages: List[str],
+    output_dir: str,
+    page_limit: int = 35,
+    concurrency: int = 4,
+    requests_per_second: float = 1.0,
+    burst: int = 1,
+    test_pages: Optional[int] = None,
+) -> List[int]:
+    """Export all the pages as shards in output_dir, returns the new shard indices."""
+    logger = logs.get_logger()
+    client = scrape.Client(rate=requests_per_second, burst=burst, pool_size=concurrency)
+    shards = list(plan_shards(pages, page_limit, test_pages))
+    todo = [(i, b) for i, b in shards if not os.path.exists(shard_path(output_dir, i))]
+    if skipped := len(shards) - len(todo):
+        logger.info("Skipping %d shards that were already exported.", skipped)
+    done = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = {
+            pool.submit(export_pages, wiki, batch, shard_path(output_dir, i), client): i
+            for i, batch in todo
+        }
+        for future in concurrent.futures.as_completed(futures):
+            i = futures[future]
+            written = future.result()
+            done.append(i)
+            logger.info(
+                "Exported shard %d (%d/%d), %d bytes", i, len(done), len(todo), written
+            )
+    client.log_metrics(logger)
+    client.close()
+    return sorted(done)
 
 
 def main(args):
@@ -88,13 +190,16 @@ def main(args):
     # Note: These exports seem to an xml namespace so all tags are actually
     #   "{http://mediawiki.org/xml/export-0.11/}TAGNAME"
     # with literal "{"'s.
-    for i, j in enumerate(range(0, len(pages), args.page_limit)):
-        xml = export_pages(args.wiki, pages[j : j + args.page_limit])
-        with open(os.path.join(args.output_dir, f"{i:>05}-pages.xml"), "w") as wf:
-            wf.write(xml)
-        if args.test_pages and j > args.test_pages:
-            logger.info(f"Scraped {j + args.page_limit} pages, stopping for testing.")
-            break
+    export_shards(
+        args.wiki,
+        pages,
+        args.output_dir,
+        page_limit=args.page_limit,
+        concurrency=args.concurrency,
+        requests_per_second=args.requests_per_second,
+        burst=args.burst,
+        test_pages=args.test_pages,
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,113 @@
+"""Tests for the concurrent Special:Export fetcher, against a local stub server."""
+
+import http.server
+import os
+import threading
+import time
+import urllib.parse
+
+import export_pages
+import pytest
+
+from common_pile import scrape
+
+
+class ExportHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        params = urllib.parse.parse_qs(url.query)
+        self.server.requests.append(params["pages"][0].split("\n"))
+        if url.path != "/wiki/Special:Export":
+            self.send_error(404)
+            return
+        body = "".join(
+            f"<page><title>{title}</title></page>"
+            for title in params["pages"][0].split("\n")
+        )
+        body = f"<mediawiki>{body}</mediawiki>".encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), ExportHandler)
+    httpd.requests = []
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def wiki_url(server):
+    return f"http://127.0.0.1:{server.server_address[1]}/"
+
+
+def test_export_shards(server, tmp_path):
+    pages = [f"Page {i}" for i in range(10)]
+    done = export_pages.export_shards(
+        wiki_url(server),
+        pages,
+        str(tmp_path),
+        page_limit=3,
+        concurrency=3,
+        requests_per_second=0,
+    )
+    assert done == [0, 1, 2, 3]
+    assert sorted(os.listdir(tmp_path)) == [f"{i:>05}-pages.xml" for i in range(4)]
+    with open(export_pages.shard_path(str(tmp_path), 3)) as f:
+        assert f.read() == "<mediawiki><page><title>Page 9</title></page></mediawiki>"
+
+
+def test_export_shards_resumes(server, tmp_path):
+    pages = [f"Page {i}" for i in range(10)]
+    existing = export_pages.shard_path(str(tmp_path), 1)
+    with open(existing, "w") as wf:
+        wf.write("already exported")
+    done = export_pages.export_shards(
+        wiki_url(server), pages, str(tmp_path), page_limit=3, requests_per_second=0
+    )
+    assert done == [0, 2, 3]
+    assert sorted(server.requests) == [
+        ["Page 0", "Page 1", "Page 2"],
+        ["Page 6", "Page 7", "Page 8"],
+        ["Page 9"],
+    ]
+    with open(existing) as f:
+        assert f.read() == "already exported"
+
+
+def test_export_shards_rate_limited(server, tmp_path):
+    pages = [f"Page {i}" for i in range(5)]
+    start = time.monotonic()
+    export_pages.export_shards(
+        wiki_url(server),
+        pages,
+        str(tmp_path),
+        page_limit=1,
+        concurrency=5,
+        requests_per_second=20,
+    )
+    # The first request uses the burst token, the other 4 wait 1/20s each.
+    assert time.monotonic() - start >= 4 / 20
+
+
+def test_token_bucket_burst():
+    bucket = scrape.TokenBucket(rate=10, burst=3)
+    assert [bucket.acquire() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.acquire() > 0
+
+
+def test_host_rate_limiter_is_per_host():
+    limiter = scrape.HostRateLimiter(rate=1)
+    assert limiter.bucket("http://a.org/x") is limiter.bucket("http://a.org/y")
+    assert limiter.bucket("http://a.org/x") is not limiter.bucket("http://b.org/x")
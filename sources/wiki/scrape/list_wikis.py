@@ -9,7 +9,7 @@ import time
 import urllib.parse
 from typing import List
 
-import tenacity
+import requests
 from utils import enumerate_pages, get_page, get_soup, get_wiki_name, make_wiki_url
 
 from common_pile import logs
@@ -62,7 +62,7 @@ def get_wiki_link(
         time.sleep(wait)
         logger.info(f"Found {ext_url} as the external url for {url}")
         return ext_url
-    except tenacity.RetryError:
+    except (RuntimeError, requests.RequestException):
         logger.error(f"Failed to fetch {url}")
 
 
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""Time `wiki.fix_math` on the math templates collected by find.py.
+
+The fused rewrite is compared against running each math template rewrite as
+its own pass (how fix_math used to work), and the outputs are checked to be
+identical.
+"""
+
+import argparse
+import json
+import time
+
+import wiki
+
+parser = argparse.ArgumentParser(description="Benchmark the math template rewrite.")
+parser.add_argument(
+    "--input",
+    default="math_templates.json",
+    help="The template -> count json written by find.py.",
+)
+parser.add_argument(
+    "--repeats", type=int, default=3, help="Take the best time of this many runs."
+)
+
+
+def fix_math_sequential(text):
+    """fix_math with one pass per template."""
+    text = wiki.remove_template_brackets(
+        text,
+        ("var", "nobreak", "nowrap", "mvar", "linktext", "em", "italics correction"),
+    )
+    text = wiki.fix_equals(text)
+    text = wiki.replace_fraction(text)
+    for name in wiki.MATH_TEMPLATE_REWRITES:
+        text = wiki.replace_math_template(text, name)
+    text = wiki.replace_symbols(text)
+    text = wiki.replace_sup(text)
+    text = wiki.replace_sub(text)
+    text = wiki.replace_mset(text)
+    text = wiki.replace_abs(text)
+    return text
+
+
+def best_time(fn, templates, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        results = [fn(t) for t in templates]
+        best = min(best, time.perf_counter() - start)
+    return best, results
+
+
+def main(args):
+    with open(args.input) as f:
+        templates = list(json.load(f))
+    chars = sum(len(t) for t in templates)
+    print(f"{len(templates):,} unique templates, {chars:,} chars")
+    sequential, expected = best_time(fix_math_sequential, templates, args.repeats)
+    fused, results = best_time(wiki.fix_math, templates, args.repeats)
+    for name, seconds in (("sequential", sequential), ("fused", fused)):
+        print(
+            f"{name}: {seconds:.3f}s ({len(templates) / seconds:,.0f} templates/s, "
+            f"{chars / seconds / 1e6:.1f}M chars/s)"
+        )
+    print(f"speedup: {sequential / fused:.2f}x")
+    if mismatches := sum(e != r for e, r in zip(expected, results)):
+        raise ValueError(f"{mismatches} templates were rewritten differently.")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""Time the wikitext rewrites from preprocess.py on the largest pages in a dump.
+
+The largest pages are the ones that used to hit the parser timeouts, so this
+reports the time (and characters per second) for each rewrite on the `--top`
+longest documents.
+"""
+
+import argparse
+import glob
+import heapq
+import json
+import time
+
+import tqdm
+import wiki
+from smart_open import smart_open
+
+parser = argparse.ArgumentParser(description="Benchmark the wikitext rewrites.")
+parser.add_argument(
+    "--input",
+    required=True,
+    help="Glob of dolma files with raw wikitext, i.e. .../dump/raw/documents/*.jsonl.gz",
+)
+parser.add_argument(
+    "--top", type=int, default=20, help="How many of the largest pages to time."
+)
+parser.add_argument(
+    "--repeats", type=int, default=3, help="Take the best time of this many runs."
+)
+parser.add_argument("--output", help="Where to save the timings as json.")
+
+
+def largest_pages(paths, top):
+    heap = []
+    for path in paths:
+        with smart_open(path) as f:
+            for l in tqdm.tqdm(f, desc=path):
+                if not l:
+                    continue
+                data = json.loads(l)
+                if not (text := data["text"]):
+                    continue
+                item = (len(text), data["id"], text)
+                if len(heap) < top:
+                    heapq.heappush(heap, item)
+                else:
+                    heapq.heappushpop(heap, item)
+    return sorted(heap, reverse=True)
+
+
+# The rewrites in the order preprocess.py applies them.
+STEPS = (
+    ("replace_math_tags", wiki.replace_math_tags),
+    ("adjust_indentation", wiki.adjust_indentation),
+    (
+        "extract_math_templates",
+        lambda t: wiki.extract_templates(t, ("math",), wiki.MATH_MARKER)[0],
+    ),
+    (
+        "extract_raw_templates",
+        lambda t: wiki.extract_templates(t, wiki.MATH_TEMPLATES, wiki.SECOND_MARKER)[0],
+    ),
+)
+
+
+def best_time(fn, text, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn(text)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main(args):
+    pages = largest_pages(sorted(glob.glob(args.input)), args.top)
+    results = []
+    for length, doc_id, text in pages:
+        timings = {}
+        for name, fn in STEPS:
+            timings[name], text = best_time(fn, text, args.repeats)
+        total = sum(timings.values())
+        results.append({"id": doc_id, "chars": length, "seconds": total, **timings})
+        print(
+            f"{doc_id}: {length:,} chars in {total:.3f}s "
+            f"({length / max(total, 1e-9) / 1e6:.1f}M chars/s) "
+            + ", ".join(f"{k}={v:.3f}s" for k, v in timings.items())
+        )
+    if args.output:
+        with open(args.output, "w") as wf:
+            json.dump(results, wf, indent=2)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args)
@@ -1,12 +1,18 @@
 """Tools and utilities for parsing wikitext."""
 
+import bisect
+import functools
 import itertools
+import json
 import os
 import re
-from typing import Dict, List, Set, Tuple
+from typing import Callable, Dict, Iterator, List, Set, Tuple
 
 import requests
 
+from common_pile.cache import memoize
+from common_pile.logs import get_logger
+
 # ᙭᙭᙭᙭᙭ "Canadian Syllabics Chi Sign", a rare unicode that isn't touched by wtf_wikipedia
 MATH_MARKER = "\u166D\u166D\u166D\u166D\u166D"
 # ⇭⇭⇭⇭⇭ "Upwards White Arrow On Pedestal with Vertical Bar", a rare unicode untouched by wtf_wikipedia
@@ -46,18 +52,116 @@ CHAR_SYMBOLS = {
 }
 
 
+@functools.lru_cache(maxsize=None)
+def compile_pattern(pattern: str, flags: int = re.IGNORECASE) -> re.Pattern:
+    """Compile (and cache) a pattern, the rewrites below are run for every document."""
+    return re.compile(pattern, flags)
+
+
+def pair_scopes(text: str, start: str, end: str) -> Dict[int, Tuple[int, int]]:
+    """Match every `start` in text to its `end` with a stack, in one pass.
+
+    Returns a map from the index of each opening to the (start, end) of its
+    closing, (-1, -1) when it is never closed. This gives the same answer as
+    calling `finish_template` on each opening, without rescanning the rest of
+    the text for every opening that is never closed.
+    """
+    scope = compile_pattern(f"(?P<_scope_open>{start})|(?P<_scope_close>{end})")
+    closings = {}
+    stack = []
+    i = 0
+    while m := scope.search(text, i):
+        if m.group("_scope_open") is not None:
+            stack.append(m.start())
+            closings[m.start()] = (-1, -1)
+        elif stack:
+            closings[stack.pop()] = m.span()
+        i = max(m.end(), i + 1)
+    return closings
+
+
+def pair_mustache_scopes(text: str) -> Callable[[int], Tuple[int, int]]:
+    """Build a lookup from the index of a {{ to the (start, end) of its }}.
+
+    This gives the same answer as `finish_mustache_template` for every opening,
+    but is built in a single pass over the braces. Starting after a {{, the
+    scan is at depth 0 and a `}}` at depth 0 closes the template, so `close[k]`
+    is where a scan that starts at the kth brace with depth 0 finishes:
+      * a `}}` is the closing itself,
+      * a lone `}` at depth 0 is ignored, so it is where the next brace finishes,
+      * a `{` has to be matched first, so it is where the brace after its match finishes.
+    """
+    # The scan never looks at the last character.
+    braces = [m.start() for m in MUSTACHE.finditer(text, 0, len(text) - 1)]
+    matches = {}
+    stack = []
+    for k, b in enumerate(braces):
+        if text[b] == "{":
+            stack.append(k)
+        elif stack:
+            matches[stack.pop()] = k
+    close = [-1] * (len(braces) + 1)
+    for k in range(len(braces) - 1, -1, -1):
+        b = braces[k]
+        if text[b] == "}":
+            close[k] = b if text[b + 1] == "}" else close[k + 1]
+        elif k in matches:
+            close[k] = close[matches[k] + 1]
+
+    def finish(pos: int) -> Tuple[int, int]:
+        end = close[bisect.bisect_left(braces, pos + 2)]
+        return (end, end + 2) if end != -1 else (-1, -1)
+
+    return finish
+
+
+def scan_scopes(
+    text: str, opening: str, nest_open: str = "{{", nest_close: str = "}}"
+) -> Iterator[Tuple[re.Match, int, int]]:
+    """Find each top-level scope that starts with `opening` in a single forward scan.
+
+    Yields the match for the opening and the (start, end) of its closing, all
+    indices are into `text`. Openings that are never closed are yielded with a
+    closing of (-1, -1), the scan then continues after the opening.
+
+    Replacing the templates, the math tags, and removing template brackets all
+    share this scan. Searching from a position in the original string (instead
+    of re-searching a text[offset:] slice) and pairing the scopes up front
+    (instead of scanning forward from each opening, which goes to the end of the
+    text for every unclosed one) keeps it linear in the length of the text.
+    """
+    opening = compile_pattern(opening)
+    mustache = nest_open == "{{" and nest_close == "}}"
+    closings = None
+    pos = 0
+    while m := opening.search(text, pos):
+        if closings is None:
+            closings = (
+                pair_mustache_scopes(text)
+                if mustache
+                else pair_scopes(text, nest_open, nest_close).get
+            )
+        if (closing := closings(m.start())) is None:
+            # The opening didn't line up with a nest_open, scan from it instead.
+            closing = finish_template(text, nest_open, nest_close, m.start())
+        end_start, end_end = closing
+        yield m, end_start, end_end
+        pos = m.end() if end_start == -1 else end_end
+
+
 def insert_templates(text: str, templates: List[str], marker) -> str:
     """Replace each instance of marker in text with a template.
 
     re.sub was being annoying about \'s in the replacements.'
     """
+    marker = compile_pattern(marker)
     offset = 0
     new_text = []
     for t in templates:
-        if mark := re.search(marker, text[offset:], re.IGNORECASE):
-            new_text.append(text[offset : offset + mark.span()[0]])
+        if mark := marker.search(text, offset):
+            new_text.append(text[offset : mark.start()])
             new_text.append(t)
-            offset = offset + mark.span()[1]
+            offset = mark.end()
         else:
             # This should be an error, but the logger isn't plumbed into this
             # function atm, just let it go for v0
@@ -67,10 +171,6 @@ def insert_templates(text: str, templates: List[str], marker) -> str:
     return "".join(new_text)
 
 
-# Replacing the templates, the math tags, and the indentation adjustment all have
-# basically the algorithm, but to share code the unique function part would have
-# to be super complex and have access to a bunch of things (the start, end, the
-# matches, etc.) So it isn't worth it to deduplicate this code at the moment.
 def extract_templates(
     text: str, templates: List[str], replacement: str
 ) -> Tuple[str, List[str]]:
@@ -81,28 +181,23 @@ def extract_templates(
     new_text = []
     templates = []
     offset = 0
-    # See `replace_math_tags`
-    while template := re.search(opening, text[offset:], re.IGNORECASE):
+    # We expect there to be far more {{ openings inside the template compared the
+    # the <math> tags, so we need to find the last one. This will dispatch to the
+    # special curly parser.
+    for template, end_start, end_end in scan_scopes(text, opening, "{{", "}}"):
         # Add everything before the template
-        new_text.append(text[offset : offset + template.span()[0]])
-        # Find the closing }}, we expect there to be far more {{ openings inside
-        # the template compared the the <math> tags, so we need to find the last
-        # one. This will dispatch to the special curly parser.
-        end_start, end_end = finish_template(
-            text[offset + template.span()[0] :], "{{", "}}"
-        )
+        new_text.append(text[offset : template.start()])
         # If a template is opened and never finished, we just include everything
+        # after the opening.
         if end_start == -1:
-            offset = offset + template.span()[1]
+            offset = template.end()
             continue
         # Add our template replacement
         new_text.append(replacement)
         # Add the template text to our list of templates.
-        templates.append(
-            text[offset + template.span()[0] : offset + template.span()[0] + end_end]
-        )
-        # Move the search offset in the text to after the template.
-        offset = offset + template.span()[0] + end_end
+        templates.append(text[template.start() : end_end])
+        # Move the offset in the text to after the template.
+        offset = end_end
     # If there is any text left over after the last time we found a template,
     # add that to out new text
     if text[offset:]:
@@ -118,23 +213,21 @@ def remove_template_brackets(text: str, templates: List[str]) -> str:
 
     Examples include: nobreak, nowrap, and var
     """
+    # Removing brackets can't create an opening when there were none to start
+    # with, so check for all of them at once before doing a pass for each.
+    if not compile_pattern(rf"{{{{(?:{'|'.join(templates)}) *?\|?").search(text):
+        return text
     for template in templates:
         opening = rf"{{{{{template} *?\|?"
         new_text = []
         offset = 0
-        while t := re.search(opening, text[offset:], re.IGNORECASE):
-            new_text.append(text[offset : offset + t.span()[0]])
-            end_start, end_end = finish_template(
-                text[offset + t.span()[0] :], "{{", "}}"
-            )
+        for t, end_start, end_end in scan_scopes(text, opening, "{{", "}}"):
+            new_text.append(text[offset : t.start()])
             if end_start == -1:
-                offset = offset + t.span()[1]
+                offset = t.end()
                 continue
-            template_text = text[
-                offset + t.span()[1] : offset + t.span()[0] + end_start
-            ]
-            new_text.append(template_text)
-            offset = offset + t.span()[0] + end_end
+            new_text.append(text[t.end() : end_start])
+            offset = end_end
         if text[offset:]:
             new_text.append(text[offset:])
         text = "".join(new_text)
@@ -143,9 +236,9 @@ def remove_template_brackets(text: str, templates: List[str]) -> str:
 
 def fix_equals(text: str) -> str:
     """wtf_wikipedia can handle the {{math|1=...}} templates but not {{math| ... {{=}} ...}}"""
-    if re.search(r"{{ ?= ?}}|<nowiki>=</nowiki>", text, re.IGNORECASE):
-        text = re.sub(r"{{math ?\|", "{{math|1=", text)
-        return re.sub(r"{{ ?= ?}}|<nowiki>=</nowiki>", "=", text)
+    if compile_pattern(r"{{ ?= ?}}|<nowiki>=</nowiki>").search(text):
+        text = compile_pattern(r"{{math ?\|", 0).sub("{{math|1=", text)
+        return compile_pattern(r"{{ ?= ?}}|<nowiki>=</nowiki>", 0).sub("=", text)
     return text
 
 
@@ -162,8 +255,8 @@ def replace_template(
     nest_close=None,
     recursive: bool = False,
 ) -> str:
-    """Replace templates found in text with a marker. See replace_math_templates
-    for an explaination of the main parsing code.
+    """Replace templates found in text with a marker. See `scan_scopes` for an
+    explaination of the main parsing code.
 
     Note: This function *always* allows for the nesting of *different* templates
           i.e., {{math|{{overline|...}}}}, but recursive=True must be set to
@@ -173,16 +266,13 @@ def replace_template(
     nest_close = nest_close if nest_close else closing
     offset = 0
     new_text = []
-    while m := re.search(opening, text[offset:], re.IGNORECASE):
-        new_text.append(text[offset : offset + m.span()[0]])
-        end_start, end_end = finish_template(
-            text[offset + m.span()[0] :], nest_open, nest_close
-        )
+    for m, end_start, end_end in scan_scopes(text, opening, nest_open, nest_close):
+        new_text.append(text[offset : m.start()])
         if end_start == -1:
-            offset = offset + m.span()[1]
+            offset = m.end()
             continue
         new_text.append(start)
-        between = text[offset + m.span()[1] : offset + m.span()[0] + end_start]
+        between = text[m.end() : end_start]
         if recursive:
             new_text.append(
                 replace_template(
@@ -199,7 +289,7 @@ def replace_template(
         else:
             new_text.append(between)
         new_text.append(end)
-        offset = offset + m.span()[0] + end_end
+        offset = end_end
     if trailing := text[offset:]:
         new_text.append(trailing)
     return "".join(new_text)
@@ -217,122 +307,204 @@ def replace_sup(text: str) -> str:
     return replace_template(text, r"<sup>", r"</sup>", "^{", "}", recursive=True)
 
 
+# The {{...}} templates that are rewritten to latex, in the order fix_math has
+# always applied them, as (opening, latex start, latex end).
+MATH_TEMPLATE_REWRITES = {
+    "prime": (r"{{(?:[Pp]rime|′) ?\|", "", "'"),
+    "overline": (r"{{[Oo]verline ?\|?", r"\overline{", "}"),
+    "overbar": (r"{{[Oo]verbar ?\|", r"\overbar{", "}"),
+    "overarc": (r"{{[Oo]verarc ?\|", r"\overarc{", "}"),
+    "radical": (r"{{[Rr]adic(?:al)? ?\|", r"\sqrt{", "}"),
+    "mathcal": (r"{{[Mm]athcal ?\|", r"\mathcal{", "}"),
+    "mathbb": (r"{{[Mm]athbb ?\|", r"\mathbb{", "}"),
+    # TODO: Replace ''' with \mathbf{}?
+    "strong": (r"{{[Ss]trong ?\|", r"\mathbf{", "}"),
+    "ceil": (r"{{[Cc]eil ?\|", r"\ceil{", "}"),
+    "floor": (r"{{[Ff]loor ?\|", r"\floor{", "}"),
+    "norm": (r"{{[Nn]orm ?\|", rf"\{ABS_MARKER}", rf"\{ABS_MARKER}"),
+    "open_closed": (r"{{[Oo]pen-[Cc]losed ?\|", "(", "]"),
+    "open_open": (r"{{[Oo]pen-[Oo]pen ?\|", "(", ")"),
+    "closed_closed": (r"{{[Cc]losed-[Cc]losed ?\|", "[", "]"),
+    "closed_open": (r"{{[Cc]losed-[Oo]pen ?\|", "[", ")"),
+    "bra": (r"{{[Bb]ra ?\|", r"\langle", ABS_MARKER),
+    "ket": (r"{{[Kk]et ?\|", ABS_MARKER, r"\rangle"),
+    "brace": (r"{{[Bb]race ?\|", r"\{", r"\}"),
+    "angle_bracket": (r"{{[Aa]ngle ?[Bb]racket ?\|", r"\langle", r"\rangle"),
+}
+# One alternation that finds the opening of any of them, the group name says
+# which. The shared {{ is pulled out front so the regex only tries the names
+# where there is a {{.
+MATH_TEMPLATE_PATTERN = "{{(?:%s)" % "|".join(
+    f"(?P<{name}>{opening[len('{{'):]})"
+    for name, (opening, _, _) in MATH_TEMPLATE_REWRITES.items()
+)
+# The same openings with only one {.
+MATH_TEMPLATE_HALF_PATTERN = "{(?<!{{)(?:%s)" % "|".join(
+    opening[len("{{") :] for opening, _, _ in MATH_TEMPLATE_REWRITES.values()
+)
+
+
+def replace_math_template(text: str, name: str) -> str:
+    opening, start, end = MATH_TEMPLATE_REWRITES[name]
+    return replace_template(text, opening, "}}", start, end, nest_open="{{")
+
+
 def replace_radical(text: str) -> str:
-    opening = r"{{[Rr]adic(?:al)? ?\|"
-    closing = r"}}"
-    return replace_template(text, opening, closing, "\sqrt{", "}", nest_open="{{")
+    return replace_math_template(text, "radical")
 
 
 def replace_prime(text: str) -> str:
-    opening = r"{{(?:[Pp]rime|′) ?\|"
-    closing = r"}}"
-    return replace_template(text, opening, closing, "", "'", nest_open="{{")
+    return replace_math_template(text, "prime")
 
 
 def replace_fraction(text: str) -> str:
     """{{Fraction|}} isn't handled by wtf_wikipedia but {{sfrac|...}} is."""
-    text = re.sub(r"{{[Ff]ract(?:ion)?(?:/sandbox)? ?\|", "{{sfrac|", text)
-    return re.sub(r"{{sfrac/sandbox ?\|", "{{sfrac|", text)
+    text = compile_pattern(r"{{[Ff]ract(?:ion)?(?:/sandbox)? ?\|", 0).sub(
+        "{{sfrac|", text
+    )
+    return compile_pattern(r"{{sfrac/sandbox ?\|", 0).sub("{{sfrac|", text)
 
 
 def replace_overline(text: str) -> str:
-    opening = r"{{[Oo]verline ?\|?"
-    closing = r"}}"
-    return replace_template(text, opening, closing, r"\overline{", "}", nest_open="{{")
+    return replace_math_template(text, "overline")
 
 
 def replace_overbar(text: str) -> str:
-    opening = r"{{[Oo]verbar ?\|"
-    return replace_template(text, opening, "}}", r"\overbar{", "}", nest_open="{{")
+    return replace_math_template(text, "overbar")
 
 
 def replace_overarc(text: str) -> str:
-    opening = r"{{[Oo]verarc ?\|"
-    return replace_template(text, opening, "}}", r"\overarc{", "}", nest_open="{{")
+    return replace_math_template(text, "overarc")
 
 
 def replace_mathcal(text: str) -> str:
-    opening = r"{{[Mm]athcal ?\|"
-    return replace_template(text, opening, "}}", r"\mathcal{", "}", nest_open="{{")
+    return replace_math_template(text, "mathcal")
 
 
 def replace_mathbb(text: str) -> str:
-    opening = r"{{[Mm]athbb ?\|"
-    return replace_template(text, opening, "}}", r"\mathbb{", "}", nest_open="{{")
+    return replace_math_template(text, "mathbb")
 
 
-# TODO: Replace ''' with \mathbf{}?
 def replace_strong(text: str) -> str:
-    opening = r"{{[Ss]trong ?\|"
-    return replace_template(text, opening, "}}", r"\mathbf{", "}", nest_open="{{")
+    return replace_math_template(text, "strong")
 
 
 def replace_ceil(text: str) -> str:
-    opening = r"{{[Cc]eil ?\|"
-    return replace_template(text, opening, "}}", r"\ceil{", "}", nest_open="{{")
+    return replace_math_template(text, "ceil")
 
 
 def replace_floor(text: str) -> str:
-    opening = r"{{[Ff]loor ?\|"
-    return replace_template(text, opening, "}}", r"\floor{", "}", nest_open="{{")
+    return replace_math_template(text, "floor")
 
 
 def replace_norm(text: str) -> str:
-    opening = r"{{[Nn]orm ?\|"
-    return replace_template(
-        text, opening, "}}", rf"\{ABS_MARKER}", rf"\{ABS_MARKER}", nest_open="{{"
-    )
+    return replace_math_template(text, "norm")
 
 
 def replace_open_closed(text: str) -> str:
-    opening = r"{{[Oo]pen-[Cc]losed ?\|"
-    return replace_template(text, opening, "}}", "(", "]", nest_open="{{")
+    return replace_math_template(text, "open_closed")
 
 
 def replace_open_open(text: str) -> str:
-    opening = r"{{[Oo]pen-[Oo]pen ?\|"
-    return replace_template(text, opening, "}}", "(", ")", nest_open="{{")
+    return replace_math_template(text, "open_open")
 
 
 def replace_closed_closed(text: str) -> str:
-    opening = r"{{[Cc]losed-[Cc]losed ?\|"
-    return replace_template(text, opening, "}}", "[", "]", nest_open="{{")
+    return replace_math_template(text, "closed_closed")
 
 
 def replace_closed_open(text: str) -> str:
-    opening = r"{{[Cc]losed-[Oo]pen ?\|"
-    return replace_template(text, opening, "}}", "[", ")", nest_open="{{")
+    return replace_math_template(text, "closed_open")
 
 
 def replace_bra(text: str) -> str:
-    opening = r"{{[Bb]ra ?\|"
-    return replace_template(text, opening, "}}", r"\langle", ABS_MARKER, nest_open="{{")
+    return replace_math_template(text, "bra")
 
 
 def replace_ket(text: str) -> str:
-    opening = r"{{[Kk]et ?\|"
-    return replace_template(text, opening, "}}", ABS_MARKER, r"\rangle", nest_open="{{")
+    return replace_math_template(text, "ket")
 
 
 def replace_brace(text: str) -> str:
-    opening = r"{{[Bb]race ?\|"
-    return replace_template(text, opening, "}}", r"\{", r"\}", nest_open="{{")
+    return replace_math_template(text, "brace")
 
 
 def replace_angle_bracket(text: str) -> str:
-    opening = r"{{[Aa]ngle ?[Bb]racket ?\|"
-    return replace_template(text, opening, "}}", r"\langle", r"\rangle", nest_open="{{")
+    return replace_math_template(text, "angle_bracket")
+
+
+def rewrite_math_templates(text: str) -> str:
+    """Apply every rewrite in MATH_TEMPLATE_REWRITES in a single traversal.
+
+    This is the same as calling the replace_* functions one after another, but
+    all the openings are found with one alternation and the templates are paired
+    with their closings once. Nested templates are tracked with a stack, a
+    template nested inside one of the same kind is left as is, like the
+    non-recursive single passes do.
+
+    The passes can only see each other's output when a template is never
+    closed, or when a rewrite glues text together into a new opening. The
+    result then depends on the order the passes run in, so that text falls
+    back to running them one at a time.
+    """
+    matches = list(compile_pattern(MATH_TEMPLATE_PATTERN).finditer(text))
+    if not matches:
+        return text
+    # A rewrite that ends in { turns a {name| after it into a new opening.
+    if compile_pattern(MATH_TEMPLATE_HALF_PATTERN).search(text):
+        return _rewrite_math_templates_sequential(text)
+    finish = pair_mustache_scopes(text)
+    edits = []
+    # The (name, closing start) of the templates we are currently inside of.
+    stack = []
+    for m in matches:
+        while stack and stack[-1][1] <= m.start():
+            stack.pop()
+        name = m.lastgroup
+        end_start, end_end = finish(m.start())
+        if end_start == -1 or (stack and end_end > stack[-1][1]):
+            return _rewrite_math_templates_sequential(text)
+        if any(n == name for n, _ in stack):
+            continue
+        _, start, end = MATH_TEMPLATE_REWRITES[name]
+        # Removing the opening of a {{prime|...}} joins the text on either side,
+        # which can finish the name of a template that was being opened.
+        if not start and text.rfind("{", 0, m.start()) > max(
+            text.rfind("|", 0, m.start()), text.rfind("}", 0, m.start())
+        ):
+            return _rewrite_math_templates_sequential(text)
+        edits.append((m.start(), m.end(), start))
+        edits.append((end_start, end_end, end))
+        stack.append((name, end_start))
+    edits.sort()
+    new_text = []
+    offset = 0
+    for edit_start, edit_end, replacement in edits:
+        new_text.append(text[offset:edit_start])
+        new_text.append(replacement)
+        offset = edit_end
+    new_text.append(text[offset:])
+    return "".join(new_text)
+
+
+def _rewrite_math_templates_sequential(text: str) -> str:
+    for name in MATH_TEMPLATE_REWRITES:
+        text = replace_math_template(text, name)
+    return text
 
 
 def replace_symbols(
     text: str, symbols: Dict[str, str] = CHAR_SYMBOLS, include_money: bool = False
 ) -> str:
     """Replace templates that evaulate to a symbol {{pi}} -> 𝛑 with the latex version."""
+    # Most math has no symbols at all, so check for any of them in one search first.
+    if not compile_pattern(rf"{{{{(?:{'|'.join(symbols)})}}}}").search(text):
+        return text
     for template, latex in symbols.items():
         # re.sub was being difficult about including something like \p in the
         # replacement string. So do it manually.
         # text = re.sub(rf"{{{{{template}}}}}", latex, text)
-        if m := re.search(rf"{{{{{template}}}}}", text, re.IGNORECASE):
+        if m := compile_pattern(rf"{{{{{template}}}}}").search(text):
             if include_money:
                 latex = f"${latex}$"
             text = "".join((text[: m.span()[0]], latex, text[m.span()[1] :]))
@@ -383,25 +555,7 @@ def fix_math(text):
     )
     text = fix_equals(text)
     text = replace_fraction(text)
-    text = replace_prime(text)
-    text = replace_overline(text)
-    text = replace_overbar(text)
-    text = replace_overarc(text)
-    text = replace_radical(text)
-    text = replace_mathcal(text)
-    text = replace_mathbb(text)
-    text = replace_strong(text)
-    text = replace_ceil(text)
-    text = replace_floor(text)
-    text = replace_norm(text)
-    text = replace_open_closed(text)
-    text = replace_open_open(text)
-    text = replace_closed_closed(text)
-    text = replace_closed_open(text)
-    text = replace_bra(text)
-    text = replace_ket(text)
-    text = replace_brace(text)
-    text = replace_angle_bracket(text)
+    text = rewrite_math_templates(text)
     text = replace_symbols(text)
     text = replace_sup(text)
     text = replace_sub(text)
@@ -424,27 +578,19 @@ def replace_math_tags(text: str) -> str:
     math_closing = r"</math>"
     offset = 0
     new_text = []
-    # Find the first math tag in the text, we will increment where we start our
-    # search to be after these <math></math> tags to find the next on.
-    # All regex positions are based of the text[offset:] slice we we need to add
-    # offset to them when using them to index the whole string
-    while math := re.search(math_opening, text[offset:], re.IGNORECASE):
-        # Add everything before the first match.
-        new_text.append(text[offset : offset + math.span()[0]])
-
-        # Find the closing </math> associated with this tag. This index is relative
-        # to the slice of text starting with the location of the opening tag match
-        # so we need to add the start offset and the offset to index into the
-        # original string.
-        end_start, end_end = finish_template(
-            text[offset + math.span()[0] :], math_opening, math_closing
-        )
+    # Find each math tag and the closing </math> associated with it, all the
+    # positions index into the whole string.
+    for math, end_start, end_end in scan_scopes(
+        text, math_opening, math_opening, math_closing
+    ):
+        # Add everything before the match.
+        new_text.append(text[offset : math.start()])
         # This happens when there is a start tag but no end tag. For example,
         # in talk page 1-9564, they have `<math>` as a symbol (it is inside <nowiki>)
         if end_start == -1:
             # TODO: Add logging
             # Skip processing the scope for this one and then continue looking for more matches
-            offset = offset + math.span()[1]
+            offset = math.end()
             continue
         # <math display="inline"> and <math display=inline> should use $
         # <math display="block"> and <math display=block> should use $$
@@ -454,18 +600,17 @@ def replace_math_tags(text: str) -> str:
         #   don't need any marking for this special case, just use $$
         new_text.append("$" if math.group("type") == "inline" else "$$")
 
-        math_text = text[offset + math.span()[1] : offset + math.span()[0] + end_start]
         # We shouldn't have nested <math> tags, but it is wikitext so *shrug*.
         # We could recurse to replace nested <math...> tags but that would cause
         # latex errors so instead we log an error.
         # if m := re.search(math_opening, math_text):
         #     logger.error("...")
         # Add the text /after/ the opening tag, but /before/ the closing tag.
-        new_text.append(math_text)
+        new_text.append(text[math.end() : end_start])
         # Same choices as above.
         new_text.append("$ " if math.group("type") == "inline" else "$$")
-        # Move the search offset to /after/ the closing tag.
-        offset = offset + math.span()[0] + end_end
+        # Move the offset to /after/ the closing tag.
+        offset = end_end
     if text[offset:]:
         new_text.append(text[offset:])
     return "".join(new_text)
@@ -638,36 +783,38 @@ SKIP_SECTIONS = frozenset(
 
 ##
 # These function look ahead in the text to find the end of a scope.
-def finish_template(text, start="{{", end="}}"):
+def finish_template(text, start="{{", end="}}", pos: int = 0):
     """Find the end of a template by looking for `end`.
 
-    text should start with the `start` template that we are looking to finish.
+    text[pos:] should start with the `start` template that we are looking to
+    finish. The returned (start, end) of the closing index into `text`.
 
     This handles nested scoping as long as the "start" regex matches all openings
     to scopes, otherwise it is possible to have the end of an unfound opening be
     considered the final end.
     """
     if start == "{{" and end == "}}":
-        return finish_mustache_template(text)
-    i = 0
+        return finish_mustache_template(text, pos)
+    # Jump between the openings and closings, an opening is preferred when both
+    # match at the same position.
+    scope = compile_pattern(f"(?P<_scope_open>{start})|(?P<_scope_close>{end})")
     templates = 0
-    while i < len(text):
-        if m := re.search(f"^{start}", text[i:], re.IGNORECASE):
+    i = pos
+    while m := scope.search(text, i):
+        if m.group("_scope_open") is not None:
             templates += 1
-            # Note: .span is based on the slice so it is basically the length of the match
-            i += m.span()[1] - 1
-        elif m := re.search(f"^{end}", text[i:], re.IGNORECASE):
+        else:
             templates -= 1
-            # Note: .span is based on the slice so it is basically the length of the match
-            begin = i + m.span()[0]
-            i += m.span()[1] - 1
             if templates == 0:
-                return begin, i + 1
-        i += 1
+                return m.start(), m.end()
+        i = max(m.end(), i + 1)
     return -1, -1
 
 
-def finish_mustache_template(text):
+MUSTACHE = re.compile(r"[{}]")
+
+
+def finish_mustache_template(text, pos: int = 0):
     """This is a special case of template finding where `{` and `}` are considered
     scopes that we must close before finding }}.
 
@@ -675,23 +822,25 @@ def finish_mustache_template(text):
 
     In ambiguous cases like {{{, it parses to {{, { for opening the scopes.
     """
-    i = 2
+    i = pos + 2
+    last = len(text) - 1
     scopes = ["{{"]
-    while i < len(text) - 1:
+    # Skip straight to the next curly brace, everything else is ignored.
+    while m := MUSTACHE.search(text, i, last):
+        i = m.start()
         if text[i] == "{":
             scopes.append("{")
-        elif text[i] == "}":
-            if text[i + 1] == "}":
-                if scopes and scopes[-1] == "{{":
-                    scopes.pop()
-                    i += 1
-                elif scopes and scopes[-1] == "{":
-                    scopes.pop()
-                if not scopes:
-                    return i - 1, i + 1
-            else:
-                if scopes and scopes[-1] == "{":
-                    scopes.pop()
+        elif text[i + 1] == "}":
+            if scopes and scopes[-1] == "{{":
+                scopes.pop()
+                i += 1
+            elif scopes and scopes[-1] == "{":
+                scopes.pop()
+            if not scopes:
+                return i - 1, i + 1
+        else:
+            if scopes and scopes[-1] == "{":
+                scopes.pop()
         i += 1
     return -1, -1
 
@@ -711,6 +860,36 @@ def wiki_to_dir(wiki_id, chars: int = 2, levels: int = 2):
     return os.path.join(*parts)
 
 
+PARSER_DIR = os.path.join(os.path.dirname(__file__), "parser")
+PARSER_PACKAGES = ("wtf_wikipedia", "wtf-plugin-api", "wtf-plugin-latex")
+
+
+def parser_version(parser_dir: str = PARSER_DIR) -> str:
+    """The installed versions of the packages the parser server uses.
+
+    Falls back to the version ranges of package.json when they aren't installed
+    here, e.g. when the server runs on another machine.
+    """
+    with open(os.path.join(parser_dir, "package.json")) as f:
+        versions = json.load(f)["dependencies"]
+    for package in PARSER_PACKAGES:
+        path = os.path.join(parser_dir, "node_modules", package, "package.json")
+        if os.path.exists(path):
+            with open(path) as f:
+                versions[package] = json.load(f)["version"]
+        else:
+            get_logger().warning(
+                "%s isn't installed in %s, using %s from package.json as its version.",
+                package,
+                parser_dir,
+                versions.get(package),
+            )
+    return ",".join(f"{p}={versions.get(p)}" for p in PARSER_PACKAGES)
+
+
+# The parser output only depends on the wikitext, the id and source are just
+# for logging on the server.
+@memoize("wtf_wikipedia", version=parser_version)
 def parse_wikitext(
     text, doc_id, source, host: str = "http://localhost", port: int = 5000
 ):
@@ -787,18 +966,20 @@ def adjust_indentation(text: str) -> str:
     stack seems to be much smaller when using multiprocessing (I only the max
     recursion depth exceeded error when running within dolma).
     """
+    indent_pattern = compile_pattern("^:+.+$", re.MULTILINE | re.IGNORECASE)
     result = []
-    while indent := re.search("^:+.+$", text, re.MULTILINE | re.IGNORECASE):
+    offset = 0
+    while indent := indent_pattern.search(text, offset):
         # The :ident is on the last line, "\n" isn't matched so subtract 1
-        if indent.span()[1] >= (len(text) - 1):
-            result.append(text)
+        if indent.end() >= (len(text) - 1):
+            result.append(text[offset:])
             break
 
-        result.append(text[: indent.span()[1] + 1])
-        if text[indent.span()[1] + 1] not in (":", "\n"):
+        result.append(text[offset : indent.end() + 1])
+        if text[indent.end() + 1] not in (":", "\n"):
             result.append("\n")
 
-        text = text[indent.span()[1] + 1 :]
+        offset = indent.end() + 1
     else:
-        result.append(text)
+        result.append(text[offset:])
     return "".join(result)
@@ -0,0 +1,486 @@
+"""Equivalence tests for the single-pass scanner in wiki.py.
+
+The reference_* functions are the original implementations, which re-searched
+a `text[offset:]` slice (and `finish_template` did so once per character). The
+rewrites must produce identical output.
+"""
+
+import random
+import re
+from typing import List, Tuple
+
+import pytest
+from wiki import wiki
+
+
+def reference_insert_templates(text: str, templates: List[str], marker) -> str:
+    offset = 0
+    new_text = []
+    for t in templates:
+        if mark := re.search(marker, text[offset:], re.IGNORECASE):
+            new_text.append(text[offset : offset + mark.span()[0]])
+            new_text.append(t)
+            offset = offset + mark.span()[1]
+        else:
+            pass
+    if trailing := text[offset:]:
+        new_text.append(trailing)
+    return "".join(new_text)
+
+
+def reference_extract_templates(
+    text: str, templates: List[str], replacement: str
+) -> Tuple[str, List[str]]:
+    opening = rf"{{{{(?:{'|'.join(templates)}) *?\|"
+    new_text = []
+    templates = []
+    offset = 0
+    while template := re.search(opening, text[offset:], re.IGNORECASE):
+        new_text.append(text[offset : offset + template.span()[0]])
+        end_start, end_end = reference_finish_template(
+            text[offset + template.span()[0] :], "{{", "}}"
+        )
+        if end_start == -1:
+            offset = offset + template.span()[1]
+            continue
+        new_text.append(replacement)
+        templates.append(
+            text[offset + template.span()[0] : offset + template.span()[0] + end_end]
+        )
+        offset = offset + template.span()[0] + end_end
+    if text[offset:]:
+        new_text.append(text[offset:])
+    new_text = "".join(new_text)
+    assert len(re.findall(replacement, new_text)) == len(templates)
+    return new_text, templates
+
+
+def reference_remove_template_brackets(text: str, templates: List[str]) -> str:
+    for template in templates:
+        opening = rf"{{{{{template} *?\|?"
+        new_text = []
+        offset = 0
+        while t := re.search(opening, text[offset:], re.IGNORECASE):
+            new_text.append(text[offset : offset + t.span()[0]])
+            end_start, end_end = reference_finish_template(
+                text[offset + t.span()[0] :], "{{", "}}"
+            )
+            if end_start == -1:
+                offset = offset + t.span()[1]
+                continue
+            template_text = text[
+                offset + t.span()[1] : offset + t.span()[0] + end_start
+            ]
+            new_text.append(template_text)
+            offset = offset + t.span()[0] + end_end
+        if text[offset:]:
+            new_text.append(text[offset:])
+        text = "".join(new_text)
+    return text
+
+
+def reference_replace_template(
+    text: str,
+    opening,
+    closing,
+    start,
+    end,
+    nest_open=None,
+    nest_close=None,
+    recursive: bool = False,
+) -> str:
+    nest_open = nest_open if nest_open else opening
+    nest_close = nest_close if nest_close else closing
+    offset = 0
+    new_text = []
+    while m := re.search(opening, text[offset:], re.IGNORECASE):
+        new_text.append(text[offset : offset + m.span()[0]])
+        end_start, end_end = reference_finish_template(
+            text[offset + m.span()[0] :], nest_open, nest_close
+        )
+        if end_start == -1:
+            offset = offset + m.span()[1]
+            continue
+        new_text.append(start)
+        between = text[offset + m.span()[1] : offset + m.span()[0] + end_start]
+        if recursive:
+            new_text.append(
+                reference_replace_template(
+                    between,
+                    opening,
+                    closing,
+                    start,
+                    end,
+                    nest_open,
+                    nest_close,
+                    recursive,
+                )
+            )
+        else:
+            new_text.append(between)
+        new_text.append(end)
+        offset = offset + m.span()[0] + end_end
+    if trailing := text[offset:]:
+        new_text.append(trailing)
+    return "".join(new_text)
+
+
+def reference_replace_math_tags(text: str) -> str:
+    math_opening = r'<math(?: display="?(?P<type>inline|block)"?)?>'
+    math_closing = r"</math>"
+    offset = 0
+    new_text = []
+    while math := re.search(math_opening, text[offset:], re.IGNORECASE):
+        new_text.append(text[offset : offset + math.span()[0]])
+
+        end_start, end_end = reference_finish_template(
+            text[offset + math.span()[0] :], math_opening, math_closing
+        )
+        if end_start == -1:
+            offset = offset + math.span()[1]
+            continue
+        new_text.append("$" if math.group("type") == "inline" else "$$")
+
+        math_text = text[offset + math.span()[1] : offset + math.span()[0] + end_start]
+        new_text.append(math_text)
+        new_text.append("$ " if math.group("type") == "inline" else "$$")
+        offset = offset + math.span()[0] + end_end
+    if text[offset:]:
+        new_text.append(text[offset:])
+    return "".join(new_text)
+
+
+def reference_finish_template(text, start="{{", end="}}"):
+    if start == "{{" and end == "}}":
+        return reference_finish_mustache_template(text)
+    i = 0
+    templates = 0
+    while i < len(text):
+        if m := re.search(f"^{start}", text[i:], re.IGNORECASE):
+            templates += 1
+            i += m.span()[1] - 1
+        elif m := re.search(f"^{end}", text[i:], re.IGNORECASE):
+            templates -= 1
+            begin = i + m.span()[0]
+            i += m.span()[1] - 1
+            if templates == 0:
+                return begin, i + 1
+        i += 1
+    return -1, -1
+
+
+def reference_finish_mustache_template(text):
+    i = 2
+    scopes = ["{{"]
+    while i < len(text) - 1:
+        if text[i] == "{":
+            scopes.append("{")
+        elif text[i] == "}":
+            if text[i + 1] == "}":
+                if scopes and scopes[-1] == "{{":
+                    scopes.pop()
+                    i += 1
+                elif scopes and scopes[-1] == "{":
+                    scopes.pop()
+                if not scopes:
+                    return i - 1, i + 1
+            else:
+                if scopes and scopes[-1] == "{":
+                    scopes.pop()
+        i += 1
+    return -1, -1
+
+
+def reference_adjust_indentation(text: str) -> str:
+    result = []
+    while indent := re.search("^:+.+$", text, re.MULTILINE | re.IGNORECASE):
+        if indent.span()[1] >= (len(text) - 1):
+            result.append(text)
+            break
+
+        result.append(text[: indent.span()[1] + 1])
+        if text[indent.span()[1] + 1] not in (":", "\n"):
+            result.append("\n")
+
+        text = text[indent.span()[1] + 1 :]
+    else:
+        result.append(text)
+    return "".join(result)
+
+
+def reference_replace_symbols(text: str, symbols=wiki.CHAR_SYMBOLS) -> str:
+    for template, latex in symbols.items():
+        if m := re.search(rf"{{{{{template}}}}}", text, re.IGNORECASE):
+            text = "".join((text[: m.span()[0]], latex, text[m.span()[1] :]))
+    return text
+
+
+def reference_rewrite_math_templates(text: str) -> str:
+    """The math template rewrites as separate passes, in the original order."""
+    for opening, start, end in wiki.MATH_TEMPLATE_REWRITES.values():
+        text = reference_replace_template(text, opening, "}}", start, end, "{{")
+    return text
+
+
+def reference_fix_math(text: str) -> str:
+    text = reference_remove_template_brackets(
+        text,
+        ("var", "nobreak", "nowrap", "mvar", "linktext", "em", "italics correction"),
+    )
+    text = wiki.fix_equals(text)
+    text = wiki.replace_fraction(text)
+    text = reference_rewrite_math_templates(text)
+    text = reference_replace_symbols(text)
+    text = reference_replace_template(
+        text, r"<sup>", r"</sup>", "^{", "}", None, None, True
+    )
+    text = reference_replace_template(
+        text, r"<sub>", r"</sub>", "_{", "}", None, None, True
+    )
+    text = reference_replace_template(
+        text, r"{{[Mm]set\|?", r"}}", r"\{", r"\}", "{{", None, True
+    )
+    text = text.replace("{{!}}", wiki.ABS_MARKER)
+    text = text.replace("<nowiki>|</nowiki>", wiki.ABS_MARKER)
+    text = text.replace("<nowiki>||</nowiki>", f"{wiki.ABS_MARKER}{wiki.ABS_MARKER}")
+    return reference_replace_template(
+        text,
+        r"{{[Mm]?[Aa]bs ?\|?",
+        r"}}",
+        wiki.ABS_MARKER,
+        wiki.ABS_MARKER,
+        "{{",
+        None,
+        True,
+    )
+
+
+# Fragments that exercise nesting, unclosed scopes, mixed case, and the math
+# display types.
+FRAGMENTS = (
+    "{{",
+    "}}",
+    "{",
+    "}",
+    "{{math|",
+    "{{Math |",
+    "{{mvar|",
+    "{{nowrap|",
+    "{{overline|",
+    "{{Overline",
+    "{{abs|",
+    "{{mset|",
+    "{{radic|",
+    "{{pi}}",
+    "<math>",
+    '<math display="inline">',
+    "<math display=block>",
+    "</math>",
+    "<sub>",
+    "</sub>",
+    "<sup>",
+    "</SUP>",
+    "\n",
+    "\n:",
+    "\n::",
+    ":",
+    "x",
+    "y = 2",
+    " ",
+    "|",
+    "abc",
+)
+
+
+def random_wikitext(rng: random.Random, length: int) -> str:
+    return "".join(rng.choice(FRAGMENTS) for _ in range(length))
+
+
+def random_texts(n: int = 200, seed: int = 1234):
+    rng = random.Random(seed)
+    return [random_wikitext(rng, rng.randint(0, 60)) for _ in range(n)]
+
+
+# Math templates are mostly well formed, so also generate nested templates that
+# are closed, with the odd stray brace, to exercise the fused rewrite.
+MATH_OPENINGS = (
+    "{{overline|",
+    "{{Overline",
+    "{{mathbb|",
+    "{{prime|",
+    "{{norm|",
+    "{{brace|",
+    "{{bra|",
+    "{{ket|",
+    "{{radic|",
+    "{{open-open|",
+    "{{angle bracket|",
+    "{{strong |",
+    "{{abs|",
+    "{{mset|",
+    "{{math|",
+    "{{nowrap|",
+    "{{fraction|",
+)
+MATH_LEAVES = (
+    "x",
+    "|",
+    " ",
+    "{{pi}}",
+    "{{=}}",
+    "{{!}}",
+    "<sup>2</sup>",
+    "{",
+    "}",
+    "{x}",
+)
+
+
+def random_math(rng: random.Random, depth: int = 0) -> str:
+    parts = []
+    for _ in range(rng.randint(0, 4)):
+        if depth < 4 and rng.random() < 0.5:
+            inner = random_math(rng, depth + 1)
+            parts.append(f"{rng.choice(MATH_OPENINGS)}{inner}}}}}")
+        else:
+            parts.append(rng.choice(MATH_LEAVES))
+    return "".join(parts)
+
+
+def random_math_texts(n: int = 500, seed: int = 4321):
+    rng = random.Random(seed)
+    return [random_math(rng) for _ in range(n)]
+
+
+EXAMPLES = (
+    "",
+    "no templates here",
+    "{{math|x {{overline|y}} z}} and {{math|unclosed",
+    "a <math>x^2</math> b <math display=inline>y</math> c <math>unclosed",
+    "X<sub>i<sub>j</sub></sub> and X<sup>2</sup>",
+    ":indent\ntext\n::more\n:\nlast",
+    ":only an indent",
+)
+
+
+@pytest.mark.parametrize("text", EXAMPLES + tuple(random_texts()))
+def test_extract_templates(text):
+    assert wiki.extract_templates(
+        text, ("math", "mvar"), wiki.MATH_MARKER
+    ) == reference_extract_templates(text, ("math", "mvar"), wiki.MATH_MARKER)
+
+
+@pytest.mark.parametrize("text", EXAMPLES + tuple(random_texts()))
+def test_insert_templates(text):
+    extracted, templates = reference_extract_templates(
+        text, ("math",), wiki.MATH_MARKER
+    )
+    # Include more templates than markers to hit the missing marker case.
+    templates = templates + ["{{extra}}"]
+    assert wiki.insert_templates(
+        extracted, templates, wiki.MATH_MARKER
+    ) == reference_insert_templates(extracted, templates, wiki.MATH_MARKER)
+
+
+@pytest.mark.parametrize("text", EXAMPLES + tuple(random_texts()))
+def test_remove_template_brackets(text):
+    templates = ("var", "nowrap", "mvar")
+    assert wiki.remove_template_brackets(
+        text, templates
+    ) == reference_remove_template_brackets(text, templates)
+
+
+@pytest.mark.parametrize(
+    "args",
+    (
+        (r"<sub>", r"</sub>", "_{", "}", None, None, True),
+        (r"<sup>", r"</sup>", "^{", "}", None, None, True),
+        (r"{{[Oo]verline ?\|?", r"}}", r"\overline{", "}", "{{", None, False),
+        (r"{{[Mm]?[Aa]bs ?\|?", r"}}", "|", "|", "{{", None, True),
+        (r"{{[Mm]set\|?", r"}}", r"\{", r"\}", "{{", None, True),
+    ),
+)
+@pytest.mark.parametrize("text", EXAMPLES + tuple(random_texts(100)))
+def test_replace_template(text, args):
+    assert wiki.replace_template(text, *args) == reference_replace_template(text, *args)
+
+
+@pytest.mark.parametrize("text", EXAMPLES + tuple(random_texts()))
+def test_replace_math_tags(text):
+    assert wiki.replace_math_tags(text) == reference_replace_math_tags(text)
+
+
+@pytest.mark.parametrize("text", EXAMPLES + tuple(random_texts()))
+def test_adjust_indentation(text):
+    assert wiki.adjust_indentation(text) == reference_adjust_indentation(text)
+
+
+@pytest.mark.parametrize("text", tuple(random_texts(100)))
+@pytest.mark.parametrize(
+    "scope",
+    (
+        ("{{", "}}"),
+        ("<sub>", "</sub>"),
+        (r'<math(?: display="?(?P<type>inline|block)"?)?>', "</math>"),
+    ),
+)
+def test_finish_template_from_offset(text, scope):
+    start, end = scope
+    # Finishing from an offset into the full text should match finishing on the slice.
+    for m in re.finditer(start, text, re.IGNORECASE):
+        expected = reference_finish_template(text[m.start() :], start, end)
+        if expected != (-1, -1):
+            expected = (expected[0] + m.start(), expected[1] + m.start())
+        assert wiki.finish_template(text, start, end, m.start()) == expected
+
+
+@pytest.mark.parametrize("text", EXAMPLES + tuple(random_texts()))
+def test_pair_mustache_scopes(text):
+    finish = wiki.pair_mustache_scopes(text)
+    for i in range(len(text)):
+        if not text.startswith("{{", i):
+            continue
+        expected = reference_finish_mustache_template(text[i:])
+        if expected != (-1, -1):
+            expected = (expected[0] + i, expected[1] + i)
+        assert finish(i) == expected
+
+
+MATH_EXAMPLES = (
+    "{{math|x {{overline|{{mathbb|R}}}} = {{norm|v}}}}",
+    "{{overline|{{overline|x}}}}",
+    "{{overline|{mathbb|x}}}",
+    "{{bra|a}}{{ket|b}} {{pi}} {{pi}} {{Delta}}",
+    "{{abs|{{abs|x}}}} {{mset|1, {{mset|2}}}} X<sub>i<sub>j</sub></sub>",
+    "{{Fraction|1|2}} {{math|1 {{=}} 1}}",
+    "{{overline|unclosed {{mathbb|R}}",
+    "{{Overline{{prime| x}}}}",
+    "a{{{prime|{mathbb|x}}}} y}}",
+)
+
+
+@pytest.mark.parametrize(
+    "text", MATH_EXAMPLES + tuple(random_math_texts()) + tuple(random_texts())
+)
+def test_rewrite_math_templates(text):
+    assert wiki.rewrite_math_templates(text) == reference_rewrite_math_templates(text)
+
+
+@pytest.mark.parametrize(
+    "text", MATH_EXAMPLES + tuple(random_math_texts()) + tuple(random_texts())
+)
+def test_fix_math(text):
+    assert wiki.fix_math(text) == reference_fix_math(text)
+
+
+def test_parser_version(tmp_path):
+    (tmp_path / "package.json").write_text(
+        '{"dependencies": {"wtf_wikipedia": "^10.3.1", "wtf-plugin-api": "^2.0.0",'
+        ' "wtf-plugin-latex": "^1.0.0", "express": "^4.19.2"}}'
+    )
+    installed = tmp_path / "node_modules" / "wtf_wikipedia"
+    installed.mkdir(parents=True)
+    (installed / "package.json").write_text('{"version": "10.4.0"}')
+    assert wiki.parser_version(str(tmp_path)) == (
+        "wtf_wikipedia=10.4.0,wtf-plugin-api=^2.0.0,wtf-plugin-latex=^1.0.0"
+    )